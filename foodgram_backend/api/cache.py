@@ -0,0 +1,151 @@
+"""Кеширование ответов API."""
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+from constants import (SINGLE_FLIGHT_LOCK_TIMEOUT, SINGLE_FLIGHT_POLL_INTERVAL,
+                       SINGLE_FLIGHT_WAIT_TIMEOUT)
+
+CACHE_HIT = 'HIT'
+CACHE_MISS = 'MISS'
+
+
+def _stat_key(name, result):
+    return f'stats:{name}:{result.lower()}'
+
+
+def count_cache_result(name, result, delta=1):
+    """Увеличивает счетчик попаданий или промахов кеша name."""
+    if not delta:
+        return
+    key = _stat_key(name, result)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.set(key, delta, timeout=None)
+
+
+def get_cache_stats(name):
+    """Счетчики попаданий и промахов кеша name."""
+    keys = {result: _stat_key(name, result)
+            for result in (CACHE_HIT, CACHE_MISS)}
+    values = cache.get_many(keys.values())
+    return {
+        'hits': values.get(keys[CACHE_HIT], 0),
+        'misses': values.get(keys[CACHE_MISS], 0),
+    }
+
+
+def get_many_single_flight(keys, build, timeout, name=None):
+    """Значения из кеша для словаря {идентификатор: ключ кеша}.
+
+    Отсутствующие значения строит build(идентификаторы) -> {id: значение}.
+    Построение каждого ключа захватывается блокировкой через cache.add,
+    поэтому одновременные промахи по одному ключу строят его один раз,
+    а остальные запросы ждут готовое значение не дольше
+    SINGLE_FLIGHT_WAIT_TIMEOUT секунд и затем строят его сами.
+    """
+    cached = cache.get_many(keys.values())
+    result = {ident: cached[key] for ident, key in keys.items()
+              if key in cached}
+    missing = [ident for ident in keys if ident not in result]
+    if name:
+        count_cache_result(name, CACHE_HIT, len(result))
+        count_cache_result(name, CACHE_MISS, len(missing))
+    if not missing:
+        return result
+
+    owned, waiting = [], []
+    for ident in missing:
+        lock_key = f'lock:{keys[ident]}'
+        if cache.add(lock_key, 1, SINGLE_FLIGHT_LOCK_TIMEOUT):
+            owned.append(ident)
+        else:
+            waiting.append(ident)
+
+    def build_and_store(idents):
+        built = build(idents)
+        cache.set_many({keys[ident]: value
+                        for ident, value in built.items()}, timeout)
+        result.update(built)
+
+    if owned:
+        try:
+            build_and_store(owned)
+        finally:
+            cache.delete_many([f'lock:{keys[ident]}' for ident in owned])
+
+    deadline = time.monotonic() + SINGLE_FLIGHT_WAIT_TIMEOUT
+    while waiting and time.monotonic() < deadline:
+        time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        ready = cache.get_many([keys[ident] for ident in waiting])
+        for ident in waiting:
+            if keys[ident] in ready:
+                result[ident] = ready[keys[ident]]
+        waiting = [ident for ident in waiting if ident not in result]
+    if waiting:
+        build_and_store(waiting)
+    return result
+
+
+def normalize_query_params(query_params, ignore=()):
+    """Строка запроса с отсортированными параметрами и значениями."""
+    return urlencode(sorted(
+        (name, value)
+        for name in query_params if name not in ignore
+        for value in query_params.getlist(name)
+    ))
+
+
+class AnonymousResponseCacheMixin:
+    """Кеширует ответы list/retrieve для анонимных пользователей.
+
+    Ключ включает версию данных из get_anonymous_cache_version, поэтому
+    ответы устаревают при изменении данных без удаления из кеша.
+    """
+
+    anonymous_cache_name = None
+    anonymous_cache_ignore_params = ()
+
+    def get_anonymous_cache_version(self):
+        raise NotImplementedError
+
+    def get_anonymous_cache_key(self, request):
+        params = normalize_query_params(request.query_params,
+                                        self.anonymous_cache_ignore_params)
+        digest = hashlib.md5(
+            f'{request.scheme}://{request.get_host()}?{params}'.encode()
+        ).hexdigest()
+        return (f'response:{self.anonymous_cache_name}:{self.action}:'
+                f'{self.get_anonymous_cache_version()}:{digest}')
+
+    def get_cached_response(self, handler, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+        key = self.get_anonymous_cache_key(request)
+        data = cache.get(key)
+        if data is not None:
+            count_cache_result(self.anonymous_cache_name, CACHE_HIT)
+            response = Response(data)
+            response['X-Cache'] = CACHE_HIT
+            return response
+        count_cache_result(self.anonymous_cache_name, CACHE_MISS)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(key, response.data, settings.RESPONSE_CACHE_TIMEOUT)
+        response['X-Cache'] = CACHE_MISS
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super().list, request,
+                                        *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(super().retrieve, request,
+                                        *args, **kwargs)
@@ -0,0 +1,145 @@
+"""Справочники тегов и ингредиентов в памяти воркера."""
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from rest_framework.renderers import JSONRenderer
+
+from recipes.models import DataVersion, Ingredients, Tags
+
+from .serializers import IngredientsSerializer, TagsReadSerializer
+
+CATALOGUE_VERSION_NAME = 'catalogue'
+
+
+class CatalogueSnapshot:
+    """Неизменяемый снимок справочника с готовым JSON каждой записи.
+
+    Записи отсортированы по имени в нижнем регистре, что дает поиск по
+    началу имени бинарным поиском.
+    """
+
+    def __init__(self, items):
+        renderer = JSONRenderer()
+        items = sorted(items, key=lambda item: (item['name'].lower(),
+                                                item['id']))
+        self.names = [item['name'].lower() for item in items]
+        self.encoded = [renderer.render(item) for item in items]
+        self.by_id = dict(zip((item['id'] for item in items),
+                              self.encoded))
+        self.all = self.render(self.encoded)
+
+    @staticmethod
+    def render(encoded):
+        return b'[' + b','.join(encoded) + b']'
+
+    def search(self, value):
+        """Имена, начинающиеся с value, а если таких нет - содержащие."""
+        if not value:
+            return self.all
+        value = value.lower()
+        start = position = bisect_left(self.names, value)
+        while (position < len(self.names)
+               and self.names[position].startswith(value)):
+            position += 1
+        if position > start:
+            return self.render(self.encoded[start:position])
+        return self.render([encoded for name, encoded
+                            in zip(self.names, self.encoded)
+                            if value in name])
+
+
+class Catalogue:
+    """Справочники, перезагружаемые по версии из базы.
+
+    Версия проверяется не чаще раза в CATALOGUE_CHECK_INTERVAL секунд,
+    поэтому между проверками чтение не обращается к базе. Изменения в
+    этом же процессе сбрасывают снимок сразу через invalidate().
+    """
+
+    sources = {
+        'tags': (Tags, TagsReadSerializer),
+        'ingredients': (Ingredients, IngredientsSerializer),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.snapshots = {}
+        self.checked_at = None
+
+    def invalidate(self):
+        self.checked_at = None
+
+    def is_fresh(self):
+        return (self.checked_at is not None
+                and time.monotonic() - self.checked_at
+                < settings.CATALOGUE_CHECK_INTERVAL)
+
+    def refresh(self):
+        if self.is_fresh():
+            return
+        with self.lock:
+            if self.is_fresh():
+                return
+            version = DataVersion.get_version(CATALOGUE_VERSION_NAME)
+            if version != self.version or not self.snapshots:
+                self.snapshots = {
+                    name: CatalogueSnapshot(
+                        serializer(model.objects.all(), many=True).data)
+                    for name, (model, serializer) in self.sources.items()
+                }
+                self.version = version
+            self.checked_at = time.monotonic()
+
+    def get_version(self):
+        self.refresh()
+        return self.version
+
+    def get_snapshot(self, name):
+        self.refresh()
+        return self.snapshots[name]
+
+
+catalogue = Catalogue()
+
+
+def invalidate_catalogue():
+    """Отмечает изменение тегов или ингредиентов для всех воркеров."""
+    DataVersion.bump(CATALOGUE_VERSION_NAME)
+    catalogue.invalidate()
+
+
+class CatalogueMixin:
+    """Ответы list/retrieve из справочника в памяти в формате JSON.
+
+    Остальные форматы (например, browsable API) обслуживаются обычным
+    путем через базу.
+    """
+
+    catalogue_name = None
+    catalogue_search_param = None
+
+    def is_catalogue_request(self, request):
+        return request.accepted_renderer.format == 'json'
+
+    def list(self, request, *args, **kwargs):
+        if not self.is_catalogue_request(request):
+            return super().list(request, *args, **kwargs)
+        snapshot = catalogue.get_snapshot(self.catalogue_name)
+        value = (request.query_params.get(self.catalogue_search_param)
+                 if self.catalogue_search_param else None)
+        return HttpResponse(snapshot.search(value),
+                            content_type='application/json')
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.is_catalogue_request(request):
+            return super().retrieve(request, *args, **kwargs)
+        snapshot = catalogue.get_snapshot(self.catalogue_name)
+        try:
+            content = snapshot.by_id[int(kwargs[self.lookup_field])]
+        except (KeyError, ValueError):
+            raise Http404
+        return HttpResponse(content, content_type='application/json')
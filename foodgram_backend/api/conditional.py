@@ -0,0 +1,93 @@
+"""Условные GET-запросы по версиям данных."""
+import hashlib
+from datetime import datetime, timezone
+
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date, quote_etag
+
+from .cache import normalize_query_params
+from .versions import get_versions
+
+
+def get_user_versions(user):
+    """Версии данных пользователя, влияющих на флаги в ответах."""
+    if not user.is_authenticated:
+        return []
+    return [(name, user.pk)
+            for name in ('favorites', 'shopping_cart', 'follows')]
+
+
+class ConditionalGetMixin:
+    """ETag и Last-Modified из версий данных.
+
+    Валидаторы считаются до сериализации: при совпадении If-None-Match
+    или If-Modified-Since возвращается 304 без обращения к базе.
+    Версии читаются из базы одним запросом и запоминаются на время
+    запроса. Действия, для которых get_validator_versions возвращает
+    None, обрабатываются как обычно.
+    """
+
+    public_max_age = 0
+
+    def get_validator_versions(self):
+        """Ключи версий из api.versions или None без валидаторов."""
+        raise NotImplementedError
+
+    def get_validator_values(self):
+        if not hasattr(self, '_validator_values'):
+            parts = self.get_validator_versions()
+            self._validator_values = (None if parts is None
+                                      else get_versions(parts))
+        return self._validator_values
+
+    def get_validators(self, request):
+        versions = self.get_validator_values()
+        if versions is None:
+            return None, None
+        digest = hashlib.md5(repr((
+            self.action, self.kwargs, request.user.pk,
+            normalize_query_params(request.query_params),
+            request.get_host(), request.accepted_renderer.format, versions,
+        )).encode()).hexdigest()
+        # Без версий (данные не менялись) Last-Modified не отдается.
+        last_modified = max(versions, default=0) // 1_000_000 or None
+        return quote_etag(digest), last_modified
+
+    def patch_cache_headers(self, request, response):
+        if request.user.is_authenticated:
+            patch_cache_control(response, private=True, no_cache=True)
+        else:
+            patch_cache_control(response, public=True,
+                                max_age=self.public_max_age)
+        patch_vary_headers(response, ('Accept', 'Authorization'))
+
+    def get_conditional_response(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request)
+        if etag is None:
+            return handler(request, *args, **kwargs)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            self.patch_cache_headers(request, response)
+        return response
+
+    def get_last_modified(self):
+        """Время последнего изменения данных текущего ответа."""
+        _, last_modified = self.get_validators(self.request)
+        if last_modified is None:
+            return None
+        return datetime.fromtimestamp(last_modified, tz=timezone.utc)
+
+    def list(self, request, *args, **kwargs):
+        return self.get_conditional_response(super().list, request,
+                                             *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_conditional_response(super().retrieve, request,
+                                             *args, **kwargs)
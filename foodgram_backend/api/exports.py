@@ -0,0 +1,243 @@
+"""Выгрузка списка покупок в txt, csv и pdf.
+
+Текстовые форматы отдаются потоком по мере чтения строк агрегата, pdf
+собирается в ограниченном пуле потоков: запрос не ждет сборки, а сразу
+получает 202 с Location и Retry-After, и повторный запрос по этому
+адресу отдает файл из кеша. Готовый файл кешируется по
+версии корзины, повторная выгрузка берется из кеша.
+"""
+import csv
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import status
+
+from recipes.models import ShoppingCart, ShoppingListItem
+
+from .cache import CACHE_HIT, CACHE_MISS, count_cache_result
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд помнить неудачную сборку PDF, чтобы сообщить о ней
+# при следующем запросе.
+RENDER_ERROR_TIMEOUT = 60
+
+
+class ShoppingListExport:
+    """Данные списка покупок пользователя для выгрузки."""
+
+    def __init__(self, user, date):
+        self.user = user
+        self.date = date
+
+    def get_header(self):
+        name = self.user.get_full_name() or self.user.username
+        total_recipes = ShoppingCart.objects.filter(user=self.user).count()
+        date = timezone.localtime(self.date).strftime('%d.%m.%Y %H:%M')
+        return [
+            ('Список покупок', ''),
+            ('Пользователь', name),
+            ('Количество рецептов', total_recipes),
+            ('Дата', date),
+        ]
+
+    def get_items(self):
+        """Строки (название, единица, количество) без загрузки в память."""
+        return ShoppingListItem.objects.filter(user=self.user).values_list(
+            F('ingredient__name'), F('ingredient__measurement_unit'),
+            'total_amount',
+        ).order_by('ingredient__name').iterator(
+            chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+
+def iter_txt(export):
+    for title, value in export.get_header():
+        yield f'{title}: {value}\n' if value != '' else f'{title}\n'
+    yield '\n'
+    empty = True
+    for name, unit, amount in export.get_items():
+        empty = False
+        yield f'• {name}: {amount} {unit}\n'
+    if empty:
+        yield 'Корзина пуста\n'
+
+
+class _Echo:
+    """Псевдофайл для csv.writer, возвращающий записанную строку."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(export):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['name', 'measurement_unit', 'amount'])
+    for row in export.get_items():
+        yield writer.writerow(row)
+
+
+def render_pdf(header, items):
+    """PDF из заранее прочитанных строк, без обращений к базе."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+
+    font = 'ShoppingListFont'
+    if font not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(font, settings.PDF_FONT_PATH))
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+    margin, line_height = 50, 16
+    y = height - margin
+
+    def write_line(text, size=11):
+        nonlocal y
+        if y < margin:
+            pdf.showPage()
+            y = height - margin
+        pdf.setFont(font, size)
+        pdf.drawString(margin, y, text)
+        y -= line_height
+
+    for title, value in header:
+        write_line(f'{title}: {value}' if value != '' else title,
+                   size=16 if value == '' else 11)
+    y -= line_height
+    for name, unit, amount in items:
+        write_line(f'• {name}: {amount} {unit}')
+    if not items:
+        write_line('Корзина пуста')
+    pdf.save()
+    return buffer.getvalue()
+
+
+class PDFRenderPool:
+    """Ограниченный пул потоков для сборки PDF.
+
+    Одинаковые задания объединяются по ключу кеша, а при заполненной
+    очереди новые задания не принимаются.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='pdf')
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def submit(self, key, header, items):
+        """Future с содержимым PDF или None, если пул перегружен."""
+        with self.lock:
+            future = self.pending.get(key)
+            if future is not None:
+                return future
+            if not self.slots.acquire(blocking=False):
+                return None
+            future = self.executor.submit(self.render, key, header, items)
+            self.pending[key] = future
+            return future
+
+    def render(self, key, header, items):
+        try:
+            content = render_pdf(header, items)
+            cache.set(key, content, settings.EXPORT_CACHE_TIMEOUT)
+            return content
+        except Exception:
+            logger.exception('Не удалось собрать PDF %s', key)
+            cache.set(f'error:{key}', True, RENDER_ERROR_TIMEOUT)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+            self.slots.release()
+
+
+pdf_pool = PDFRenderPool(settings.PDF_RENDER_WORKERS,
+                         settings.PDF_RENDER_QUEUE_SIZE)
+
+TEXT_FORMATS = {
+    'txt': ('text/plain; charset=utf-8', iter_txt),
+    'csv': ('text/csv; charset=utf-8', iter_csv),
+}
+CONTENT_TYPES = {
+    'pdf': 'application/pdf',
+    **{name: content_type
+       for name, (content_type, _) in TEXT_FORMATS.items()},
+}
+
+
+def get_cache_key(user, version, export_format):
+    return f'export:shopping_cart:{user.pk}:{version}:{export_format}'
+
+
+def _attach(response, export_format):
+    response['Content-Disposition'] = (
+        f'attachment; filename="shopping-list.{export_format}"')
+    return response
+
+
+def _stream_and_cache(chunks, key):
+    """Отдает куски потоком и кладет результат в кеш, если он невелик."""
+    parts, size = [], 0
+    for chunk in chunks:
+        data = chunk.encode()
+        if parts is not None:
+            size += len(data)
+            if size > settings.EXPORT_CACHE_MAX_BYTES:
+                parts = None
+            else:
+                parts.append(data)
+        yield data
+    if parts is not None:
+        cache.set(key, b''.join(parts), settings.EXPORT_CACHE_TIMEOUT)
+
+
+def export_shopping_list(user, version, date, export_format, location):
+    """Ответ с выгрузкой списка покупок в формате export_format.
+
+    version - версия корзины, location - адрес, по которому забирать
+    готовый PDF.
+    """
+    key = get_cache_key(user, version, export_format)
+    content = cache.get(key)
+    if content is not None:
+        count_cache_result('shopping_list_export', CACHE_HIT)
+        return _attach(HttpResponse(
+            content, content_type=CONTENT_TYPES[export_format]),
+            export_format)
+    count_cache_result('shopping_list_export', CACHE_MISS)
+    export = ShoppingListExport(user, date)
+
+    if export_format in TEXT_FORMATS:
+        content_type, iter_rows = TEXT_FORMATS[export_format]
+        return _attach(StreamingHttpResponse(
+            _stream_and_cache(iter_rows(export), key),
+            content_type=content_type), export_format)
+
+    header, items = export.get_header(), list(export.get_items())
+    if cache.get(f'error:{key}'):
+        cache.delete(f'error:{key}')
+        return JsonResponse(
+            {'detail': 'Не удалось собрать PDF, повторите запрос.'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if pdf_pool.submit(key, header, items) is None:
+        response = JsonResponse(
+            {'detail': 'Сервис выгрузки PDF перегружен.'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = settings.PDF_RETRY_AFTER
+        return response
+    response = JsonResponse(
+        {'detail': 'PDF готовится, повторите запрос позже.'},
+        status=status.HTTP_202_ACCEPTED)
+    response['Location'] = location
+    response['Retry-After'] = settings.PDF_RETRY_AFTER
+    return response
@@ -0,0 +1,59 @@
+"""Лента рецептов авторов, на которых подписан пользователь."""
+from itertools import chain
+
+from django.db import connection
+
+from recipes.models import Recipes, TimelineEntry
+from recipes.timeline import get_fanout_on_read_author_ids
+from users.models import Follow
+
+
+class Feed:
+    """Источник страниц ленты для KeysetPagination.
+
+    Ключи (pub_date, id) берутся диапазонным чтением по индексу из
+    TimelineEntry и, для авторов с fan-out on read, из рецептов каждого
+    такого автора отдельно: одно условие author IN (...) заставило бы
+    базу прочитать все рецепты этих авторов до курсора и отсортировать.
+    Затем ключи сливаются, и рецепты страницы загружаются из recipes
+    одним запросом.
+    """
+
+    def __init__(self, user, recipes):
+        self.user = user
+        self.recipes = recipes
+
+    def get_sources(self, pagination, cursor, reverse, limit):
+        sources = [pagination.apply_cursor(
+            TimelineEntry.objects.filter(user=self.user).values_list(
+                'pub_date', 'recipe_id'),
+            cursor, reverse, id_field='recipe_id')[:limit]]
+        author_ids = get_fanout_on_read_author_ids()
+        if author_ids:
+            author_ids = Follow.objects.filter(
+                user=self.user, following__in=author_ids).values_list(
+                    'following', flat=True)
+            sources.extend(self.get_author_sources(
+                pagination, list(author_ids), cursor, reverse, limit))
+        return sources
+
+    @staticmethod
+    def get_author_sources(pagination, author_ids, cursor, reverse, limit):
+        """По limit ключей каждого автора - одним UNION ALL, если база
+        умеет LIMIT в частях составного запроса."""
+        querysets = [pagination.apply_cursor(
+            Recipes.objects.filter(author=author_id).values_list(
+                'pub_date', 'id'),
+            cursor, reverse)[:limit] for author_id in author_ids]
+        if (len(querysets) > 1 and connection.features
+                .supports_slicing_ordering_in_compound):
+            return [querysets[0].union(*querysets[1:], all=True)]
+        return querysets
+
+    def fetch_page(self, pagination, cursor, reverse, limit):
+        keys = sorted(
+            set(chain.from_iterable(
+                self.get_sources(pagination, cursor, reverse, limit))),
+            reverse=not reverse)[:limit]
+        recipes = self.recipes.in_bulk([pk for _, pk in keys])
+        return [recipes[pk] for _, pk in keys if pk in recipes]
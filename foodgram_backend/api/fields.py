@@ -1,17 +1,116 @@
 """Кастом поля для сериализаторов."""
 import base64
+from pathlib import Path
 
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.core.files.base import ContentFile
 from rest_framework import serializers
 
+from .uploads import check_image_dimensions, check_image_size
+
+# Ключ контекста сериализатора с заранее загруженными объектами:
+# {модель: {pk: объект}}.
+PRELOADED_CONTEXT_KEY = 'preloaded_objects'
+
 
 class Base64ImageField(serializers.ImageField):
-    """Класс для кастомного поля image сериализатора Recipes."""
+    """Класс для кастомного поля image сериализатора Recipes.
+
+    Принимает base64-строку или загруженный файл (multipart или «сырое»
+    тело запроса).
+    """
 
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
             format, imgstr = data.split(';base64,')
+            error = check_image_size(len(imgstr) * 3 // 4)
+            if error:
+                raise serializers.ValidationError(error)
             ext = format.split('/')[-1]
             data = ContentFile(base64.b64decode(imgstr), name='image.' + ext)
 
+        image = super().to_internal_value(data)
+        error = check_image_dimensions(*image.image.size)
+        if error:
+            raise serializers.ValidationError(error)
+        return image
+
+
+class LocalImageField(Base64ImageField):
+    """Base64ImageField, принимающий еще и путь к файлу.
+
+    Путь считается от каталога context['image_root'] и не может из него
+    выходить.
+    """
+
+    default_error_messages = {
+        'not_found': 'Файл изображения {path} не найден.',
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) and not data.startswith('data:'):
+            data = self.read_file(data)
         return super().to_internal_value(data)
+
+    def read_file(self, path):
+        root = Path(self.context['image_root']).resolve()
+        full_path = (root / path).resolve()
+        if not full_path.is_relative_to(root) or not full_path.is_file():
+            self.fail('not_found', path=path)
+        error = check_image_size(full_path.stat().st_size)
+        if error:
+            raise serializers.ValidationError(error)
+        return ContentFile(full_path.read_bytes(), name=full_path.name)
+
+
+def preload_related_objects(context, queryset, values, catalogue_name=None):
+    """Загружает объекты queryset по всем pk из values одним запросом.
+
+    С VALIDATE_PKS_FROM_CATALOGUE pk, которые есть в справочнике
+    catalogue_name в памяти, принимаются без запроса. Неверные значения
+    пропускаются - ошибку по ним выдаст само поле.
+    """
+    model = queryset.model
+    pks = set()
+    for value in values:
+        if isinstance(value, bool):
+            continue
+        try:
+            pks.add(model._meta.pk.to_python(value))
+        except DjangoValidationError:
+            continue
+    objects = {}
+    if catalogue_name and settings.VALIDATE_PKS_FROM_CATALOGUE:
+        from .catalogue import catalogue
+
+        snapshot = catalogue.get_snapshot(catalogue_name)
+        objects = {pk: model(pk=pk) for pk in pks if pk in snapshot.by_id}
+    missing = pks - objects.keys()
+    if missing:
+        objects.update(queryset.in_bulk(missing))
+    context.setdefault(PRELOADED_CONTEXT_KEY, {})[model] = objects
+
+
+class BatchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """PrimaryKeyRelatedField без запроса на каждое значение.
+
+    Объекты берутся из загруженных preload_related_objects, а если
+    загрузки не было, поле работает как обычно.
+    """
+
+    def to_internal_value(self, data):
+        model = self.get_queryset().model
+        objects = self.context.get(PRELOADED_CONTEXT_KEY, {}).get(model)
+        if objects is None:
+            return super().to_internal_value(data)
+        if self.pk_field is not None:
+            data = self.pk_field.to_internal_value(data)
+        try:
+            if isinstance(data, bool):
+                raise DjangoValidationError('')
+            return objects[model._meta.pk.to_python(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except DjangoValidationError:
+            self.fail('incorrect_type', data_type=type(data).__name__)
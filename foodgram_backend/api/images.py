@@ -0,0 +1,187 @@
+"""Производные изображений рецептов и аватаров.
+
+После загрузки оригинала пул потоков строит уменьшенные копии нескольких
+ширин в форматах из IMAGE_DERIVATIVE_FORMATS (без EXIF) и сохраняет их
+пути в поле *_variants модели:
+
+    {'source': 'recipes/images/x.png',
+     'sizes': {'320': {'webp': '...', 'jpeg': '...'}, ...}}
+
+source — имя оригинала, по которому построены копии; если оно не
+совпадает с текущим, копии устарели и будут построены заново.
+"""
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, features
+
+from recipes.models import Recipes
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+# Модель -> (поле оригинала, поле с производными).
+IMAGE_FIELDS = {
+    Recipes: ('image', 'image_variants'),
+    User: ('avatar', 'avatar_variants'),
+}
+SAVE_OPTIONS = {
+    'avif': {'quality': 60},
+    'webp': {'quality': 80, 'method': 4},
+    'jpeg': {'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+
+def get_formats():
+    return [image_format for image_format in settings.IMAGE_DERIVATIVE_FORMATS
+            if image_format == 'jpeg' or features.check(image_format)]
+
+
+def is_stale(instance):
+    field, variants_field = IMAGE_FIELDS[type(instance)]
+    source = getattr(instance, field).name or None
+    return (getattr(instance, variants_field) or {}).get('source') != source
+
+
+def render_derivatives(source):
+    """Строит копии source и возвращает карту размеров."""
+    with default_storage.open(source) as file:
+        image = ImageOps.exif_transpose(Image.open(file))
+        image = image.convert('RGB')
+    stem = os.path.splitext(source)[0]
+    widths = [width for width in settings.IMAGE_DERIVATIVE_WIDTHS
+              if width < image.width] or [image.width]
+    sizes = {}
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+        sizes[str(width)] = {}
+        for image_format in get_formats():
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format.upper(),
+                         **SAVE_OPTIONS[image_format])
+            extension = 'jpg' if image_format == 'jpeg' else image_format
+            sizes[str(width)][image_format] = default_storage.save(
+                f'{stem}_{width}.{extension}',
+                ContentFile(buffer.getvalue()))
+    return sizes
+
+
+def delete_derivatives(variants):
+    for formats in (variants or {}).get('sizes', {}).values():
+        for path in formats.values():
+            default_storage.delete(path)
+
+
+def release_on_commit(name, variants):
+    """После коммита снимает ссылки на оригинал name и его копии."""
+    def release():
+        if name:
+            default_storage.delete(name)
+        delete_derivatives(variants)
+
+    transaction.on_commit(release)
+
+
+def replace_image(instance, content):
+    """Сохраняет content оригиналом instance, None - удаляет оригинал.
+
+    Старый оригинал и его копии освобождаются только после коммита: при
+    откате строка по-прежнему ссылается на них.
+    """
+    field, variants_field = IMAGE_FIELDS[type(instance)]
+    old_name = getattr(instance, field).name
+    old_variants = getattr(instance, variants_field)
+    with transaction.atomic():
+        setattr(instance, field, content)
+        setattr(instance, variants_field, {})
+        instance.save(update_fields=[field, variants_field])
+        release_on_commit(old_name, old_variants)
+
+
+def release_images(instance):
+    """Освобождает оригинал и копии удаленного объекта."""
+    field, variants_field = IMAGE_FIELDS[type(instance)]
+    deferred = instance.get_deferred_fields()
+    if field in deferred or variants_field in deferred:
+        # Удаленную строку уже не дочитать.
+        return
+    release_on_commit(getattr(instance, field).name,
+                      getattr(instance, variants_field))
+
+
+def build_derivatives(model, pk, force=False):
+    """Приводит производные объекта в соответствие с оригиналом."""
+    from .signals import invalidate_recipes
+
+    field, variants_field = IMAGE_FIELDS[model]
+    instance = model.objects.filter(pk=pk).only(
+        field, variants_field).first()
+    if instance is None or not (force or is_stale(instance)):
+        return
+    source = getattr(instance, field).name or None
+    old_variants = getattr(instance, variants_field)
+    variants = {}
+    if source:
+        variants = {'source': source, 'sizes': render_derivatives(source)}
+    with transaction.atomic():
+        updated = model.objects.filter(pk=pk, **{field: source or ''}).update(
+            **{variants_field: variants})
+        if model is Recipes:
+            invalidate_recipes([pk])
+        else:
+            invalidate_recipes(instance.recipes.values_list('pk', flat=True))
+    if updated:
+        delete_derivatives(old_variants)
+    else:
+        delete_derivatives(variants)
+
+
+class DerivativePool:
+    """Пул потоков для построения производных вне запроса."""
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='images')
+
+    def submit(self, model, pk):
+        return self.executor.submit(self.run, model, pk)
+
+    @staticmethod
+    def run(model, pk):
+        try:
+            build_derivatives(model, pk)
+        except Exception:
+            logger.exception('Не удалось построить копии изображения '
+                             '%s %s', model.__name__, pk)
+        finally:
+            close_old_connections()
+
+
+derivative_pool = DerivativePool(settings.IMAGE_DERIVATIVE_WORKERS)
+
+
+def schedule_derivatives(instance):
+    """После коммита ставит построение копий в очередь, если нужно."""
+    if is_stale(instance):
+        model, pk = type(instance), instance.pk
+        transaction.on_commit(lambda: derivative_pool.submit(model, pk))
+
+
+def get_size_map(variants, request=None):
+    """Карта {ширина: {формат: url}} для ответа API."""
+    sizes = {}
+    for width, formats in (variants or {}).get('sizes', {}).items():
+        sizes[width] = {}
+        for image_format, path in formats.items():
+            url = default_storage.url(path)
+            sizes[width][image_format] = (
+                request.build_absolute_uri(url) if request else url)
+    return sizes
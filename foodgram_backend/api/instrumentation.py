@@ -0,0 +1,138 @@
+"""Учет SQL-запросов каждого запроса к API.
+
+QueryInstrumentationMiddleware для доли запросов
+SQL_INSTRUMENTATION_SAMPLE_RATE оборачивает выполнение SQL через
+connection.execute_wrapper и считает число запросов и время в базе,
+в том числе при DEBUG=False. В ответ добавляется заголовок
+Server-Timing: db, render - рендеринг готового ответа DRF в байты
+(serializer.data считается во view и входит только в total) - и total.
+Медленные запросы и запросы с повторяющимися SQL (N+1) пишутся в лог
+одной JSON-строкой с отпечатками SQL: литералы и списки IN заменены на
+плейсхолдеры.
+"""
+import json
+import logging
+import random
+import re
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Сколько самых долгих отпечатков SQL писать в лог.
+LOGGED_FINGERPRINTS = 10
+
+FINGERPRINT_RULES = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'"s\d+_x\d+"'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\bIN\s*\((?:\s*\?\s*,?)+\)', re.IGNORECASE), 'IN (...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """SQL без значений: запросы, отличающиеся только ими, совпадают."""
+    for pattern, replacement in FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class QueryStats:
+    """execute_wrapper, копящий число и время запросов по отпечаткам."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = defaultdict(lambda: [0, 0.0])
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.duration += duration
+            stats = self.fingerprints[sql]
+            stats[0] += 1
+            stats[1] += duration
+
+    def by_fingerprint(self):
+        """{отпечаток: [число, секунды]}; отпечатки считаются только
+        здесь, а не на каждом запросе."""
+        result = defaultdict(lambda: [0, 0.0])
+        for sql, (count, duration) in self.fingerprints.items():
+            stats = result[fingerprint(sql)]
+            stats[0] += count
+            stats[1] += duration
+        return result
+
+
+class QueryInstrumentationMiddleware:
+    """Server-Timing и лог медленных запросов и N+1 по выборке запросов."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.SQL_INSTRUMENTATION_SAMPLE_RATE:
+            return self.get_response(request)
+        stats = QueryStats()
+        request._render_duration = 0.0
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        total = time.perf_counter() - started
+        response['Server-Timing'] = (
+            f'db;dur={stats.duration * 1000:.1f};'
+            f'desc="{stats.count} queries", '
+            f'render;dur={request._render_duration * 1000:.1f}, '
+            f'total;dur={total * 1000:.1f}')
+        self.log(request, response, stats, total)
+        return response
+
+    def process_template_response(self, request, response):
+        """Время рендеринга ответа DRF - через post-render callback."""
+        if not hasattr(request, '_render_duration'):
+            return response
+        started = time.perf_counter()
+
+        def finish(response):
+            request._render_duration = time.perf_counter() - started
+
+        response.add_post_render_callback(finish)
+        return response
+
+    def log(self, request, response, stats, total):
+        fingerprints = stats.by_fingerprint()
+        duplicates = {
+            sql: count for sql, (count, _) in fingerprints.items()
+            if count >= settings.SQL_DUPLICATE_QUERY_THRESHOLD}
+        slow = total * 1000 >= settings.SQL_SLOW_REQUEST_MS
+        if not slow and not duplicates:
+            return
+        slowest = sorted(fingerprints.items(), key=lambda item: item[1][1],
+                         reverse=True)[:LOGGED_FINGERPRINTS]
+        logger.warning(json.dumps({
+            'event': 'slow_request' if slow else 'duplicate_queries',
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'db_ms': round(stats.duration * 1000, 1),
+            'queries': stats.count,
+            'duplicates': duplicates,
+            'fingerprints': [
+                {'sql': sql, 'count': count, 'ms': round(duration * 1000, 1)}
+                for sql, (count, duration) in slowest],
+        }, ensure_ascii=False))
@@ -0,0 +1,29 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.shortlinks import encode_short_code
+from recipes.models import Recipes
+
+
+class Command(BaseCommand):
+    help = 'Заполняет короткие коды рецептов, у которых их нет'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Размер пачки обновлений')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ids = Recipes.objects.filter(short_url__isnull=True).values_list(
+            'pk', flat=True).iterator(chunk_size=batch_size)
+        total = 0
+        while batch := list(islice(ids, batch_size)):
+            with transaction.atomic():
+                Recipes.objects.bulk_update(
+                    [Recipes(pk=pk, short_url=encode_short_code(pk))
+                     for pk in batch], ['short_url'])
+            total += len(batch)
+        self.stdout.write(self.style.SUCCESS(
+            f'Коротких кодов заполнено: {total}.'))
@@ -0,0 +1,95 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.views import RecipeViewSet
+from recipes import timeline
+from recipes.models import Recipes
+from users.models import Follow
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Замеряет раскладку рецепта по лентам подписчиков и чтение '
+            'ленты в режимах fan-out on write и fan-out on read. Данные '
+            'создаются в транзакции и откатываются.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--followers', type=int, default=100000)
+        parser.add_argument('--recipes', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=10)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+        cache.delete(timeline.FANOUT_ON_READ_CACHE_KEY)
+
+    def run(self, options):
+        followers = options['followers']
+        author = User.objects.create(username='bench_feed_author',
+                                     email='bench_feed_author@example.com')
+        started = time.perf_counter()
+        users = User.objects.bulk_create(
+            User(username=f'bench_feed_{number}',
+                 email=f'bench_feed_{number}@example.com')
+            for number in range(followers))
+        Follow.objects.bulk_create(
+            (Follow(user=user, following=author) for user in users),
+            batch_size=5000)
+        self.stdout.write(f'Подписчиков: {followers}, подготовка '
+                          f'{time.perf_counter() - started:.2f} с')
+        recipes = Recipes.objects.bulk_create(
+            Recipes(name=f'bench {number}', text='bench', cooking_time=1,
+                    author=author, image='recipes/images/bench.png')
+            for number in range(options['recipes']))
+        reader = users[len(users) // 2]
+
+        with override_settings(FEED_FANOUT_MAX_FOLLOWERS=followers + 1):
+            cache.delete(timeline.FANOUT_ON_READ_CACHE_KEY)
+            started = time.perf_counter()
+            for recipe in recipes:
+                timeline.fan_out(recipe.pk)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'fan-out on write: {elapsed / len(recipes):.3f} с на '
+                f'рецепт ({followers / elapsed * len(recipes):.0f} '
+                f'записей/с)')
+            self.read(reader, options['limit'], 'fan-out on write')
+
+        with override_settings(FEED_FANOUT_MAX_FOLLOWERS=followers):
+            cache.delete(timeline.FANOUT_ON_READ_CACHE_KEY)
+            self.read(reader, options['limit'], 'fan-out on read')
+
+    def read(self, user, limit, name):
+        view = RecipeViewSet.as_view({'get': 'feed'},
+                                     **RecipeViewSet.feed.kwargs)
+        request = APIRequestFactory().get('/api/recipes/feed/',
+                                          {'limit': limit},
+                                          HTTP_HOST='localhost')
+        force_authenticate(request, user)
+        cache.delete(timeline.FANOUT_ON_READ_CACHE_KEY)
+        timeline.get_fanout_on_read_author_ids()
+        connection.queries_log.clear()
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+            response.render()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'{name}: чтение ленты {elapsed * 1000:.1f} мс, '
+            f'{len(queries)} запросов, '
+            f'{len(response.data["results"])} рецептов')
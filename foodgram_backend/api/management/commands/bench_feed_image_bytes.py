@@ -0,0 +1,58 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipes
+
+
+def file_size(path):
+    try:
+        return default_storage.size(path)
+    except OSError:
+        return 0
+
+
+def pick_variant(variants, width, formats):
+    """Путь к наименьшей копии не уже width в первом доступном формате."""
+    sizes = sorted((int(size), paths)
+                   for size, paths in (variants or {}).get('sizes',
+                                                           {}).items())
+    for size, paths in sizes:
+        if size >= width or size == sizes[-1][0]:
+            for image_format in formats:
+                if image_format in paths:
+                    return paths[image_format]
+    return None
+
+
+class Command(BaseCommand):
+    help = ('Считает байты изображений одной страницы ленты: оригиналы '
+            'против уменьшенных копий.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=6,
+                            help='Рецептов на странице')
+        parser.add_argument('--width', type=int, default=320,
+                            help='Ширина карточки в пикселях')
+        parser.add_argument('--formats', nargs='+',
+                            default=['avif', 'webp', 'jpeg'],
+                            help='Форматы в порядке предпочтения клиента')
+
+    def handle(self, *args, **options):
+        recipes = Recipes.objects.select_related('author')[:options['limit']]
+        original = derived = 0
+        for recipe in recipes:
+            images = [(recipe.image.name, recipe.image_variants)]
+            if recipe.author.avatar:
+                images.append((recipe.author.avatar.name,
+                               recipe.author.avatar_variants))
+            for name, variants in images:
+                size = file_size(name)
+                original += size
+                path = pick_variant(variants, options['width'],
+                                    options['formats'])
+                derived += file_size(path) if path else size
+        self.stdout.write(f'Рецептов: {len(recipes)}')
+        self.stdout.write(f'Оригиналы: {original} байт')
+        self.stdout.write(f'Копии: {derived} байт')
+        if original:
+            self.stdout.write(f'Экономия: {100 - derived * 100 // original}%')
@@ -0,0 +1,70 @@
+import base64
+import io
+import json
+import os
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from PIL import Image
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from api.fields import Base64ImageField
+from api.uploads import ImageMultiPartParser, ImageUploadParser
+
+PARSERS = [JSONParser(), ImageMultiPartParser(), ImageUploadParser()]
+
+
+class Command(BaseCommand):
+    help = ('Замеряет время и пик памяти Python при приеме изображения '
+            'в base64, multipart/form-data и «сырым» телом запроса.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megabytes', type=float, nargs='+',
+                            default=[1, 5, 9])
+
+    def handle(self, *args, **options):
+        self.stdout.write('MB     upload     body bytes  seconds  peak KiB')
+        for megabytes in options['megabytes']:
+            image = self.make_image(int(megabytes * 1024 * 1024))
+            for name, request in self.make_requests(image):
+                self.measure(megabytes, name, request)
+
+    @staticmethod
+    def make_image(size):
+        """PNG из шума: почти не сжимается, весит около size байт."""
+        side = int((size / 3) ** 0.5)
+        buffer = io.BytesIO()
+        Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)
+                        ).save(buffer, 'PNG', compress_level=0)
+        return buffer.getvalue()
+
+    @staticmethod
+    def make_requests(image):
+        factory = APIRequestFactory()
+        encoded = 'data:image/png;base64,' + base64.b64encode(image).decode()
+        yield 'base64', factory.put(
+            '/', json.dumps({'image': encoded}),
+            content_type='application/json')
+        upload = io.BytesIO(image)
+        upload.name = 'image.png'
+        yield 'multipart', factory.put('/', {'image': upload},
+                                       format='multipart')
+        yield 'raw', factory.generic('PUT', '/', image,
+                                     content_type='image/png')
+
+    def measure(self, megabytes, name, django_request):
+        length = int(django_request.META['CONTENT_LENGTH'])
+        tracemalloc.start()
+        started = time.perf_counter()
+        request = Request(django_request, parsers=PARSERS)
+        data = request.data.get('image', request.data.get('file'))
+        image = Base64ImageField().to_internal_value(data)
+        image.close()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(f'{megabytes:<6} {name:<10} {length:<11} '
+                          f'{elapsed:<8.3f} {peak // 1024}')
@@ -0,0 +1,91 @@
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import status
+
+from api.exports import export_shopping_list, pdf_pool
+from recipes import shopping_list
+from recipes.models import (Ingredients, RecipeIngredients, Recipes,
+                            ShoppingCart)
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Замеряет время и пик памяти выгрузки списка покупок для '
+            'корзин разного размера. Данные создаются в транзакции и '
+            'откатываются.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, nargs='+',
+                            default=[10, 100, 500])
+        parser.add_argument('--ingredients-per-recipe', type=int,
+                            default=10)
+        parser.add_argument('--formats', nargs='+',
+                            default=['txt', 'csv', 'pdf'])
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        per_recipe = options['ingredients_per_recipe']
+        user = User.objects.create(username='bench_export',
+                                   email='bench_export@example.com')
+        ingredients = Ingredients.objects.bulk_create(
+            Ingredients(name=f'bench ingredient {number}',
+                        measurement_unit='г')
+            for number in range(max(options['recipes']) * per_recipe // 3
+                                + per_recipe))
+        self.stdout.write('recipes  format   bytes      seconds  peak KiB')
+        for size in options['recipes']:
+            ShoppingCart.objects.filter(user=user).delete()
+            recipes = Recipes.objects.bulk_create(
+                Recipes(name=f'bench {number}', text='bench',
+                        cooking_time=1, author=user,
+                        image='recipes/images/bench.png')
+                for number in range(size))
+            RecipeIngredients.objects.bulk_create(
+                RecipeIngredients(
+                    recipe_id=recipe,
+                    ingredient_id=ingredients[
+                        (index * 3 + offset) % len(ingredients)],
+                    amount=offset + 1)
+                for index, recipe in enumerate(recipes)
+                for offset in range(per_recipe))
+            ShoppingCart.objects.bulk_create(
+                ShoppingCart(user=user, recipe=recipe) for recipe in recipes)
+            shopping_list.rebuild([user.pk])
+            for export_format in options['formats']:
+                self.measure(user, size, export_format)
+
+    def measure(self, user, size, export_format):
+        tracemalloc.start()
+        started = time.perf_counter()
+        version = time.time_ns()
+        response = export_shopping_list(user, version, timezone.now(),
+                                        export_format, '')
+        while response.status_code == status.HTTP_202_ACCEPTED:
+            # PDF собирается в пуле: ждем сборку и забираем из кеша.
+            for future in list(pdf_pool.pending.values()):
+                future.result()
+            response = export_shopping_list(user, version, timezone.now(),
+                                            export_format, '')
+        length = sum(len(chunk) for chunk in response)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(f'{size:<8} {export_format:<8} {length:<10} '
+                          f'{elapsed:<8.3f} {peak // 1024}')
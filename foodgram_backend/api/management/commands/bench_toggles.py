@@ -0,0 +1,88 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api.views import RecipeViewSet, UserViewset
+from recipes.models import Favorites, Recipes, ShoppingCart
+from users.models import Follow
+
+User = get_user_model()
+
+ACTIONS = {
+    'favorite': (RecipeViewSet, '/api/recipes/{id}/favorite/'),
+    'shopping_cart': (RecipeViewSet, '/api/recipes/{id}/shopping_cart/'),
+    'subscribe': (UserViewset, '/api/users/{id}/subscribe/'),
+}
+
+
+class Command(BaseCommand):
+    help = ('Одновременно добавляет и удаляет одну связь пользователя и '
+            'рецепта (автора) из многих потоков и замеряет пропускную '
+            'способность и долю ошибок. Данные удаляются после замера.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--action', choices=ACTIONS, default='favorite')
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Запросов на поток')
+
+    def handle(self, *args, **options):
+        author = User.objects.create(username='bench_toggles_author',
+                                     email='bench_toggles_author@example.com')
+        user = User.objects.create(username='bench_toggles_user',
+                                   email='bench_toggles_user@example.com')
+        recipe = Recipes.objects.create(
+            name='bench', text='bench', cooking_time=1, author=author,
+            image='recipes/images/bench.png')
+        try:
+            self.run(options, user,
+                     author if options['action'] == 'subscribe' else recipe)
+        finally:
+            Favorites.objects.filter(user=user).delete()
+            ShoppingCart.objects.filter(user=user).delete()
+            Follow.objects.filter(user=user).delete()
+            User.objects.filter(pk__in=[user.pk, author.pk]).delete()
+
+    def run(self, options, user, target):
+        viewset, url = ACTIONS[options['action']]
+        view = viewset.as_view({'post': options['action'],
+                                'delete': options['action']},
+                               **getattr(viewset, options['action']).kwargs)
+        url = url.format(id=target.pk)
+        factory = APIRequestFactory()
+
+        def hammer(number):
+            statuses = Counter()
+            try:
+                for request_number in range(options['requests']):
+                    method = ('post' if (number + request_number) % 2
+                              else 'delete')
+                    request = getattr(factory, method)(
+                        url, HTTP_HOST='localhost')
+                    force_authenticate(request, user)
+                    try:
+                        statuses[view(request, id=target.pk).status_code] += 1
+                    except Exception as error:
+                        statuses[type(error).__name__] += 1
+            finally:
+                close_old_connections()
+            return statuses
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            statuses = sum(executor.map(hammer, range(options['threads'])),
+                           Counter())
+        elapsed = time.perf_counter() - started
+        total = sum(statuses.values())
+        errors = sum(count for status, count in statuses.items()
+                     if not isinstance(status, int) or status >= 500)
+        self.stdout.write(
+            f'{options["action"]}: {total} запросов из '
+            f'{options["threads"]} потоков за {elapsed:.2f} с '
+            f'({total / elapsed:.0f} запросов/с), ошибок {errors} '
+            f'({errors / total:.1%}); ответы: {dict(statuses)}')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from api.images import IMAGE_FIELDS, build_derivatives, is_stale
+
+
+class Command(BaseCommand):
+    help = 'Строит уменьшенные копии изображений рецептов и аватаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Перестроить и актуальные копии')
+
+    def handle(self, *args, **options):
+        for model, fields in IMAGE_FIELDS.items():
+            built = failed = 0
+            instances = model.objects.exclude(**{fields[0]: ''}).only(
+                *fields).iterator()
+            for instance in instances:
+                if not (options['force'] or is_stale(instance)):
+                    continue
+                try:
+                    build_derivatives(model, instance.pk,
+                                      force=options['force'])
+                    built += 1
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(
+                        f'{model.__name__} {instance.pk}: {error!r}')
+            self.stdout.write(self.style.SUCCESS(
+                f'{model._meta.verbose_name_plural}: построено {built}, '
+                f'ошибок {failed}.'))
@@ -0,0 +1,49 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from api.recipe_import import RecipeImporter
+from constants import RECIPE_IMPORT_BATCH_SIZE
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Импортирует рецепты из файла NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ndjson_file', type=str,
+                            help='Путь к файлу NDJSON, по рецепту в строке')
+        parser.add_argument('--author', required=True,
+                            help='username автора рецептов')
+        parser.add_argument('--image-root',
+                            help='Каталог, от которого считаются пути '
+                                 'к изображениям')
+        parser.add_argument('--batch-size', type=int,
+                            default=RECIPE_IMPORT_BATCH_SIZE,
+                            help='Размер пачки рецептов')
+
+    def handle(self, *args, **options):
+        try:
+            author = User.objects.get(username=options['author'])
+        except User.DoesNotExist:
+            raise CommandError(
+                f'Пользователь {options["author"]} не найден.')
+        importer = RecipeImporter(author, image_root=options['image_root'],
+                                  batch_size=options['batch_size'])
+        path = options['ndjson_file']
+        try:
+            with open(path, encoding='utf-8') as file:
+                results, seconds = importer.run(file)
+        except OSError as error:
+            raise CommandError(f'Ошибка импорта из {path}: {error!r}')
+        created = 0
+        for result in results:
+            if 'id' in result:
+                created += 1
+            else:
+                self.stderr.write(
+                    f'Строка {result["line"]}: {result["errors"]}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Импорт из {path}: создано {created}, ошибок '
+            f'{len(results) - created} за {seconds:.2f} с '
+            f'({created / max(seconds, 1e-6):.0f} рецептов/с).'))
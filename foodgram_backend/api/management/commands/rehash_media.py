@@ -0,0 +1,85 @@
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from api.signals import invalidate_recipes
+from recipes.models import Recipes
+from recipes.storage import ContentAddressedStorage, is_content_name
+
+User = get_user_model()
+
+# Модель, поле файла, поле с картой уменьшенных копий.
+MEDIA_FIELDS = [
+    (Recipes, 'image', 'image_variants'),
+    (User, 'avatar', 'avatar_variants'),
+]
+
+
+class Command(BaseCommand):
+    help = ('Переносит загруженные ранее медиа в хранилище по хешу '
+            'содержимого: файлы читаются потоком, одинаковые хранятся '
+            'один раз.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Не удалять файлы со старыми именами')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError('Хранилище по умолчанию не '
+                               'ContentAddressedStorage.')
+        self.renamed = {}
+        self.missing = 0
+        for model, field, variants_field in MEDIA_FIELDS:
+            moved = 0
+            instances = model.objects.exclude(**{field: ''}).only(
+                field, variants_field).iterator()
+            for instance in instances:
+                moved += self.move(model, instance, field, variants_field)
+            self.stdout.write(f'{model._meta.verbose_name_plural}: '
+                              f'перенесено {moved}.')
+        if not options['keep_old']:
+            for name in self.renamed:
+                default_storage.delete(name)
+        self.stdout.write(self.style.SUCCESS(
+            f'Уникальных файлов: {len(set(self.renamed.values()))} из '
+            f'{len(self.renamed)}, не найдено: {self.missing}.'))
+
+    def rehash(self, name):
+        """Имя файла по хешу; повторные ссылки не перечитывают файл."""
+        if not name or is_content_name(name):
+            return name
+        if name in self.renamed:
+            default_storage.add_reference(self.renamed[name])
+            return self.renamed[name]
+        try:
+            with default_storage.open(name) as file:
+                self.renamed[name] = default_storage.save(name, file)
+        except FileNotFoundError:
+            self.missing += 1
+            self.stderr.write(f'Файл не найден: {name}')
+            return name
+        return self.renamed[name]
+
+    def move(self, model, instance, field, variants_field):
+        name = getattr(instance, field).name
+        variants = getattr(instance, variants_field) or {}
+        new_name = self.rehash(name)
+        new_variants = variants
+        if variants.get('sizes'):
+            new_variants = {
+                'source': new_name if variants.get('source') == name
+                else variants.get('source'),
+                'sizes': {
+                    width: {image_format: self.rehash(path)
+                            for image_format, path in formats.items()}
+                    for width, formats in variants['sizes'].items()}}
+        if new_name == name and new_variants == variants:
+            return 0
+        model.objects.filter(pk=instance.pk, **{field: name}).update(
+            **{field: new_name, variants_field: new_variants})
+        if model is Recipes:
+            invalidate_recipes([instance.pk])
+        else:
+            invalidate_recipes(instance.recipes.values_list('pk', flat=True))
+        return 1
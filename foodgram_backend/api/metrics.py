@@ -0,0 +1,263 @@
+"""Метрики API в текстовом формате Prometheus.
+
+MetricsMiddleware считает по маршрутам - именам URL из роутера, а не
+путям, чтобы число серий было ограничено, - и методам: гистограмму
+длительности запросов, ответы по кодам и число SQL-запросов, а также
+запросы в обработке. Нестандартные методы считаются как OTHER, чтобы
+клиент не мог плодить серии. /metrics отдает их вместе с попаданиями и
+промахами кешей API.
+
+У каждого воркера gunicorn свои счетчики. Если задан
+METRICS_MULTIPROC_DIR, процесс не чаще раза в METRICS_FLUSH_INTERVAL
+секунд пишет снимок в <каталог>/<pid>.json, а /metrics суммирует снимки
+всех процессов. Каталог очищает при запуске gunicorn.conf.py; он же
+прибавляет счетчики завершившегося воркера к накопленному снимку
+exited.json и удаляет снимок воркера, так что число файлов не растет с
+перезапусками. При запуске без gunicorn каталог нужно очищать вручную.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections
+
+from .cache import get_cache_stats
+
+# Кеши, чьи попадания и промахи считает count_cache_result.
+CACHE_NAMES = ('recipes', 'recipe_fragments', 'shopping_list_export')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Накопленный снимок завершившихся воркеров, см. gunicorn.conf.py.
+EXITED_NAME = 'exited.json'
+METHODS = frozenset(
+    ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+PREFIX = 'foodgram'
+
+
+class Registry:
+    """Метрики текущего процесса."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # (route, method) -> [число по корзинам..., +Inf, сумма секунд].
+        self.durations = {}
+        self.responses = Counter()
+        self.queries = Counter()
+        self.in_flight = 0
+        self.flushed = 0.0
+        self.pid = self.process = None
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def observe(self, route, method, status, duration, queries):
+        with self.lock:
+            self.in_flight -= 1
+            histogram = self.durations.setdefault(
+                (route, method), [0] * (len(self.buckets) + 1) + [0.0])
+            histogram[bisect_left(self.buckets, duration)] += 1
+            histogram[-1] += duration
+            self.responses[route, method, status] += 1
+            self.queries[route, method] += queries
+
+    def get_process(self):
+        """Идентификатор процесса, не повторяющийся при повторе pid."""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.process = f'{self.pid}-{time.time_ns()}'
+        return self.process
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'process': self.get_process(),
+                'in_flight': self.in_flight,
+                'durations': [[*key, list(value)]
+                              for key, value in self.durations.items()],
+                'responses': [[*key, value]
+                              for key, value in self.responses.items()],
+                'queries': [[*key, value]
+                            for key, value in self.queries.items()],
+                'cache': ({name: get_cache_stats(name)
+                           for name in CACHE_NAMES}
+                          if is_local_cache() else {}),
+            }
+
+    def flush(self, directory, force=False):
+        """Пишет снимок в файл процесса, если пора или force."""
+        now = time.monotonic()
+        if not force and now - self.flushed < settings.METRICS_FLUSH_INTERVAL:
+            return
+        self.flushed = now
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        path = Path(directory) / f'{os.getpid()}.json'
+        temporary = path.with_suffix('.tmp')
+        temporary.write_text(json.dumps(self.snapshot()))
+        os.replace(temporary, path)
+
+
+registry = Registry(settings.METRICS_LATENCY_BUCKETS)
+
+
+def is_local_cache():
+    """Счетчики кешей свои у каждого процесса."""
+    return isinstance(caches['default'], LocMemCache)
+
+
+def read_snapshots():
+    """Снимки всех процессов или только текущего."""
+    directory = settings.METRICS_MULTIPROC_DIR
+    if not directory:
+        return [registry.snapshot()]
+    registry.flush(directory, force=True)
+    # Накопленный снимок читается последним: gunicorn.conf.py сначала
+    # дописывает в него воркер, а потом удаляет снимок воркера. Так
+    # воркер учитывается ровно один раз: по своему снимку или, если он
+    # уже в merged накопленного, по накопленному.
+    paths = sorted(Path(directory).glob('*.json'),
+                   key=lambda path: path.name == EXITED_NAME)
+    snapshots, merged = [], set()
+    for path in paths:
+        try:
+            snapshot = json.loads(path.read_text())
+        except (OSError, ValueError):
+            # Файл удалили или еще не дописали.
+            continue
+        if path.name == EXITED_NAME:
+            merged.update(snapshot['merged'])
+        snapshots.append(snapshot)
+    return [snapshot for snapshot in snapshots
+            if snapshot.get('process') not in merged]
+
+
+def merge(snapshots):
+    durations, responses, queries = {}, Counter(), Counter()
+    cache_stats = {name: Counter() for name in CACHE_NAMES}
+    in_flight = 0
+    for snapshot in snapshots:
+        for route, method, values in snapshot['durations']:
+            total = durations.setdefault((route, method), [0] * len(values))
+            for index, value in enumerate(values):
+                total[index] += value
+        for route, method, status, value in snapshot['responses']:
+            responses[route, method, status] += value
+        for route, method, value in snapshot['queries']:
+            queries[route, method] += value
+        for name, stats in snapshot['cache'].items():
+            cache_stats.setdefault(name, Counter()).update(stats)
+        in_flight += snapshot['in_flight']
+    if not is_local_cache() or not settings.METRICS_MULTIPROC_DIR:
+        # Общий кеш или один процесс - счетчики читаются напрямую.
+        cache_stats = {name: get_cache_stats(name) for name in CACHE_NAMES}
+    return durations, responses, queries, cache_stats, in_flight
+
+
+def format_labels(**labels):
+    def escape(value):
+        return (str(value).replace('\\', r'\\').replace('"', r'\"')
+                .replace('\n', r'\n'))
+
+    return '{' + ','.join(f'{name}="{escape(value)}"'
+                          for name, value in labels.items()) + '}'
+
+
+def render_metrics():
+    """Метрики всех процессов в текстовом формате Prometheus."""
+    durations, responses, queries, cache_stats, in_flight = merge(
+        read_snapshots())
+    lines = []
+
+    def header(name, kind, help_text):
+        lines.append(f'# HELP {PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+
+    header('http_request_duration_seconds', 'histogram',
+           'Длительность запросов по маршрутам.')
+    for (route, method), values in sorted(durations.items()):
+        cumulative = 0
+        for bound, count in zip((*registry.buckets, '+Inf'), values[:-1]):
+            cumulative += count
+            lines.append(
+                f'{PREFIX}_http_request_duration_seconds_bucket'
+                f'{format_labels(route=route, method=method, le=bound)} '
+                f'{cumulative}')
+        labels = format_labels(route=route, method=method)
+        lines.append(f'{PREFIX}_http_request_duration_seconds_sum{labels} '
+                     f'{values[-1]}')
+        lines.append(f'{PREFIX}_http_request_duration_seconds_count{labels} '
+                     f'{cumulative}')
+
+    header('http_responses_total', 'counter', 'Ответы по кодам статуса.')
+    for (route, method, status), value in sorted(responses.items()):
+        labels = format_labels(route=route, method=method, status=status)
+        lines.append(f'{PREFIX}_http_responses_total{labels} {value}')
+
+    header('db_queries_total', 'counter', 'SQL-запросы по маршрутам.')
+    for (route, method), value in sorted(queries.items()):
+        lines.append(f'{PREFIX}_db_queries_total'
+                     f'{format_labels(route=route, method=method)} {value}')
+
+    header('http_requests_in_flight', 'gauge', 'Запросы в обработке.')
+    lines.append(f'{PREFIX}_http_requests_in_flight {in_flight}')
+
+    for result in ('hits', 'misses'):
+        header(f'cache_{result}_total', 'counter',
+               f'{"Попадания" if result == "hits" else "Промахи"} кешей API.')
+        for name, stats in sorted(cache_stats.items()):
+            lines.append(f'{PREFIX}_cache_{result}_total'
+                         f'{format_labels(cache=name)} {stats.get(result, 0)}')
+    header('cache_hit_ratio', 'gauge', 'Доля попаданий кешей API.')
+    for name, stats in sorted(cache_stats.items()):
+        total = stats.get('hits', 0) + stats.get('misses', 0)
+        ratio = stats.get('hits', 0) / total if total else 0
+        lines.append(f'{PREFIX}_cache_hit_ratio{format_labels(cache=name)} '
+                     f'{ratio:.4f}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_route(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.url_name or match.view_name or 'unnamed'
+
+
+class MetricsMiddleware:
+    """Длительность, код ответа и число SQL-запросов по маршрутам."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        registry.start()
+        started = time.perf_counter()
+        status = 500
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(count))
+                response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            method = request.method if request.method in METHODS else 'OTHER'
+            registry.observe(get_route(request), method, status,
+                             time.perf_counter() - started, queries[0])
+            if settings.METRICS_MULTIPROC_DIR:
+                registry.flush(settings.METRICS_MULTIPROC_DIR)
@@ -1,9 +1,294 @@
+import base64
+import hashlib
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 from constants import DEFAULT_PAGE_SIZE_PAGINATOR
 
+from .versions import get_version
+
+
+class CountStrategy:
+    """Подсчет записей для пагинатора.
+
+    Точный COUNT(*) кешируется на COUNT_CACHE_TIMEOUT секунд по версии
+    данных модели и SQL запроса, в который уже подставлены все фильтры.
+    Для таблиц PostgreSQL больше COUNT_ESTIMATE_THRESHOLD строк вместо
+    COUNT(*) берется оценка планировщика, а exact становится False.
+    """
+
+    def __init__(self, object_list):
+        self.object_list = object_list
+        self.exact = True
+
+    def get_sql(self):
+        queryset = self.object_list
+        return queryset.query.get_compiler(queryset.db).as_sql()
+
+    def get_cache_key(self):
+        try:
+            sql, params = self.get_sql()
+        except EmptyResultSet:
+            return None
+        model = self.object_list.model._meta.label_lower
+        digest = hashlib.md5(f'{sql}{params}'.encode()).hexdigest()
+        return f'count:{model}:{get_version("count", model)}:{digest}'
+
+    def estimate(self):
+        """Оценка планировщика PostgreSQL или None для малых таблиц."""
+        connection = connections[self.object_list.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                [self.object_list.model._meta.db_table])
+            row = cursor.fetchone()
+            if row is None or row[0] < settings.COUNT_ESTIMATE_THRESHOLD:
+                return None
+            sql, params = self.get_sql()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def count(self):
+        if not isinstance(self.object_list, QuerySet):
+            return len(self.object_list)
+        key = self.get_cache_key()
+        if key is None:
+            return 0
+        cached = cache.get(key)
+        if cached is not None:
+            count, self.exact = cached
+            return count
+        count = self.estimate()
+        if count is None:
+            count = self.object_list.count()
+        else:
+            self.exact = False
+        cache.set(key, (count, self.exact), settings.COUNT_CACHE_TIMEOUT)
+        return count
+
+
+class InexactPage(Page):
+    """Страница, о следующей странице которой известно по лишней строке."""
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class CountStrategyPaginator(Paginator):
+    """Paginator, считающий записи через CountStrategy.
+
+    Оценку числа записей нельзя использовать как границу: страницы за
+    ней оказались бы недоступны, а перед ней - пустыми. Поэтому при
+    неточном count номер страницы не сверяется с num_pages, а выбирается
+    на строку больше страницы: по ней и определяется, есть ли следующая.
+    """
+
+    @cached_property
+    def count(self):
+        self.count_strategy = CountStrategy(self.object_list)
+        return self.count_strategy.count()
+
+    @property
+    def exact(self):
+        # Точность известна после подсчета.
+        self.count
+        return self.count_strategy.exact
+
+    def validate_number(self, number):
+        if self.exact:
+            return super().validate_number(number)
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages['invalid_page'])
+        if number < 1:
+            raise EmptyPage(self.error_messages['min_page'])
+        return number
+
+    def page(self, number):
+        if self.exact:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage(self.error_messages['no_results'])
+        return InexactPage(rows[:self.per_page], number, self,
+                           has_next=len(rows) > self.per_page)
+
 
 class PageLimitPagination(pagination.PageNumberPagination):
     page_query_param = 'page'
     page_size_query_param = 'limit'
     page_size = DEFAULT_PAGE_SIZE_PAGINATOR
+    django_paginator_class = CountStrategyPaginator
+
+    def get_paginated_response(self, data):
+        paginator = self.page.paginator
+        return Response({
+            'count': paginator.count,
+            'count_exact': paginator.count_strategy.exact,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count_exact'] = {
+            'type': 'boolean',
+            'example': True,
+        }
+        return response_schema
+
+
+class KeysetPagination(pagination.BasePagination):
+    """Keyset-пагинация по (pub_date, id) без OFFSET и COUNT.
+
+    Курсор - непрозрачная base64-строка с позицией последней/первой
+    записи страницы и направлением обхода.
+    """
+
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    mode_query_value = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = DEFAULT_PAGE_SIZE_PAGINATOR
+    invalid_cursor_message = 'Неверный курсор.'
+
+    @classmethod
+    def is_requested(cls, request):
+        """Клиент запросил курсорный режим явно или передал курсор."""
+        params = request.query_params
+        return (params.get(cls.mode_query_param) == cls.mode_query_value
+                or cls.cursor_query_param in params)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return page_size if page_size > 0 else self.page_size
+
+    def encode_cursor(self, obj, reverse):
+        position = {'d': obj.pub_date.isoformat(), 'i': obj.pk,
+                    'r': int(reverse)}
+        encoded = base64.urlsafe_b64encode(
+            json.dumps(position, separators=(',', ':')).encode())
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   encoded.decode())
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            return (datetime.fromisoformat(position['d']),
+                    int(position['i']), bool(position['r']))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def apply_cursor(queryset, cursor, reverse, id_field='id'):
+        """Сортирует queryset по (pub_date, id_field) и отсекает курсором.
+
+        Условие с OR не годится базе как граница диапазона индекса,
+        поэтому впереди добавлено избыточное pub_date <= (>=) курсора:
+        по нему чтение индекса начинается сразу с позиции курсора, и
+        глубокие страницы стоят столько же, сколько первая.
+        """
+        if reverse:
+            queryset = queryset.order_by('pub_date', id_field)
+        else:
+            queryset = queryset.order_by('-pub_date', '-' + id_field)
+        if cursor:
+            pub_date, pk, _ = cursor
+            lookup = 'gt' if reverse else 'lt'
+            queryset = queryset.filter(
+                Q(**{f'pub_date__{lookup}e': pub_date}),
+                Q(**{f'pub_date__{lookup}': pub_date})
+                | Q(pub_date=pub_date, **{f'{id_field}__{lookup}': pk}))
+        return queryset
+
+    def fetch(self, queryset, cursor, reverse, limit):
+        """Первые limit записей после курсора в порядке обхода.
+
+        Вместо queryset можно передать объект с методом fetch_page,
+        который соберет страницу из нескольких источников.
+        """
+        if hasattr(queryset, 'fetch_page'):
+            return queryset.fetch_page(self, cursor, reverse, limit)
+        return list(self.apply_cursor(queryset, cursor, reverse)[:limit])
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor[2])
+
+        results = self.fetch(queryset, cursor, reverse, self.page_size + 1)
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True,
+                         'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True,
+                             'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,90 @@
+"""Queryset'ы для чтения с фиксированным числом запросов."""
+from django.contrib.auth import get_user_model
+from django.db.models import (BooleanField, Count, Exists, IntegerField,
+                              OuterRef, Prefetch, Subquery, Value)
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorites, RecipeIngredients, Recipes, ShoppingCart
+from users.models import Follow
+
+User = get_user_model()
+
+
+def annotate_user_flag(queryset, name, subquery, user):
+    """Аннотирует queryset флагом текущего пользователя через Exists."""
+    if user.is_authenticated:
+        return queryset.annotate(**{name: Exists(subquery)})
+    return queryset.annotate(
+        **{name: Value(False, output_field=BooleanField())})
+
+
+def get_authors_queryset(user):
+    """Авторы с аннотацией подписки текущего пользователя."""
+    return annotate_user_flag(
+        User.objects.all(), 'is_subscribed',
+        Follow.objects.filter(user=user.pk, following=OuterRef('pk')), user)
+
+
+def get_followed_author_ids(request):
+    """id авторов, на которых подписан пользователь запроса.
+
+    Запоминается в запросе, чтобы все вложенные UserGetSerializer ответа
+    обошлись одним запросом.
+    """
+    if not hasattr(request, '_followed_author_ids'):
+        request._followed_author_ids = set(Follow.objects.filter(
+            user=request.user.pk).values_list('following', flat=True))
+    return request._followed_author_ids
+
+
+def annotate_recipe_flags(queryset, user):
+    """Рецепты с флагами is_favorited и is_in_shopping_cart."""
+    queryset = annotate_user_flag(
+        queryset, 'is_favorited',
+        Favorites.objects.filter(user=user.pk, recipe=OuterRef('pk')), user)
+    return annotate_user_flag(
+        queryset, 'is_in_shopping_cart',
+        ShoppingCart.objects.filter(user=user.pk, recipe=OuterRef('pk')),
+        user)
+
+
+def get_recipe_prefetches(user):
+    """Связи, нужные RecipeReadSerializer."""
+    return (
+        'tags',
+        Prefetch('author', queryset=get_authors_queryset(user)),
+        Prefetch('recipe_ingredients',
+                 queryset=RecipeIngredients.objects.select_related(
+                     'ingredient_id')),
+    )
+
+
+def parse_recipes_limit(value):
+    """recipes_limit из запроса или None, если он не задан или неверен."""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return None
+    return limit if limit >= 0 else None
+
+
+def get_subscriptions_queryset(user, recipes_limit=None):
+    """Авторы, на которых подписан user, в порядке подписки.
+
+    Число рецептов аннотируется подзапросом, а первые recipes_limit
+    рецептов всех авторов страницы подгружаются одним запросом с
+    ROW_NUMBER() OVER (PARTITION BY author) - так Django выполняет
+    Prefetch со срезом.
+    """
+    recipes = Recipes.objects.only('id', 'name', 'image', 'image_variants',
+                                   'cooking_time', 'author')
+    if recipes_limit is not None:
+        recipes = recipes[:recipes_limit]
+    recipes_count = Recipes.objects.filter(author=OuterRef('pk')).order_by(
+    ).values('author').annotate(count=Count('pk')).values('count')
+    return User.objects.filter(following__user=user).annotate(
+        is_subscribed=Value(True, output_field=BooleanField()),
+        recipes_count=Coalesce(Subquery(recipes_count), 0,
+                               output_field=IntegerField()),
+    ).order_by('following__id').prefetch_related(
+        Prefetch('recipes', queryset=recipes, to_attr='subscription_recipes'))
@@ -0,0 +1,177 @@
+"""Пакетный импорт рецептов из NDJSON.
+
+Каждая строка - рецепт в формате POST /api/recipes/ и необязательный
+original_url; изображение передается base64 или путем к файлу в
+каталоге импорта. Рецепты проверяются пачками: теги и ингредиенты всей
+пачки загружаются одним запросом на модель, а рецепты, связи с тегами и
+ингредиенты пишутся bulk_create в транзакции на пачку. Если пачку
+отвергла база (например, тот же original_url импортировали параллельно),
+ее строки пишутся по одной. Ошибки возвращаются по каждой строке и не
+мешают импорту остальных.
+"""
+import json
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from rest_framework import serializers
+from rest_framework.parsers import BaseParser
+
+from constants import RECIPE_IMPORT_BATCH_SIZE
+from recipes.models import Ingredients, RecipeIngredients, Recipes, Tags
+from recipes.signals import recipes_imported
+
+from .fields import LocalImageField, preload_related_objects
+from .serializers import RecipePostSerializer
+from .shortlinks import encode_short_code
+
+
+class NDJSONParser(BaseParser):
+    """Тело запроса application/x-ndjson - строки читаются лениво."""
+
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return iter(())
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        return (line.decode(encoding) for line in stream)
+
+
+class RecipeImportSerializer(RecipePostSerializer):
+    """Рецепт из файла импорта."""
+
+    image = LocalImageField()
+    original_url = serializers.URLField(required=False, allow_null=True)
+
+    class Meta(RecipePostSerializer.Meta):
+        fields = RecipePostSerializer.Meta.fields + ['original_url']
+
+    def preload_related(self, data):
+        # Теги и ингредиенты загружены RecipeImporter на всю пачку.
+        pass
+
+
+class RecipeImporter:
+    """Импорт рецептов автора author пачками по batch_size."""
+
+    def __init__(self, author, image_root=None,
+                 batch_size=RECIPE_IMPORT_BATCH_SIZE, context=None):
+        self.author = author
+        self.batch_size = batch_size
+        self.context = {
+            **(context or {}),
+            'image_root': image_root or settings.RECIPE_IMPORT_IMAGE_ROOT,
+        }
+        self.seen_urls = set()
+
+    def run(self, items):
+        """Импортирует items - словари или строки NDJSON.
+
+        Возвращает (результаты по строкам, секунды). Результат строки -
+        {'line': n, 'id': pk} или {'line': n, 'errors': {...}}.
+        """
+        started = time.perf_counter()
+        items = ((line, item) for line, item in enumerate(items, start=1)
+                 if not isinstance(item, str) or item.strip())
+        results = []
+        while batch := list(islice(items, self.batch_size)):
+            results.extend(self.import_batch(batch))
+        return results, time.perf_counter() - started
+
+    @staticmethod
+    def decode(item):
+        if isinstance(item, str):
+            try:
+                item = json.loads(item)
+            except ValueError as error:
+                return None, {'detail': [f'Некорректный JSON: {error}']}
+        if not isinstance(item, dict):
+            return None, {'detail': ['Ожидается объект рецепта.']}
+        return item, None
+
+    def preload(self, items, context):
+        tag_ids, ingredient_ids = [], []
+        for item in items:
+            if isinstance(item.get('tags'), list):
+                tag_ids.extend(item['tags'])
+            if isinstance(item.get('ingredients'), list):
+                ingredient_ids.extend(
+                    ingredient.get('id') for ingredient in item['ingredients']
+                    if isinstance(ingredient, dict))
+        preload_related_objects(context, Tags.objects.all(), tag_ids, 'tags')
+        preload_related_objects(context, Ingredients.objects.all(),
+                                ingredient_ids, 'ingredients')
+
+    def validate(self, batch):
+        """Проверенные данные и ошибки по строкам пачки."""
+        decoded = [(line, *self.decode(item)) for line, item in batch]
+        context = dict(self.context)
+        self.preload([item for _, item, _ in decoded if item], context)
+        urls = {item['original_url'] for _, item, _ in decoded
+                if item and isinstance(item.get('original_url'), str)}
+        imported_urls = set(Recipes.objects.filter(
+            original_url__in=urls).values_list('original_url', flat=True))
+        valid, errors = [], []
+        for line, item, error in decoded:
+            if error is None:
+                serializer = RecipeImportSerializer(data=item,
+                                                    context=context)
+                if serializer.is_valid():
+                    url = serializer.validated_data.get('original_url')
+                    if url and (url in imported_urls
+                                or url in self.seen_urls):
+                        error = {'original_url': [
+                            'Рецепт с этим адресом уже импортирован.']}
+                    else:
+                        if url:
+                            self.seen_urls.add(url)
+                        valid.append((line, serializer.validated_data))
+                        continue
+                else:
+                    error = serializer.errors
+            errors.append({'line': line, 'errors': error})
+        return valid, errors
+
+    def save(self, valid):
+        """Пишет проверенные рецепты valid в одной транзакции."""
+        with transaction.atomic():
+            recipes = Recipes.objects.bulk_create([
+                Recipes(author=self.author, **{
+                    field: value for field, value in data.items()
+                    if field not in ('tags', 'ingredients')})
+                for _, data in valid])
+            for recipe in recipes:
+                recipe.short_url = encode_short_code(recipe.pk)
+            Recipes.objects.bulk_update(recipes, ['short_url'])
+            Recipes.tags.through.objects.bulk_create([
+                Recipes.tags.through(recipes_id=recipe.pk, tags_id=tag.pk)
+                for recipe, (_, data) in zip(recipes, valid)
+                for tag in data['tags']])
+            RecipeIngredients.objects.bulk_create([
+                RecipeIngredients(recipe_id=recipe,
+                                  ingredient_id=ingredient['id'],
+                                  amount=ingredient['amount'])
+                for recipe, (_, data) in zip(recipes, valid)
+                for ingredient in data['ingredients']])
+            recipes_imported.send(sender=Recipes, recipes=recipes)
+        return [{'line': line, 'id': recipe.pk}
+                for recipe, (line, _) in zip(recipes, valid)]
+
+    def import_batch(self, batch):
+        valid, errors = self.validate(batch)
+        if not valid:
+            return errors
+        try:
+            created = self.save(valid)
+        except IntegrityError:
+            created = []
+            for row in valid:
+                try:
+                    created.extend(self.save([row]))
+                except IntegrityError:
+                    errors.append({'line': row[0], 'errors': {'detail': [
+                        'Рецепт конфликтует с уже сохраненными данными.']}})
+        return sorted(created + errors, key=lambda result: result['line'])
@@ -0,0 +1,38 @@
+"""Рендереры для выбора формата выгрузки списка покупок.
+
+Содержимое ответа формирует view, рендереры нужны для согласования
+формата через ?format= или заголовок Accept.
+"""
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+class PassthroughRenderer(BaseRenderer):
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or isinstance(data, (bytes, str)):
+            return data
+        return json.dumps(data, ensure_ascii=False).encode()
+
+
+class ShoppingListHTMLRenderer(PassthroughRenderer):
+    media_type = 'text/html'
+    format = 'html'
+
+
+class PlainTextRenderer(PassthroughRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(PassthroughRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class PDFRenderer(PassthroughRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
@@ -1,15 +1,28 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.http import QueryDict
 from djoser.serializers import UserCreateSerializer
 from djoser.serializers import UserSerializer as BaseUserSerializer
 from rest_framework import serializers
-from rest_framework.serializers import UniqueTogetherValidator, ValidationError
+from rest_framework.serializers import ValidationError
 
-from constants import MIN_VALUE_INGREDIENT
-from recipes.models import (Favorites, Ingredients, RecipeIngredients, Recipes,
-                            ShoppingCart, Tags)
+from constants import MIN_VALUE_INGREDIENT, RECIPE_BATCH_MAX_IDS
+from recipes.models import Ingredients, RecipeIngredients, Recipes, Tags
+from recipes.signals import (recipe_ingredients_changed,
+                             suspend_ingredient_signals)
 from users.models import Follow
 
-from .fields import Base64ImageField
+from .cache import get_many_single_flight
+from .fields import (Base64ImageField, BatchedPrimaryKeyRelatedField,
+                     preload_related_objects)
+from .images import get_size_map, release_on_commit, replace_image
+from .querysets import (get_followed_author_ids, get_recipe_prefetches,
+                        parse_recipes_limit)
+from .uploads import form_to_dict
+from .versions import get_versions
 
 User = get_user_model()
 
@@ -27,18 +40,25 @@ class UserGetSerializer(BaseUserSerializer):
     """Сериализатор для получения пользователя/пользователей."""
 
     is_subscribed = serializers.SerializerMethodField()
+    avatar_sizes = serializers.SerializerMethodField()
 
     class Meta(BaseUserSerializer.Meta):
         model = User
         fields = ['email', 'id', 'username', 'first_name', 'last_name',
-                  'is_subscribed', 'avatar']
+                  'is_subscribed', 'avatar', 'avatar_sizes']
 
     def get_is_subscribed(self, obj):
         """Проверяет, подписан ли текущий пользователь на этого автора."""
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return obj.following.filter(user=request.user).exists()
-        return False
+        if (not request or not request.user.is_authenticated
+                or request.user.pk == obj.pk):
+            return False
+        return obj.pk in get_followed_author_ids(request)
+
+    def get_avatar_sizes(self, obj):
+        return get_size_map(obj.avatar_variants, self.context.get('request'))
 
 
 class TagsReadSerializer(serializers.ModelSerializer):
@@ -49,7 +69,7 @@ class TagsReadSerializer(serializers.ModelSerializer):
 
 
 class RecipeIngredientsWriteSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredients.objects.all())
+    id = BatchedPrimaryKeyRelatedField(queryset=Ingredients.objects.all())
     amount = serializers.IntegerField(required=True,
                                       min_value=MIN_VALUE_INGREDIENT)
 
@@ -57,11 +77,6 @@ class RecipeIngredientsWriteSerializer(serializers.ModelSerializer):
         model = RecipeIngredients
         fields = ['id', 'amount']
 
-    def validate_id(self, value):
-        if not Ingredients.objects.filter(id=value.id).exists():
-            raise serializers.ValidationError('Нет такого ингредиента!')
-        return value
-
 
 class RecipeIngredientsReadSerializer(serializers.ModelSerializer):
     id = serializers.PrimaryKeyRelatedField(read_only=True)
@@ -81,6 +96,78 @@ class IngredientsSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class RecipeListSerializer(serializers.ListSerializer):
+    """Список рецептов из кеша публичных фрагментов.
+
+    Публичная часть рецепта кешируется по его версии, а флаги текущего
+    пользователя накладываются при ответе: is_favorited и
+    is_in_shopping_cart из аннотаций queryset, is_subscribed автора -
+    одним запросом подписок на всю страницу.
+    """
+
+    def get_user(self):
+        request = self.context.get('request')
+        return request.user if request else AnonymousUser()
+
+    def get_fragment_key(self, recipe, version):
+        # Ссылки на изображения абсолютные: в ключе схема и хост.
+        request = self.context.get('request')
+        origin = (f'{request.scheme}://{request.get_host()}'
+                  if request else '')
+        return f'fragment:recipe:{recipe.pk}:{version}:{origin}'
+
+    def build_fragments(self, recipes):
+        prefetch_related_objects(recipes,
+                                 *get_recipe_prefetches(self.get_user()))
+        fragments = {}
+        for recipe in recipes:
+            fragment = self.child.to_representation(recipe)
+            fragment.update(is_favorited=False, is_in_shopping_cart=False)
+            fragment['author'] = {**fragment['author'],
+                                  'is_subscribed': False}
+            fragments[recipe.pk] = fragment
+        return fragments
+
+    def get_subscribed_author_ids(self, recipes):
+        user = self.get_user()
+        if not user.is_authenticated:
+            return set()
+        return set(Follow.objects.filter(
+            user=user,
+            following__in={recipe.author_id for recipe in recipes}
+        ).values_list('following', flat=True))
+
+    def get_fragments(self, recipes):
+        """Фрагменты из кеша по версиям рецептов."""
+        versions = get_versions([('recipe', recipe.pk)
+                                 for recipe in recipes])
+        keys = {recipe.pk: self.get_fragment_key(recipe, version)
+                for recipe, version in zip(recipes, versions)}
+        recipes_by_id = {recipe.pk: recipe for recipe in recipes}
+        return get_many_single_flight(
+            keys,
+            lambda ids: self.build_fragments(
+                [recipes_by_id[pk] for pk in ids]),
+            settings.FRAGMENT_CACHE_TIMEOUT,
+            name='recipe_fragments')
+
+    def to_representation(self, data):
+        recipes = list(data)
+        fragments = self.get_fragments(recipes)
+        subscribed = self.get_subscribed_author_ids(recipes)
+
+        representation = []
+        for recipe in recipes:
+            item = dict(fragments[recipe.pk])
+            item['is_favorited'] = bool(self.child.get_is_favorited(recipe))
+            item['is_in_shopping_cart'] = bool(
+                self.child.get_is_in_shopping_cart(recipe))
+            item['author'] = {**item['author'],
+                              'is_subscribed': recipe.author_id in subscribed}
+            representation.append(item)
+        return representation
+
+
 class RecipeReadSerializer(serializers.ModelSerializer):
     """Сериализатор для чтения рецептов."""
 
@@ -90,29 +177,39 @@ class RecipeReadSerializer(serializers.ModelSerializer):
     author = UserGetSerializer(read_only=True)
     is_in_shopping_cart = serializers.SerializerMethodField()
     is_favorited = serializers.SerializerMethodField()
+    image_sizes = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipes
         fields = ['id', 'tags', 'author', 'ingredients', 'is_favorited',
-                  'is_in_shopping_cart', 'name', 'image', 'text',
-                  'cooking_time']
+                  'is_in_shopping_cart', 'name', 'image', 'image_sizes',
+                  'text', 'cooking_time']
+        list_serializer_class = RecipeListSerializer
 
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         return (request and request.user.is_authenticated
                 and obj.favorites.filter(user=request.user).exists())
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         return (request and request.user.is_authenticated
                 and obj.shopping_cart.filter(user=request.user).exists())
 
+    def get_image_sizes(self, obj):
+        return get_size_map(obj.image_variants, self.context.get('request'))
+
 
 class RecipeReadSerializerForSubscriptions(RecipeReadSerializer):
 
     class Meta(RecipeReadSerializer.Meta):
-        fields = ['id', 'name', 'image', 'cooking_time']
+        fields = ['id', 'name', 'image', 'image_sizes', 'cooking_time']
         read_only_fields = ['id', 'name', 'image', 'cooking_time']
+        list_serializer_class = serializers.ListSerializer
 
 
 class RecipePostSerializer(serializers.ModelSerializer):
@@ -120,8 +217,8 @@ class RecipePostSerializer(serializers.ModelSerializer):
 
     ingredients = RecipeIngredientsWriteSerializer(many=True,
                                                    required=True)
-    tags = serializers.PrimaryKeyRelatedField(queryset=Tags.objects.all(),
-                                              many=True, required=True)
+    tags = BatchedPrimaryKeyRelatedField(queryset=Tags.objects.all(),
+                                         many=True, required=True)
     image = Base64ImageField()
 
     class Meta:
@@ -130,6 +227,27 @@ class RecipePostSerializer(serializers.ModelSerializer):
                   'text', 'cooking_time']
         read_only_fields = ('author', )
 
+    def to_internal_value(self, data):
+        if isinstance(data, QueryDict):
+            data = form_to_dict(data, json_fields=('tags', 'ingredients'))
+        self.preload_related(data)
+        return super().to_internal_value(data)
+
+    def preload_related(self, data):
+        """Теги и ингредиенты всего рецепта - одним запросом на модель."""
+        if not isinstance(data, dict):
+            return
+        tags = data.get('tags')
+        ingredients = data.get('ingredients')
+        preload_related_objects(
+            self.context, Tags.objects.all(),
+            tags if isinstance(tags, list) else [], 'tags')
+        preload_related_objects(
+            self.context, Ingredients.objects.all(),
+            [item.get('id') for item in ingredients
+             if isinstance(item, dict)]
+            if isinstance(ingredients, list) else [], 'ingredients')
+
     def validate(self, data):
         if 'tags' not in data:
             raise ValidationError({'detail': 'Поле тегов обязательно!'})
@@ -152,6 +270,11 @@ class RecipePostSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         """Преобразуем IDs в объекты при выводе."""
+        request = self.context.get('request')
+        prefetch_related_objects(
+            [instance],
+            *get_recipe_prefetches(request.user if request
+                                   else AnonymousUser()))
         return RecipeReadSerializer(instance, context=self.context).data
 
     def create_update_ingredients(self, recipe, ingredients_data):
@@ -170,41 +293,86 @@ class RecipePostSerializer(serializers.ModelSerializer):
             self.create_update_ingredients(recipe, ingredients_data))
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        # instance = super().update(instance, validated_data)
-        tags_data = validated_data.pop('tags')
-        ingredients_data = validated_data.pop('ingredients')
-
-        for attr, value in validated_data.items():
-            setattr(instance, attr, value)
-        instance.save()
-
-        if 'image' in validated_data:
-            instance.image = validated_data['image']
-        instance.save()
-
-        if 'tags' in validated_data:
-            instance.tags.set(tags_data)
-
-        if 'ingredients' in validated_data:
-            ingredients_data = validated_data.pop('ingredients')
-            instance.recipe_ingredients.all().delete()
-            RecipeIngredients.objects.bulk_create(
-                self.create_update_ingredients(instance, ingredients_data))
+        """Меняет только то, что отличается от сохраненного рецепта."""
+        tags_data = validated_data.pop('tags', None)
+        ingredients_data = validated_data.pop('ingredients', None)
+
+        update_fields = [attr for attr, value in validated_data.items()
+                         if getattr(instance, attr) != value]
+        old_image = None
+        if 'image' in update_fields:
+            # Копии старого изображения освобождаются вместе с ним, а
+            # новые построит пул после коммита.
+            old_image = (instance.image.name, instance.image_variants)
+            instance.image_variants = {}
+            update_fields.append('image_variants')
+        for attr in update_fields:
+            if attr in validated_data:
+                setattr(instance, attr, validated_data[attr])
+        if update_fields:
+            instance.save(update_fields=update_fields)
+        if old_image:
+            release_on_commit(*old_image)
+
+        if tags_data is not None:
+            self.update_tags(instance, tags_data)
+        if ingredients_data is not None:
+            self.update_ingredients(instance, ingredients_data)
         return instance
 
+    def update_tags(self, recipe, tags_data):
+        current = set(recipe.tags.values_list('pk', flat=True))
+        new = {tag.pk for tag in tags_data}
+        if current - new:
+            recipe.tags.remove(*(current - new))
+        if new - current:
+            recipe.tags.add(*(new - current))
+
+    def update_ingredients(self, recipe, ingredients_data):
+        """Удаляет, обновляет и добавляет только изменившиеся строки."""
+        # order_by() снимает сортировку Meta, требующую JOIN с рецептами.
+        rows = {row.ingredient_id_id: row
+                for row in recipe.recipe_ingredients.order_by()}
+        old = {ingredient_id: row.amount
+               for ingredient_id, row in rows.items()}
+        new = {item['id'].pk: item['amount'] for item in ingredients_data}
+        if old == new:
+            return
+
+        removed = [row.pk for ingredient_id, row in rows.items()
+                   if ingredient_id not in new]
+        changed = []
+        for ingredient_id, row in rows.items():
+            if ingredient_id in new and row.amount != new[ingredient_id]:
+                row.amount = new[ingredient_id]
+                changed.append(row)
+        added = [item for item in ingredients_data
+                 if item['id'].pk not in rows]
+        with suspend_ingredient_signals():
+            if removed:
+                RecipeIngredients.objects.filter(pk__in=removed).delete()
+            if changed:
+                RecipeIngredients.objects.bulk_update(changed, ['amount'])
+            if added:
+                RecipeIngredients.objects.bulk_create(
+                    self.create_update_ingredients(recipe, added))
+        recipe_ingredients_changed.send(sender=RecipeIngredients,
+                                        recipe_id=recipe.pk, old=old,
+                                        new=new)
+
 
 def get_recipes_for_user_with_limit(obj, context):
-    """Cписок рецептов автора."""
-    recipes_limit = context.get('recipes_limit')
-    all_recipes = obj.recipes.all()
-    try:
-        if recipes_limit is not None:
-            recipes_to_show = all_recipes[:int(recipes_limit)]
-        else:
-            recipes_to_show = all_recipes
-    except (ValueError):
-        recipes_to_show = all_recipes
+    """Cписок рецептов автора.
+
+    Если рецепты подгружены get_subscriptions_queryset, запросов нет.
+    """
+    if hasattr(obj, 'subscription_recipes'):
+        recipes_to_show = obj.subscription_recipes
+    else:
+        recipes_limit = parse_recipes_limit(context.get('recipes_limit'))
+        recipes_to_show = obj.recipes.all()[:recipes_limit]
 
     return RecipeReadSerializerForSubscriptions(recipes_to_show,
                                                 many=True).data
@@ -219,7 +387,7 @@ class SubscriptionSerializer(UserGetSerializer):
         model = User
         fields = [
             'id', 'email', 'username', 'first_name', 'last_name',
-            'is_subscribed', 'recipes', 'avatar']
+            'is_subscribed', 'recipes', 'avatar', 'avatar_sizes']
 
     def get_recipes(self, obj):
         return get_recipes_for_user_with_limit(obj, self.context)
@@ -235,64 +403,59 @@ class UserGetSerializerFollow(SubscriptionSerializer):
                                                        'recipes_count']
 
     def get_recipes_count(self, obj):
+        if hasattr(obj, 'recipes_count'):
+            return obj.recipes_count
         return obj.recipes.count()
 
     def get_recipes(self, obj):
         return get_recipes_for_user_with_limit(obj, self.context)
 
 
-class AvatarUpdateSerializer(serializers.ModelSerializer):
-    avatar = Base64ImageField(required=True)
+class RecipeBatchSerializer(serializers.Serializer):
+    """id рецептов для пакетного добавления и удаления."""
 
-    class Meta:
-        model = User
-        fields = ['avatar']
+    add = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False,
+        default=list, max_length=RECIPE_BATCH_MAX_IDS)
+    remove = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False,
+        default=list, max_length=RECIPE_BATCH_MAX_IDS)
 
-    def update(self, instance, validated_data):
-        if instance.avatar:
-            instance.avatar.delete(save=False)
-        instance.avatar = validated_data.get('avatar', None)
-        instance.save()
-        return instance
+    def validate(self, data):
+        data = {key: list(dict.fromkeys(ids)) for key, ids in data.items()}
+        if not data['add'] and not data['remove']:
+            raise ValidationError(
+                {'detail': 'Нужно передать рецепты в add или remove.'})
+        if set(data['add']) & set(data['remove']):
+            raise ValidationError(
+                {'detail': 'Рецепт не может быть и в add, и в remove.'})
+        return data
 
 
-class FavoriteSerializer(serializers.ModelSerializer):
+class RecipeImageSerializer(serializers.ModelSerializer):
+    """Замена изображения рецепта отдельным запросом."""
 
-    class Meta:
-        model = Favorites
-        fields = ['user', 'recipe']
-        validators = [
-            UniqueTogetherValidator(
-                queryset=Favorites.objects.all(),
-                fields=['user', 'recipe'],
-                message='Рецепт уже в избранном!!'
-            )
-        ]
+    image = Base64ImageField(required=True)
 
+    class Meta:
+        model = Recipes
+        fields = ['image']
 
-class ShoppingCartSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+        replace_image(instance, validated_data['image'])
+        return instance
 
-    class Meta:
-        model = ShoppingCart
-        fields = ['user', 'recipe']
-        validators = [
-            UniqueTogetherValidator(
-                queryset=ShoppingCart.objects.all(),
-                fields=['user', 'recipe'],
-                message='Рецепт уже в корзине!!'
-            )
-        ]
+    def to_representation(self, instance):
+        return RecipeReadSerializer(instance, context=self.context).data
 
 
-class FollowSerializer(serializers.ModelSerializer):
+class AvatarUpdateSerializer(serializers.ModelSerializer):
+    avatar = Base64ImageField(required=True)
 
     class Meta:
-        model = Follow
-        fields = ['user', 'following']
-        validators = [
-            UniqueTogetherValidator(
-                queryset=Follow.objects.all(),
-                fields=['user', 'following'],
-                message='Пользователь уже в подписках!'
-            )
-        ]
+        model = User
+        fields = ['avatar']
+
+    def update(self, instance, validated_data):
+        replace_image(instance, validated_data['avatar'])
+        return instance
@@ -0,0 +1,109 @@
+"""Короткие ссылки на рецепты.
+
+Код нового формата — id рецепта в base62 фиксированной длины
+SHORT_CODE_ID_LENGTH, при заданном SHORT_CODE_SECRET предварительно
+перемешанный ключевой перестановкой (сеть Фейстеля). Такой код уникален
+без проверки в базе и переводится обратно в id без запросов. Старые
+случайные коды короче и разрешаются через LRU в памяти и кеш Django.
+В LRU попадают только найденные коды, а промах хранится в кеше Django
+SHORT_LINK_MISS_CACHE_TIMEOUT секунд: код, назначенный рецепту позже,
+начнет работать не позже, чем через это время.
+"""
+import hashlib
+import string
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+
+from constants import SHORT_CODE_ID_BITS, SHORT_CODE_ID_LENGTH
+from recipes.models import Recipes
+
+ALPHABET = string.digits + string.ascii_letters
+BASE = len(ALPHABET)
+HALF_BITS = SHORT_CODE_ID_BITS // 2
+HALF_MASK = (1 << HALF_BITS) - 1
+FEISTEL_ROUNDS = 4
+
+
+def _round(value, number):
+    digest = hashlib.blake2b(
+        value.to_bytes(8, 'big'), digest_size=8,
+        key=settings.SHORT_CODE_SECRET.encode(),
+        person=number.to_bytes(1, 'big')).digest()
+    return int.from_bytes(digest, 'big') & HALF_MASK
+
+
+def permute(value, inverse=False):
+    """Ключевая перестановка чисел из SHORT_CODE_ID_BITS бит."""
+    if not settings.SHORT_CODE_SECRET:
+        return value
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    rounds = range(FEISTEL_ROUNDS)
+    if inverse:
+        left, right = right, left
+        rounds = reversed(rounds)
+    for number in rounds:
+        left, right = right, left ^ _round(right, number)
+    if inverse:
+        left, right = right, left
+    return (left << HALF_BITS) | right
+
+
+def encode_short_code(recipe_id):
+    """Код короткой ссылки для id рецепта."""
+    if not 0 < recipe_id < 1 << SHORT_CODE_ID_BITS:
+        raise ValueError(f'id {recipe_id} вне диапазона коротких кодов.')
+    value = permute(recipe_id)
+    digits = []
+    for _ in range(SHORT_CODE_ID_LENGTH):
+        value, digit = divmod(value, BASE)
+        digits.append(ALPHABET[digit])
+    return ''.join(reversed(digits))
+
+
+def decode_short_code(code):
+    """id рецепта по коду нового формата или None."""
+    if len(code) != SHORT_CODE_ID_LENGTH:
+        return None
+    value = 0
+    for char in code:
+        digit = ALPHABET.find(char)
+        if digit < 0:
+            return None
+        value = value * BASE + digit
+    if value >> SHORT_CODE_ID_BITS:
+        return None
+    return permute(value, inverse=True) or None
+
+
+@lru_cache(maxsize=settings.SHORT_LINK_LRU_SIZE)
+def get_legacy_recipe_id(code):
+    """id рецепта по старому коду; LookupError, если его нет.
+
+    lru_cache не запоминает исключения, поэтому промахи в LRU не
+    остаются.
+    """
+    key = f'shortlink:{code}'
+    recipe_id = cache.get(key)
+    if recipe_id is None:
+        recipe_id = Recipes.objects.filter(short_url=code).values_list(
+            'pk', flat=True).first() or 0
+        cache.set(key, recipe_id,
+                  settings.SHORT_LINK_CACHE_TIMEOUT if recipe_id
+                  else settings.SHORT_LINK_MISS_CACHE_TIMEOUT)
+    if not recipe_id:
+        raise LookupError(code)
+    return recipe_id
+
+
+def resolve_legacy_code(code):
+    """id рецепта по старому случайному коду или None."""
+    try:
+        return get_legacy_recipe_id(code)
+    except LookupError:
+        return None
+
+
+def resolve_short_code(code):
+    return decode_short_code(code) or resolve_legacy_code(code)
@@ -0,0 +1,178 @@
+"""Инвалидация кешей API при изменении данных."""
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+
+from recipes.models import (Favorites, Ingredients, RecipeIngredients, Recipes,
+                            ShoppingCart, Tags)
+from recipes.signals import (catalogue_imported, ingredient_signals_suspended,
+                             recipe_ingredients_changed, recipes_imported,
+                             user_recipes_changed)
+from users.models import Follow
+
+from .catalogue import invalidate_catalogue
+from .images import release_images, schedule_derivatives
+from .versions import bump_version, bump_versions
+
+User = get_user_model()
+
+# Поля пользователя, которые попадают в сериализованного автора рецепта.
+AUTHOR_FIELDS = {'email', 'username', 'first_name', 'last_name', 'avatar'}
+
+
+def bump_on_commit(*parts):
+    transaction.on_commit(lambda: bump_version(*parts))
+
+
+def invalidate_recipes(recipe_ids):
+    """Делает устаревшими кеши рецептов recipe_ids и списка рецептов.
+
+    Версии меняются после коммита, чтобы параллельный запрос не положил
+    в кеш данные, прочитанные до завершения транзакции.
+    """
+    recipe_ids = list(recipe_ids)
+
+    transaction.on_commit(lambda: bump_versions(
+        [('recipe', recipe_id) for recipe_id in recipe_ids] + [('recipes',)]))
+
+
+def invalidate_shopping_carts(recipe_ids):
+    """Делает устаревшими списки покупок с рецептами recipe_ids."""
+    user_ids = set(ShoppingCart.objects.filter(
+        recipe__in=list(recipe_ids)).values_list('user', flat=True))
+
+    transaction.on_commit(lambda: bump_versions(
+        [('shopping_cart', user_id) for user_id in user_ids]))
+
+
+@receiver([post_save, post_delete], sender=Recipes)
+@receiver([post_save, post_delete], sender=Favorites)
+@receiver([post_save, post_delete], sender=ShoppingCart)
+@receiver(m2m_changed, sender=Recipes.tags.through)
+def invalidate_recipe_counts(sender, action=None, **kwargs):
+    if action is not None and not action.startswith('post_'):
+        return
+    bump_on_commit('count', Recipes._meta.label_lower)
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=Follow)
+def invalidate_user_counts(sender, created=True, **kwargs):
+    if sender is User and not created:
+        return
+    bump_on_commit('count', User._meta.label_lower)
+
+
+@receiver([post_save, post_delete], sender=Favorites)
+def invalidate_user_favorites(sender, instance, **kwargs):
+    bump_on_commit('favorites', instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=ShoppingCart)
+def invalidate_user_shopping_cart(sender, instance, **kwargs):
+    bump_on_commit('shopping_cart', instance.user_id)
+
+
+@receiver(user_recipes_changed)
+def invalidate_user_recipes(sender, user_id, **kwargs):
+    bump_on_commit('count', Recipes._meta.label_lower)
+    bump_on_commit('favorites' if sender is Favorites else 'shopping_cart',
+                   user_id)
+
+
+@receiver([post_save, post_delete], sender=Follow)
+def invalidate_user_follows(sender, instance, **kwargs):
+    bump_on_commit('follows', instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=Tags)
+@receiver([post_save, post_delete], sender=Ingredients)
+def invalidate_catalogue_data(sender, **kwargs):
+    transaction.on_commit(invalidate_catalogue)
+
+
+@receiver(catalogue_imported)
+def invalidate_imported_catalogue(sender, updated=False, **kwargs):
+    invalidate_catalogue()
+    if updated and sender is Tags:
+        invalidate_recipes(Recipes.objects.filter(
+            tags__isnull=False).values_list('pk', flat=True).distinct())
+
+
+@receiver([post_save, post_delete], sender=Recipes)
+def invalidate_recipe(sender, instance, **kwargs):
+    invalidate_recipes([instance.pk])
+
+
+@receiver(recipes_imported)
+def invalidate_imported_recipes(sender, recipes, **kwargs):
+    invalidate_recipes(recipe.pk for recipe in recipes)
+    bump_on_commit('count', Recipes._meta.label_lower)
+    for recipe in recipes:
+        schedule_derivatives(recipe)
+
+
+@receiver([post_save, post_delete], sender=RecipeIngredients)
+def invalidate_recipe_ingredients(sender, instance, **kwargs):
+    if not ingredient_signals_suspended():
+        invalidate_recipes([instance.recipe_id_id])
+        invalidate_shopping_carts([instance.recipe_id_id])
+
+
+@receiver(recipe_ingredients_changed)
+def invalidate_changed_ingredients(sender, recipe_id, **kwargs):
+    invalidate_recipes([recipe_id])
+    invalidate_shopping_carts([recipe_id])
+
+
+@receiver(m2m_changed, sender=Recipes.tags.through)
+def invalidate_recipe_tags(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_recipes([instance.pk])
+    elif pk_set:
+        invalidate_recipes(pk_set)
+    else:
+        invalidate_recipes(instance.recipe_tags.values_list('pk',
+                                                            flat=True))
+
+
+@receiver(post_save, sender=Tags)
+@receiver(pre_delete, sender=Tags)
+def invalidate_tag(sender, instance, **kwargs):
+    invalidate_recipes(instance.recipe_tags.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Ingredients)
+@receiver(pre_delete, sender=Ingredients)
+def invalidate_ingredient(sender, instance, **kwargs):
+    recipe_ids = list(instance.ingredient_recipes.values_list(
+        'recipe_id', flat=True).distinct())
+    invalidate_recipes(recipe_ids)
+    invalidate_shopping_carts(recipe_ids)
+
+
+@receiver(post_save, sender=Recipes)
+@receiver(post_save, sender=User)
+def update_image_derivatives(sender, instance, raw=False, **kwargs):
+    if not raw:
+        schedule_derivatives(instance)
+
+
+@receiver(post_delete, sender=Recipes)
+@receiver(post_delete, sender=User)
+def release_deleted_images(sender, instance, **kwargs):
+    release_images(instance)
+
+
+@receiver(post_save, sender=User)
+def invalidate_author(sender, instance, created, update_fields=None,
+                      **kwargs):
+    if created or (update_fields is not None
+                   and not AUTHOR_FIELDS.intersection(update_fields)):
+        return
+    invalidate_recipes(instance.recipes.values_list('pk', flat=True))
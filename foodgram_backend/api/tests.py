@@ -0,0 +1,858 @@
+"""Тесты API: бюджеты запросов к базе."""
+import json
+import runpy
+import tempfile
+from importlib import import_module
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.test import APIClient
+
+from api.metrics import merge, read_snapshots, registry
+from api.pagination import CountStrategy
+from api.recipe_import import NDJSONParser, RecipeImporter
+from api.serializers import RecipePostSerializer
+from api.shortlinks import get_legacy_recipe_id, resolve_legacy_code
+from api.versions import bump_version
+from constants import RECIPE_MULTI_GET_MAX_IDS
+from recipes import timeline
+from recipes.models import (Favorites, Ingredients, MediaBlob,
+                            RecipeIngredients, Recipes, ShoppingCart, Tags,
+                            TimelineEntry)
+from recipes.signals import user_recipes_changed
+from users.models import Follow
+
+User = get_user_model()
+
+
+class QueryBudgetTestCase(TestCase):
+    """Рецепты разных авторов с тегами, ингредиентами и связями
+    пользователя.
+
+    Бюджет проверяется на страницах разного размера: число запросов не
+    должно от него зависеть.
+    """
+
+    recipes_count = 12
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user',
+                                       email='user@example.com')
+        cls.authors = [
+            User.objects.create(username=f'author{number}',
+                                email=f'author{number}@example.com')
+            for number in range(4)]
+        tags = [Tags.objects.create(name=f'tag{number}',
+                                    slug=f'tag{number}')
+                for number in range(3)]
+        ingredients = [
+            Ingredients.objects.create(name=f'ingredient{number}',
+                                       measurement_unit='г')
+            for number in range(5)]
+        cls.recipes = []
+        for number in range(cls.recipes_count):
+            recipe = Recipes.objects.create(
+                name=f'recipe{number}', text='text', cooking_time=1,
+                author=cls.authors[number % len(cls.authors)],
+                image='recipes/images/recipe.png')
+            recipe.tags.set(tags[:1 + number % 3])
+            RecipeIngredients.objects.bulk_create(
+                RecipeIngredients(recipe_id=recipe, ingredient_id=ingredient,
+                                  amount=number + 1)
+                for ingredient in ingredients[:2 + number % 3])
+            cls.recipes.append(recipe)
+        for recipe in cls.recipes[::2]:
+            Favorites.objects.create(user=cls.user, recipe=recipe)
+        for recipe in cls.recipes[::3]:
+            ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+        for author in cls.authors[:3]:
+            Follow.objects.create(user=cls.user, following=author)
+
+    def setUp(self):
+        self.anonymous = APIClient()
+        self.authenticated = APIClient()
+        self.authenticated.force_authenticate(self.user)
+
+    def assertQueryBudget(self, client, url, budget, status=200):
+        """GET url с холодным кешем укладывается в budget запросов."""
+        cache.clear()
+        with self.assertNumQueries(budget):
+            response = client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, status)
+        return response
+
+
+class RecipeReadQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_recipe_list(self):
+        # Версии для ETag и ключа кеша ответов, версия для ключа count,
+        # count, рецепты с флагами, версии рецептов для фрагментов, теги,
+        # авторы, ингредиенты.
+        for limit in (3, self.recipes_count):
+            with self.subTest(limit=limit):
+                response = self.assertQueryBudget(
+                    self.anonymous, f'/api/recipes/?limit={limit}', 8)
+                self.assertEqual(len(response.data['results']), limit)
+                # Плюс подписки пользователя на авторов страницы.
+                response = self.assertQueryBudget(
+                    self.authenticated, f'/api/recipes/?limit={limit}', 9)
+                self.assertEqual(len(response.data['results']), limit)
+
+    def test_recipe_list_flags(self):
+        response = self.assertQueryBudget(
+            self.authenticated, f'/api/recipes/?limit={self.recipes_count}',
+            9)
+        favorited = {item['id'] for item in response.data['results']
+                     if item['is_favorited']}
+        in_cart = {item['id'] for item in response.data['results']
+                   if item['is_in_shopping_cart']}
+        subscribed = {item['author']['id'] for item in response.data['results']
+                      if item['author']['is_subscribed']}
+        self.assertEqual(favorited,
+                         {recipe.pk for recipe in self.recipes[::2]})
+        self.assertEqual(in_cart, {recipe.pk for recipe in self.recipes[::3]})
+        self.assertEqual(subscribed,
+                         {author.pk for author in self.authors[:3]})
+
+    def test_recipe_detail(self):
+        # Версии для ETag, рецепт с флагами, теги, автор, ингредиенты.
+        url = f'/api/recipes/{self.recipes[0].pk}/'
+        self.assertQueryBudget(self.anonymous, url, 5)
+        response = self.assertQueryBudget(self.authenticated, url, 5)
+        self.assertTrue(response.data['is_favorited'])
+        self.assertTrue(response.data['is_in_shopping_cart'])
+
+    def test_subscriptions(self):
+        # Версия для ключа count, count, авторы, их рецепты с
+        # ограничением recipes_limit.
+        for params in ('limit=1', 'limit=3&recipes_limit=2'):
+            with self.subTest(params=params):
+                self.assertQueryBudget(
+                    self.anonymous, f'/api/users/subscriptions/?{params}', 0,
+                    status=401)
+                self.assertQueryBudget(
+                    self.authenticated,
+                    f'/api/users/subscriptions/?{params}', 4)
+
+    def test_download_shopping_cart(self):
+        # Версия корзины, строки агрегата списка покупок и, кроме csv
+        # без заголовка, число рецептов в корзине.
+        for params, budget in (('', 3), ('?format=txt', 3),
+                               ('?format=csv', 2)):
+            with self.subTest(params=params):
+                url = f'/api/recipes/download_shopping_cart/{params}'
+                self.assertQueryBudget(self.anonymous, url, 0, status=401)
+                self.assertQueryBudget(self.authenticated, url, budget)
+
+
+class VersionedCacheTests(QueryBudgetTestCase):
+    """Кеши и ETag следуют версиям из базы при кеше в памяти процесса.
+
+    bump_version без обращения к кешу - то, что видит воркер, когда
+    данные изменил другой воркер.
+    """
+
+    url = '/api/recipes/?limit=3'
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_anonymous_response_cache(self):
+        self.assertEqual(self.anonymous.get(self.url)['X-Cache'], 'MISS')
+        # Только версия списка для ETag и ключа.
+        with self.assertNumQueries(1):
+            response = self.anonymous.get(self.url)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        bump_version('recipes')
+        self.assertEqual(self.anonymous.get(self.url)['X-Cache'], 'MISS')
+
+    def test_etag(self):
+        etag = self.authenticated.get(self.url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.authenticated.get(self.url,
+                                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        bump_version('favorites', self.user.pk)
+        response = self.authenticated.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_recipe_fragments(self):
+        recipe = self.authenticated.get(self.url).data['results'][0]
+        # Версии для ETag, версия для ключа count, рецепты с флагами,
+        # версии рецептов и подписки; теги, авторы и ингредиенты - из
+        # фрагментов.
+        with self.assertNumQueries(5):
+            self.authenticated.get(self.url)
+        Recipes.objects.filter(pk=recipe['id']).update(name='renamed')
+        self.assertEqual(
+            self.authenticated.get(self.url).data['results'][0]['name'],
+            recipe['name'])
+        bump_version('recipe', recipe['id'])
+        self.assertEqual(
+            self.authenticated.get(self.url).data['results'][0]['name'],
+            'renamed')
+
+    def test_fragment_key_scheme(self):
+        image = self.anonymous.get(self.url).data['results'][0]['image']
+        secure = self.anonymous.get(self.url, secure=True)
+        self.assertTrue(image.startswith('http://'))
+        self.assertTrue(
+            secure.data['results'][0]['image'].startswith('https://'))
+
+
+class InexactCountPaginationTests(QueryBudgetTestCase):
+    """Оценка числа записей не ограничивает номера страниц."""
+
+    def get_page(self, page, estimate):
+        cache.clear()
+        with mock.patch.object(CountStrategy, 'estimate',
+                               return_value=estimate):
+            return self.anonymous.get(f'/api/recipes/?limit=5&page={page}')
+
+    def test_estimate_below_count(self):
+        for page, size, has_next in ((1, 5, True), (2, 5, True),
+                                     (3, 2, False)):
+            with self.subTest(page=page):
+                response = self.get_page(page, estimate=3)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data['count'], 3)
+                self.assertIs(response.data['count_exact'], False)
+                self.assertEqual(len(response.data['results']), size)
+                self.assertIs(bool(response.data['next']), has_next)
+                self.assertIs(bool(response.data['previous']), page > 1)
+
+    def test_estimate_above_count(self):
+        response = self.get_page(3, estimate=1000)
+        self.assertFalse(response.data['next'])
+        self.assertEqual(self.get_page(4, estimate=1000).status_code, 404)
+
+
+class UserQueryBudgetTests(QueryBudgetTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        User.objects.bulk_create(
+            User(username=f'reader{number}',
+                 email=f'reader{number}@example.com')
+            for number in range(100))
+
+    def test_user_list(self):
+        # Версия для ключа count, count и пользователи с аннотацией
+        # is_subscribed.
+        for limit in (5, 100):
+            with self.subTest(limit=limit):
+                response = self.assertQueryBudget(
+                    self.anonymous, f'/api/users/?limit={limit}', 3)
+                self.assertEqual(len(response.data['results']), limit)
+                response = self.assertQueryBudget(
+                    self.authenticated, f'/api/users/?limit={limit}', 3)
+                self.assertEqual(len(response.data['results']), limit)
+
+    def test_user_list_is_subscribed(self):
+        response = self.assertQueryBudget(
+            self.authenticated, '/api/users/?limit=200', 3)
+        subscribed = {item['id'] for item in response.data['results']
+                      if item['is_subscribed']}
+        self.assertEqual(subscribed,
+                         {author.pk for author in self.authors[:3]})
+
+    def test_user_profile(self):
+        for author, is_subscribed in ((self.authors[0], True),
+                                      (self.authors[3], False)):
+            with self.subTest(author=author.username):
+                url = f'/api/users/{author.pk}/'
+                self.assertQueryBudget(self.anonymous, url, 1)
+                response = self.assertQueryBudget(self.authenticated, url, 1)
+                self.assertIs(response.data['is_subscribed'], is_subscribed)
+
+    def test_me(self):
+        # Пользователь уже загружен аутентификацией.
+        self.assertQueryBudget(self.anonymous, '/api/users/me/', 0,
+                               status=401)
+        response = self.assertQueryBudget(self.authenticated,
+                                          '/api/users/me/', 0)
+        self.assertFalse(response.data['is_subscribed'])
+
+
+class RecipeUpdateQueryTests(QueryBudgetTestCase):
+    """PATCH рецепта пишет только изменившиеся строки.
+
+    В каждом запросе: рецепт, автор для проверки прав, теги и
+    ингредиенты из запроса, savepoint транзакции, текущие теги и
+    ингредиенты рецепта, а для ответа - теги, ингредиенты и флаги
+    избранного и корзины.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.recipe = self.recipes[0]
+        self.author_client = APIClient()
+        self.author_client.force_authenticate(self.recipe.author)
+        self.tag_ids = list(self.recipe.tags.values_list('pk', flat=True))
+        self.amounts = dict(self.recipe.recipe_ingredients.values_list(
+            'ingredient_id', 'amount'))
+
+    def patch(self, tag_ids, amounts, **fields):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.author_client.patch(
+                f'/api/recipes/{self.recipe.pk}/', {
+                    'tags': tag_ids,
+                    'ingredients': [
+                        {'id': ingredient_id, 'amount': amount}
+                        for ingredient_id, amount in amounts.items()],
+                    **fields,
+                }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return context
+
+    def assertRecipe(self, tag_ids, amounts):
+        self.assertEqual(
+            set(self.recipe.tags.values_list('pk', flat=True)),
+            set(tag_ids))
+        self.assertEqual(dict(self.recipe.recipe_ingredients.values_list(
+            'ingredient_id', 'amount')), amounts)
+
+    def test_unchanged(self):
+        context = self.patch(self.tag_ids, self.amounts)
+        self.assertEqual(len(context), 12)
+        self.assertFalse([query for query in context.captured_queries
+                          if not query['sql'].startswith(
+                              ('SELECT', 'SAVEPOINT', 'RELEASE'))])
+
+    def test_typo_fix(self):
+        # Плюс один UPDATE рецепта.
+        context = self.patch(self.tag_ids, self.amounts, name='recipe 0')
+        self.assertEqual(len(context), 13)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.name, 'recipe 0')
+        self.assertRecipe(self.tag_ids, self.amounts)
+
+    def test_diff(self):
+        # Тег: выборка связей и вставка. Ингредиенты: выборка и удаление
+        # строки, bulk_update количества, вставка. Списки покупок: их
+        # владельцы, savepoint, вставка, обновление, удаление пустых
+        # строк и версии корзин.
+        amounts = dict(self.amounts)
+        changed, removed = list(amounts)
+        amounts[changed] += 1
+        del amounts[removed]
+        amounts[Ingredients.objects.exclude(
+            pk__in=self.amounts).first().pk] = 7
+        tag_ids = self.tag_ids + [
+            Tags.objects.exclude(pk__in=self.tag_ids).first().pk]
+        context = self.patch(tag_ids, amounts)
+        self.assertEqual(len(context), 25)
+        self.assertRecipe(tag_ids, amounts)
+
+
+class RecipeImportTests(QueryBudgetTestCase):
+    """Импорт пачки, которую отвергла база."""
+
+    image = ('data:image/gif;base64,'
+             'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+    def get_items(self, count):
+        tag = Tags.objects.first()
+        ingredient = Ingredients.objects.first()
+        return [{
+            'name': f'imported{number}', 'text': 'text', 'cooking_time': 1,
+            'image': self.image, 'tags': [tag.pk],
+            'ingredients': [{'id': ingredient.pk, 'amount': 1}],
+            'original_url': f'https://example.com/{number}',
+        } for number in range(count)]
+
+    def test_integrity_error_retries_rows(self):
+        validate = RecipeImporter.validate
+
+        def validate_and_race(importer, batch):
+            # Тот же original_url сохранили после проверки пачки.
+            result = validate(importer, batch)
+            Recipes.objects.create(
+                name='raced', text='text', cooking_time=1,
+                author=self.authors[0], image='recipes/images/recipe.png',
+                original_url='https://example.com/1')
+            return result
+
+        with mock.patch.object(RecipeImporter, 'validate',
+                               validate_and_race):
+            results, _ = RecipeImporter(self.user).run(self.get_items(3))
+        self.assertEqual([result['line'] for result in results], [1, 2, 3])
+        self.assertIn('id', results[0])
+        self.assertIn('errors', results[1])
+        self.assertIn('id', results[2])
+        self.assertEqual(Recipes.objects.filter(
+            author=self.user, name__startswith='imported').count(), 2)
+
+    def test_ndjson_parser_without_body(self):
+        self.assertEqual(list(NDJSONParser().parse(None)), [])
+
+
+class ImageReplaceTests(QueryBudgetTestCase):
+    """Старый оригинал освобождается только после коммита замены."""
+
+    gif = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff'
+           b'\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01'
+           b'\x00\x01\x00\x00\x02\x01D\x00;')
+
+    def setUp(self):
+        super().setUp()
+        # Копии не строятся: пул потоков не видит транзакцию теста.
+        patcher = mock.patch('api.images.derivative_pool')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.old_name = default_storage.save('recipes/images/old.gif',
+                                             ContentFile(b'old'))
+        self.addCleanup(default_storage.delete, self.old_name)
+
+    def get_refcount(self):
+        blob = MediaBlob.objects.filter(name=self.old_name).first()
+        return blob.refcount if blob else 0
+
+    def assertReleasedOnCommit(self, request):
+        # Ссылку держит только объект; вторую снимет cleanup.
+        default_storage.add_reference(self.old_name)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = request()
+            self.assertEqual(self.get_refcount(), 2)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.get_refcount(), 1)
+        return response
+
+    def test_recipe_image(self):
+        recipe = self.recipes[0]
+        Recipes.objects.filter(pk=recipe.pk).update(image=self.old_name)
+        client = APIClient()
+        client.force_authenticate(recipe.author)
+        response = self.assertReleasedOnCommit(lambda: client.put(
+            f'/api/recipes/{recipe.pk}/image/',
+            {'image': SimpleUploadedFile('new.gif', self.gif)}))
+        self.assertEqual(response.status_code, 200)
+        recipe.refresh_from_db()
+        self.assertNotEqual(recipe.image.name, self.old_name)
+        self.assertEqual(recipe.image_variants, {})
+
+    def test_avatar_delete(self):
+        User.objects.filter(pk=self.user.pk).update(avatar=self.old_name)
+        self.user.refresh_from_db()
+        self.authenticated.force_authenticate(self.user)
+        response = self.assertReleasedOnCommit(
+            lambda: self.authenticated.delete('/api/users/me/avatar/'))
+        self.assertEqual(response.status_code, 204)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.avatar)
+
+
+@override_settings(IMAGE_MAX_UPLOAD_SIZE=16)
+class ImageUploadLimitTests(QueryBudgetTestCase):
+    """Лимит размера обрывает загрузку изображения в парсере."""
+
+    def setUp(self):
+        super().setUp()
+        self.recipe = self.recipes[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.recipe.author)
+        self.url = f'/api/recipes/{self.recipe.pk}/image/'
+
+    def test_multipart(self):
+        response = self.client.put(self.url, {
+            'image': SimpleUploadedFile('big.gif', ImageReplaceTests.gif)})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+
+    def test_raw_body(self):
+        response = self.client.put(self.url, ImageReplaceTests.gif,
+                                   content_type='image/gif')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('file', response.data)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.image.name, 'recipes/images/recipe.png')
+
+
+class TagsImportTests(QueryBudgetTestCase):
+
+    def test_name_conflict(self):
+        # tag0 уже занят тегом со slug tag0.
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write('name,slug\nnew,new\ntag0,other\n')
+            file.flush()
+            with self.assertRaisesMessage(CommandError, 'отменен'):
+                call_command('tags_import_csv', file.name)
+        self.assertFalse(Tags.objects.filter(slug__in=['new', 'other']))
+
+
+class MetricsTests(QueryBudgetTestCase):
+
+    def test_unknown_method(self):
+        before = sum(value for (_, method, _), value
+                     in registry.responses.items() if method == 'OTHER')
+        self.anonymous.generic('BREW', '/api/recipes/')
+        after = sum(value for (_, method, _), value
+                    in registry.responses.items() if method == 'OTHER')
+        self.assertEqual(after, before + 1)
+        self.assertFalse([key for key in registry.responses
+                          if key[1] == 'BREW'])
+
+    def test_exited_workers_are_merged(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with mock.patch.dict('os.environ',
+                             METRICS_MULTIPROC_DIR=directory.name):
+            config = runpy.run_path(
+                Path(__file__).resolve().parents[1] / 'gunicorn.conf.py')
+
+        def write_snapshot(pid):
+            (Path(directory.name) / f'{pid}.json').write_text(json.dumps({
+                'pid': pid, 'process': f'{pid}-1', 'in_flight': 1,
+                'durations': [['test', 'GET', [1, 0, 0.5]]],
+                'responses': [['test', 'GET', 200, 1]],
+                'queries': [['test', 'GET', 2]], 'cache': {},
+            }))
+
+        for pid in (101, 102, 103):
+            write_snapshot(pid)
+        for pid in (101, 102):
+            config['child_exit'](None, SimpleNamespace(pid=pid))
+        self.assertEqual(
+            sorted(path.name for path in Path(directory.name).iterdir()),
+            ['103.json', 'exited.json'])
+        # Снимок, прочитанный до удаления, не учитывается дважды.
+        write_snapshot(101)
+        with override_settings(METRICS_MULTIPROC_DIR=directory.name):
+            durations, responses, queries, _, in_flight = merge(
+                read_snapshots())
+        self.assertEqual(durations['test', 'GET'], [3, 0, 1.5])
+        self.assertEqual(responses['test', 'GET', 200], 3)
+        self.assertEqual(queries['test', 'GET'], 6)
+        # Из трех воркеров в обработке запрос только у живого.
+        self.assertEqual(in_flight, 1 + registry.in_flight)
+
+
+class LegacyShortCodeTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        get_legacy_recipe_id.cache_clear()
+        self.addCleanup(get_legacy_recipe_id.cache_clear)
+
+    def test_miss_is_not_kept_in_process(self):
+        recipe = self.recipes[0]
+        self.assertIsNone(resolve_legacy_code('abc123'))
+        Recipes.objects.filter(pk=recipe.pk).update(short_url='abc123')
+        # Промах в кеше Django истек.
+        cache.clear()
+        self.assertEqual(resolve_legacy_code('abc123'), recipe.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_legacy_code('abc123'), recipe.pk)
+
+
+@override_settings(FEED_FANOUT_MAX_FOLLOWERS=2)
+class TimelineThresholdTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.author = self.authors[0]
+        self.follower = User.objects.create(username='follower',
+                                            email='follower@example.com')
+        patcher = mock.patch.object(
+            timeline.executor, 'submit',
+            side_effect=lambda run, task, *args: task(*args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_timeline(self, user):
+        return set(TimelineEntry.objects.filter(
+            user=user, author=self.author).values_list(
+                'recipe_id', flat=True))
+
+    def test_crossing_up_resets_cache(self):
+        self.assertEqual(timeline.get_fanout_on_read_author_ids(), [])
+        Follow.objects.create(user=self.follower, following=self.author)
+        self.assertEqual(timeline.get_fanout_on_read_author_ids(),
+                         [self.author.pk])
+        self.assertEqual(self.get_timeline(self.follower), set())
+
+    def test_crossing_down_backfills_followers(self):
+        recipe_ids = {recipe.pk for recipe in self.recipes
+                      if recipe.author == self.author}
+        self.assertEqual(self.get_timeline(self.user), recipe_ids)
+        Follow.objects.create(user=self.follower, following=self.author)
+        # Пока автор выше порога, его рецепты в ленты не раскладываются.
+        TimelineEntry.objects.filter(author=self.author).delete()
+        self.assertEqual(timeline.get_fanout_on_read_author_ids(),
+                         [self.author.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.filter(user=self.follower).delete()
+        self.assertEqual(timeline.get_fanout_on_read_author_ids(), [])
+        self.assertEqual(self.get_timeline(self.user), recipe_ids)
+
+    def test_migration_backfills_existing_follows(self):
+        TimelineEntry.objects.all().delete()
+        migration = import_module(
+            'recipes.migrations.0014_backfill_timelines')
+        migration.backfill_timelines(apps, None)
+        self.assertEqual(
+            set(TimelineEntry.objects.filter(user=self.user).values_list(
+                'recipe_id', flat=True)),
+            {recipe.pk for recipe in self.recipes
+             if recipe.author in self.authors[:3]})
+
+
+class RecipeToggleTests(QueryBudgetTestCase):
+    """Избранное и корзина: повтор запроса не дает ошибки."""
+
+    def post(self, url, model=Favorites):
+        """Ответ и запросы, изменившие таблицу model."""
+        table = connection.ops.quote_name(model._meta.db_table)
+        with CaptureQueriesContext(connection) as context:
+            response = self.authenticated.post(url)
+        return response, [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith((f'INSERT INTO {table}',
+                                        f'DELETE FROM {table}'))]
+
+    def test_repeated_post(self):
+        for model, name in ((Favorites, 'favorite'),
+                            (ShoppingCart, 'shopping_cart')):
+            with self.subTest(name):
+                recipe = self.recipes[1]
+                url = f'/api/recipes/{recipe.pk}/{name}/'
+                response, writes = self.post(url, model)
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response.data['id'], recipe.pk)
+                self.assertEqual(len(writes), 1)
+                self.assertIn('ON CONFLICT DO NOTHING', writes[0])
+                response, writes = self.post(url, model)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(writes), 1)
+                self.assertEqual(model.objects.filter(
+                    user=self.user, recipe=recipe).count(), 1)
+
+    def test_delete_absent(self):
+        url = f'/api/recipes/{self.recipes[1].pk}/favorite/'
+        self.assertEqual(self.authenticated.delete(url).status_code, 204)
+        self.assertEqual(self.authenticated.delete(url).status_code, 204)
+        url = f'/api/recipes/{self.recipes[0].pk}/favorite/'
+        self.assertEqual(self.authenticated.delete(url).status_code, 204)
+        self.assertFalse(Favorites.objects.filter(
+            user=self.user, recipe=self.recipes[0]).exists())
+
+    def test_missing_recipe(self):
+        missing = Recipes.objects.order_by('-pk').first().pk + 1
+        for model, name in ((Favorites, 'favorite'),
+                            (ShoppingCart, 'shopping_cart')):
+            url = f'/api/recipes/{missing}/{name}/'
+            with self.subTest(name):
+                response, writes = self.post(url, model)
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(len(writes), 1)
+                self.assertEqual(
+                    self.authenticated.delete(url).status_code, 404)
+        self.assertEqual(self.authenticated.post(
+            '/api/recipes/abc/favorite/').status_code, 404)
+
+
+class RecipeValidationQueryTests(QueryBudgetTestCase):
+    """Теги и ингредиенты рецепта проверяются одним запросом на модель."""
+
+    image = RecipeImportTests.image
+
+    def validate(self, tag_ids, ingredient_ids):
+        serializer = RecipePostSerializer(data={
+            'name': 'recipe', 'text': 'text', 'cooking_time': 1,
+            'image': self.image, 'tags': tag_ids,
+            'ingredients': [{'id': pk, 'amount': 1}
+                            for pk in ingredient_ids]})
+        with CaptureQueriesContext(connection) as context:
+            serializer.is_valid()
+        return serializer, [query['sql'] for query in context.captured_queries]
+
+    def assertOneQueryPerModel(self, queries):
+        for model in (Tags, Ingredients):
+            table = connection.ops.quote_name(model._meta.db_table)
+            self.assertEqual(
+                len([sql for sql in queries if f'FROM {table}' in sql]), 1)
+
+    def test_query_count_does_not_grow(self):
+        Tags.objects.bulk_create(Tags(name=f'extra{number}',
+                                      slug=f'extra{number}')
+                                 for number in range(10))
+        Ingredients.objects.bulk_create(
+            Ingredients(name=f'extra{number}', measurement_unit='г')
+            for number in range(30))
+        tag_ids = list(Tags.objects.values_list('pk', flat=True))
+        ingredient_ids = list(Ingredients.objects.values_list('pk',
+                                                              flat=True))
+        serializer, small = self.validate(tag_ids[:1], ingredient_ids[:1])
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer, large = self.validate(tag_ids, ingredient_ids)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(len(large), len(small))
+        self.assertOneQueryPerModel(large)
+
+    def test_unknown_ids(self):
+        missing = 10 ** 6
+        tag_ids = list(Tags.objects.values_list('pk', flat=True))
+        ingredient_ids = list(Ingredients.objects.values_list('pk',
+                                                              flat=True))
+        serializer, queries = self.validate(
+            [*tag_ids, missing], [*ingredient_ids, missing, 'abc'])
+        self.assertFalse(serializer.is_valid())
+        self.assertOneQueryPerModel(queries)
+        messages = PrimaryKeyRelatedField.default_error_messages
+        self.assertEqual(serializer.errors['tags'], [
+            messages['does_not_exist'].format(pk_value=missing)])
+        errors = serializer.errors['ingredients']
+        self.assertEqual(errors[:len(ingredient_ids)],
+                         [{}] * len(ingredient_ids))
+        self.assertEqual(errors[-2], {'id': [
+            messages['does_not_exist'].format(pk_value=missing)]})
+        self.assertEqual(errors[-1], {'id': [
+            messages['incorrect_type'].format(data_type='str')]})
+
+
+class RecipeBatchTests(QueryBudgetTestCase):
+    """Пакетное изменение избранного и корзины."""
+
+    def setUp(self):
+        super().setUp()
+        self.receiver = mock.Mock()
+        user_recipes_changed.connect(self.receiver)
+        self.addCleanup(user_recipes_changed.disconnect, self.receiver)
+
+    def post(self, name, **data):
+        response = self.authenticated.post(f'/api/recipes/{name}/batch/',
+                                           data, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return {result['id']: result['status']
+                for result in response.data['results']}
+
+    def test_mixed_ids(self):
+        missing = Recipes.objects.order_by('-pk').first().pk + 1
+        for model, name, linked in (
+                (Favorites, 'favorite', self.recipes[::2]),
+                (ShoppingCart, 'shopping_cart', self.recipes[::3])):
+            with self.subTest(name):
+                self.receiver.reset_mock()
+                new = next(recipe for recipe in self.recipes
+                           if recipe not in linked)
+                absent = next(recipe for recipe in self.recipes
+                              if recipe not in linked and recipe != new)
+                results = self.post(
+                    name,
+                    add=[new.pk, linked[0].pk, missing, new.pk],
+                    remove=[linked[1].pk, absent.pk, missing + 1])
+                self.assertEqual(results, {
+                    new.pk: 'added', linked[0].pk: 'exists',
+                    missing: 'not_found', linked[1].pk: 'removed',
+                    absent.pk: 'absent', missing + 1: 'not_found'})
+                self.assertEqual(set(model.objects.filter(
+                    user=self.user).values_list('recipe_id', flat=True)),
+                    {recipe.pk for recipe in linked if recipe != linked[1]}
+                    | {new.pk})
+                self.receiver.assert_called_once_with(
+                    signal=user_recipes_changed, sender=model,
+                    user_id=self.user.pk, added=[new.pk],
+                    removed=[linked[1].pk])
+
+    def test_duplicates(self):
+        recipe = self.recipes[1]
+        results = self.post('favorite', add=[recipe.pk] * 3)
+        self.assertEqual(results, {recipe.pk: 'added'})
+        self.assertEqual(Favorites.objects.filter(
+            user=self.user, recipe=recipe).count(), 1)
+        self.receiver.assert_called_once()
+
+    def test_unchanged(self):
+        results = self.post('favorite', add=[self.recipes[0].pk],
+                            remove=[self.recipes[1].pk])
+        self.assertEqual(results, {self.recipes[0].pk: 'exists',
+                                   self.recipes[1].pk: 'absent'})
+        self.receiver.assert_not_called()
+
+    def test_conflicting_ids(self):
+        recipe = self.recipes[0]
+        response = self.authenticated.post(
+            '/api/recipes/favorite/batch/',
+            {'add': [recipe.pk], 'remove': [recipe.pk]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class RecipeBulkTests(QueryBudgetTestCase):
+    """Рецепты по списку ?ids=."""
+
+    def get(self, client, ids):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/api/recipes/bulk/',
+                                  {'ids': ','.join(map(str, ids))})
+        self.assertEqual(response.status_code, 200)
+        return response, len(context)
+
+    def test_order_and_missing(self):
+        missing = Recipes.objects.order_by('-pk').first().pk + 1
+        ids = [self.recipes[5].pk, missing, self.recipes[0].pk,
+               self.recipes[3].pk, self.recipes[0].pk]
+        response, _ = self.get(self.authenticated, ids)
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [self.recipes[5].pk, self.recipes[0].pk, self.recipes[3].pk])
+        self.assertEqual(response.data['missing'], [missing])
+        favorited = {recipe['id']: recipe['is_favorited']
+                     for recipe in response.data['results']}
+        self.assertEqual(favorited, {self.recipes[5].pk: False,
+                                     self.recipes[0].pk: True,
+                                     self.recipes[3].pk: False})
+
+    def test_query_count_does_not_grow(self):
+        for client in (self.anonymous, self.authenticated):
+            _, small = self.get(client, [self.recipes[0].pk])
+            _, large = self.get(client,
+                                [recipe.pk for recipe in self.recipes])
+            self.assertEqual(large, small)
+
+    def test_invalid_ids(self):
+        for ids in ('', 'a,b', ','.join(
+                map(str, range(1, RECIPE_MULTI_GET_MAX_IDS + 2)))):
+            with self.subTest(ids=ids[:10]):
+                self.assertEqual(self.anonymous.get(
+                    '/api/recipes/bulk/', {'ids': ids}).status_code, 400)
+
+
+@override_settings(SQL_INSTRUMENTATION_SAMPLE_RATE=1)
+class ServerTimingTests(QueryBudgetTestCase):
+
+    def test_header(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.authenticated.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(
+            response['Server-Timing'],
+            rf'^db;dur=\d+\.\d;desc="{len(context)} queries", '
+            r'render;dur=\d+\.\d, total;dur=\d+\.\d$')
+
+    @override_settings(SQL_INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_not_sampled(self):
+        response = self.anonymous.get('/api/recipes/')
+        self.assertNotIn('Server-Timing', response)
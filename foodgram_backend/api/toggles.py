@@ -0,0 +1,143 @@
+"""Идемпотентное добавление и удаление связей пользователя.
+
+Избранное, корзина и подписки пишутся одним запросом:
+INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING и
+DELETE ... RETURNING. Повтор запроса не дает ошибки, а одновременные
+повторы не упираются в уникальный индекс. Несуществующая цель не
+вставляется: INSERT выбирает ее из таблицы цели, а не полагается на
+внешний ключ, проверка которого в PostgreSQL отложена до коммита.
+
+Сигналы post_save и post_delete отправляются вручную, поэтому кеши,
+списки покупок и ленты обновляются как при save() и delete(); пакетные
+изменения отправляют один сигнал user_recipes_changed.
+"""
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404
+
+from recipes.models import Recipes
+from recipes.signals import user_recipes_changed
+
+
+def get_columns(model, target_field):
+    """Имена таблиц и столбцов для запросов по model.user и target."""
+    quote = connection.ops.quote_name
+    field = model._meta.get_field(target_field)
+    target = field.related_model
+    return {
+        'table': quote(model._meta.db_table),
+        'pk': quote(model._meta.pk.column),
+        'user': quote(model._meta.get_field('user').column),
+        'target': quote(field.column),
+        'target_table': quote(target._meta.db_table),
+        'target_pk': quote(target._meta.pk.column),
+    }
+
+
+def to_target_id(model, target_field, target_id):
+    field = model._meta.get_field(target_field)
+    try:
+        return field.target_field.to_python(target_id)
+    except ValidationError:
+        raise Http404
+
+
+def insert_links(model, user, target_field, target_ids):
+    """Вставляет связи user с существующими целями target_ids.
+
+    Возвращает [(pk, target_id)] вставленных строк.
+    """
+    sql = ('INSERT INTO {table} ({user}, {target}) '
+           'SELECT %s, {target_pk} FROM {target_table} '
+           'WHERE {target_pk} IN ({placeholders}) '
+           'ON CONFLICT DO NOTHING RETURNING {pk}, {target}').format(
+               placeholders=', '.join(['%s'] * len(target_ids)),
+               **get_columns(model, target_field))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user.pk, *target_ids])
+        return cursor.fetchall()
+
+
+def delete_links(model, user, target_field, target_ids):
+    """Удаляет связи user с target_ids, возвращает [(pk, target_id)]."""
+    sql = ('DELETE FROM {table} WHERE {user} = %s '
+           'AND {target} IN ({placeholders}) '
+           'RETURNING {pk}, {target}').format(
+               placeholders=', '.join(['%s'] * len(target_ids)),
+               **get_columns(model, target_field))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user.pk, *target_ids])
+        return cursor.fetchall()
+
+
+def add_link(model, user, target_field, target_id):
+    """Создает model(user=user, target_field=target_id).
+
+    Возвращает созданный объект или None, если связь уже есть или цели
+    нет.
+    """
+    target_id = to_target_id(model, target_field, target_id)
+    try:
+        with transaction.atomic():
+            rows = insert_links(model, user, target_field, [target_id])
+            if not rows:
+                return None
+            instance = model(pk=rows[0][0], user=user,
+                             **{f'{target_field}_id': target_id})
+            post_save.send(sender=model, instance=instance, created=True,
+                           update_fields=None, raw=False,
+                           using=connection.alias)
+    except IntegrityError:
+        # Цель удалили между выборкой и проверкой внешнего ключа.
+        raise Http404
+    return instance
+
+
+def remove_link(model, user, target_field, target_id):
+    """Удаляет model(user=user, target_field=target_id), возвращает
+    True, если связь была."""
+    target_id = to_target_id(model, target_field, target_id)
+    with transaction.atomic():
+        rows = delete_links(model, user, target_field, [target_id])
+        for pk, _ in rows:
+            instance = model(pk=pk, user=user,
+                             **{f'{target_field}_id': target_id})
+            post_delete.send(sender=model, instance=instance,
+                             origin=instance, using=connection.alias)
+    return bool(rows)
+
+
+def toggle_recipes(model, user, add=(), remove=()):
+    """Пакетно добавляет рецепты add в список model и удаляет remove.
+
+    Вставка и удаление - по одному запросу; списки покупок и версии
+    кешей обновляются один раз на пакет сигналом user_recipes_changed.
+    Возвращает {recipe_id: исход}: added, exists, removed, absent или
+    not_found.
+    """
+    added, removed = set(), set()
+    with transaction.atomic():
+        if add:
+            added = {recipe_id for _, recipe_id
+                     in insert_links(model, user, 'recipe', add)}
+        if remove:
+            removed = {recipe_id for _, recipe_id
+                       in delete_links(model, user, 'recipe', remove)}
+        if added or removed:
+            user_recipes_changed.send(sender=model, user_id=user.pk,
+                                      added=sorted(added),
+                                      removed=sorted(removed))
+    rest = (set(add) - added) | (set(remove) - removed)
+    found = set(Recipes.objects.filter(pk__in=rest).values_list(
+        'pk', flat=True)) if rest else set()
+    results = {}
+    for recipe_id in add:
+        results[recipe_id] = ('added' if recipe_id in added
+                              else 'exists' if recipe_id in found
+                              else 'not_found')
+    for recipe_id in remove:
+        results[recipe_id] = ('removed' if recipe_id in removed
+                              else 'absent' if recipe_id in found
+                              else 'not_found')
+    return results
@@ -0,0 +1,145 @@
+"""Потоковая загрузка изображений.
+
+Кроме base64 в JSON изображения принимаются в multipart/form-data и
+«сырым» телом запроса с Content-Type image/*. Такие загрузки пишутся
+обработчиками Django кусками (во временный файл, если файл больше
+FILE_UPLOAD_MAX_MEMORY_SIZE). Парсеры ImageMultiPartParser и
+ImageUploadParser добавляют к обработчикам запроса
+ImageUploadLimitHandler: он обрывает загрузку через StopUpload, как
+только превышен размер или по заголовку видно, что изображение слишком
+большое, и парсер отвечает 400. Остальные загрузки, например в админке,
+лимиты изображений не затрагивают.
+"""
+import io
+import json
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from PIL import Image
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import FileUploadParser, MultiPartParser
+
+# Сколько байт начала файла держать в памяти в поисках размеров.
+IMAGE_HEADER_MAX_BYTES = 65536
+
+
+def check_image_size(size):
+    if size > settings.IMAGE_MAX_UPLOAD_SIZE:
+        return (f'Размер изображения больше '
+                f'{settings.IMAGE_MAX_UPLOAD_SIZE} байт.')
+    return None
+
+
+def check_image_dimensions(width, height):
+    if max(width, height) > settings.IMAGE_MAX_DIMENSION:
+        return (f'Сторона изображения больше '
+                f'{settings.IMAGE_MAX_DIMENSION} пикселей.')
+    return None
+
+
+def read_image_dimensions(header):
+    """Размеры изображения по началу файла или None, если его мало."""
+    try:
+        with Image.open(io.BytesIO(header)) as image:
+            return image.size
+    except Image.DecompressionBombError:
+        return (settings.IMAGE_MAX_DIMENSION + 1,) * 2
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+
+class ImageUploadLimitHandler(FileUploadHandler):
+    """Проверяет размер и габариты файла по мере его получения.
+
+    При нарушении лимита запоминает ошибку в error и останавливает
+    загрузку, не дочитывая тело запроса.
+    """
+
+    error = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.received = 0
+        self.header = b''
+        self.checked = False
+        if self.content_length:
+            self.check(check_image_size(self.content_length))
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        self.check(check_image_size(self.received))
+        if not self.checked:
+            self.header += raw_data
+            dimensions = read_image_dimensions(self.header)
+            if dimensions is not None:
+                self.check(check_image_dimensions(*dimensions))
+            if (dimensions is not None
+                    or len(self.header) >= IMAGE_HEADER_MAX_BYTES):
+                self.checked = True
+                self.header = b''
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+    def check(self, error):
+        if error:
+            self.error = {self.field_name or 'file': [error]}
+            raise StopUpload(connection_reset=True)
+
+
+class ImageUploadLimitMixin:
+    """Парсер, ограничивающий загружаемые изображения.
+
+    ImageUploadLimitHandler ставится первым среди обработчиков загрузки
+    только этого запроса, а его ошибка возвращается как ValidationError.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context['request']._request
+        handler = ImageUploadLimitHandler(request)
+        request.upload_handlers = [handler, *request.upload_handlers]
+        try:
+            result = super().parse(stream, media_type, parser_context)
+        except StopUpload:
+            # FileUploadParser, в отличие от multipart, StopUpload не ловит.
+            result = None
+        if handler.error:
+            raise ValidationError(handler.error)
+        return result
+
+
+class ImageMultiPartParser(ImageUploadLimitMixin, MultiPartParser):
+    """multipart/form-data с лимитами для изображений."""
+
+
+class ImageUploadParser(ImageUploadLimitMixin, FileUploadParser):
+    """Изображение «сырым» телом запроса, попадает в поле file."""
+
+    media_type = 'image/*'
+
+    def get_filename(self, stream, media_type, parser_context):
+        filename = super().get_filename(stream, media_type, parser_context)
+        if filename:
+            return filename
+        return 'image.' + media_type.split(';')[0].split('/')[-1].strip()
+
+
+def form_to_dict(data, json_fields=()):
+    """Данные multipart-формы в виде словаря для сериализатора.
+
+    Списки в json_fields передаются повторяющимися полями или одним
+    полем с JSON.
+    """
+    result = data.dict()
+    for field in json_fields:
+        if field not in data:
+            continue
+        values = data.getlist(field)
+        if len(values) == 1 and values[0].lstrip().startswith(('[', '{')):
+            try:
+                values = json.loads(values[0])
+            except ValueError:
+                raise ValidationError({field: ['Некорректный JSON.']})
+        result[field] = values
+    return result
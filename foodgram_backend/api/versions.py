@@ -0,0 +1,42 @@
+"""Версии данных для инвалидации кешей.
+
+Версия хранится в таблице DataVersion и меняется при каждой записи в
+соответствующие данные, поэтому ключи, содержащие версию, устаревают
+без перебора и удаления. Значение версии - время последнего изменения
+в микросекундах, так что после очистки кеша новая версия не совпадет
+ни с одной из выданных ранее.
+
+Версии читаются из базы, а не из кеша: так их одинаково видят все
+воркеры при любом бэкенде кеша, в том числе в памяти процесса.
+"""
+from recipes.models import DataVersion
+
+
+def version_key(*parts):
+    return ':'.join(map(str, parts))
+
+
+def get_version(*parts):
+    """Текущая версия данных; 0, если они еще не менялись."""
+    return DataVersion.get_version(version_key(*parts))
+
+
+def bump_version(*parts):
+    """Отмечает изменение данных, делая устаревшими зависимые ключи."""
+    bump_versions([parts])
+
+
+def bump_versions(parts_list):
+    """Отмечает изменение нескольких данных за два запроса."""
+    keys = [version_key(*parts) for parts in parts_list]
+    if keys:
+        DataVersion.bump(*keys)
+
+
+def get_versions(parts_list):
+    """Версии для нескольких ключей за один запрос."""
+    keys = [version_key(*parts) for parts in parts_list]
+    if not keys:
+        return []
+    versions = DataVersion.get_versions(keys)
+    return [versions[key] for key in keys]
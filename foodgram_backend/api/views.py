@@ -1,154 +1,316 @@
-import random
-import string
+from itertools import islice
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import F, Sum
+from django.db import transaction
+from django.db.models import F, OuterRef
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.permissions import CurrentUserOrAdmin
 from djoser.views import UserViewSet as DjoserUserViewSet
 from rest_framework import filters, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import FormParser, JSONParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 
-from constants import SHORT_CODE_LENGTH
-from recipes.models import Favorites, Ingredients, Recipes, ShoppingCart, Tags
+from constants import RECIPE_MULTI_GET_MAX_IDS
+from recipes.models import (Favorites, Ingredients, Recipes, ShoppingCart,
+                            ShoppingListItem, Tags)
+from users.models import Follow
 
+from .cache import AnonymousResponseCacheMixin
+from .catalogue import CatalogueMixin, catalogue
+from .conditional import ConditionalGetMixin, get_user_versions
+from .exports import export_shopping_list
+from .feed import Feed
 from .filters import IngredientFilter, RecipeFilter
-from .pagination import PageLimitPagination
+from .images import replace_image
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .metrics import render_metrics
+from .pagination import KeysetPagination, PageLimitPagination
 from .permissions import IsAuthorOrReadOnly
-from .serializers import (AvatarUpdateSerializer, FavoriteSerializer,
-                          FollowSerializer, IngredientsSerializer,
+from .querysets import (annotate_recipe_flags, annotate_user_flag,
+                        get_recipe_prefetches, get_subscriptions_queryset,
+                        parse_recipes_limit)
+from .recipe_import import NDJSONParser, RecipeImporter
+from .renderers import (CSVRenderer, PDFRenderer, PlainTextRenderer,
+                        ShoppingListHTMLRenderer)
+from .serializers import (AvatarUpdateSerializer, IngredientsSerializer,
+                          RecipeBatchSerializer, RecipeImageSerializer,
                           RecipePostSerializer, RecipeReadSerializer,
                           RecipeReadSerializerForSubscriptions,
-                          ShoppingCartSerializer, SubscriptionSerializer,
                           TagsReadSerializer, UserGetSerializerFollow)
+from .shortlinks import encode_short_code, resolve_short_code
+from .toggles import add_link, remove_link, toggle_recipes
+from .uploads import ImageMultiPartParser, ImageUploadParser
 
 User = get_user_model()
 
 
-def generate_short_code():
-    """Генерирует произвольный слаг для прямой ссылки."""
-    short_url = ''.join(random.choices(string.ascii_letters
-                        + string.digits, k=SHORT_CODE_LENGTH))
-    if not Recipes.objects.filter(short_url=short_url).exists():
-        return short_url
-    return generate_short_code()
-
-
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, AnonymousResponseCacheMixin,
+                    viewsets.ModelViewSet):
     queryset = Recipes.objects.all()
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
     lookup_field = 'id'
     pagination_class = PageLimitPagination
+    parser_classes = (JSONParser, FormParser, ImageMultiPartParser)
+    anonymous_cache_name = 'recipes'
+    anonymous_cache_ignore_params = ('is_favorited', 'is_in_shopping_cart')
+    public_max_age = settings.RECIPES_HTTP_MAX_AGE
+
+    def get_anonymous_cache_version(self):
+        # Для анонима первая и единственная версия валидаторов - рецепта
+        # или списка рецептов, она уже прочитана для ETag.
+        return self.get_validator_values()[0]
+
+    def get_validator_versions(self):
+        user = self.request.user
+        if self.action == 'download_shopping_cart':
+            return [('shopping_cart', user.pk)]
+        if self.action == 'retrieve':
+            return ([('recipe', self.kwargs[self.lookup_field])]
+                    + get_user_versions(user))
+        if self.action == 'list':
+            return [('recipes',)] + get_user_versions(user)
+        if self.action == 'bulk':
+            return ([('recipe', pk) for pk in self.get_requested_ids()]
+                    + get_user_versions(user))
+        return None
+
+    @property
+    def paginator(self):
+        """Keyset-пагинация, если клиент запросил ее параметрами."""
+        request = getattr(self, 'request', None)
+        if (not hasattr(self, '_paginator') and request is not None
+                and KeysetPagination.is_requested(request)):
+            self._paginator = KeysetPagination()
+        return super().paginator
+
+    def get_queryset(self):
+        """Для чтения - фиксированное число запросов на страницу.
+
+        Связи для списка подгружает RecipeListSerializer и только для
+        рецептов, которых нет в кеше фрагментов.
+        """
+        queryset = super().get_queryset()
+        if self.action not in ('list', 'retrieve', 'feed', 'bulk'):
+            return queryset
+        user = self.request.user
+        queryset = annotate_recipe_flags(queryset, user)
+        if self.action in ('list', 'feed', 'bulk'):
+            return queryset
+        return queryset.prefetch_related(*get_recipe_prefetches(user))
 
     def get_permissions(self):
-        if self.action in ['update', 'partial_update', 'destroy']:
+        if self.action in ['update', 'partial_update', 'destroy', 'image']:
             return [IsAuthorOrReadOnly()]
         elif self.action in ['create', 'favorite', 'shopping_cart',
-                             'download_shopping_cart']:
+                             'favorite_batch', 'shopping_cart_batch',
+                             'download_shopping_cart', 'feed',
+                             'import_recipes']:
             return [IsAuthenticated()]
         return [AllowAny()]
 
     def get_serializer_class(self):
-        if self.action in ('list', 'retrieve'):
+        if self.action in ('list', 'retrieve', 'feed', 'bulk'):
             return RecipeReadSerializer
         return RecipePostSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user,
-                        short_url=generate_short_code())
-
-    def create_favorites_shopping_cart(self, serializer, obj):
-        serializer_read = RecipeReadSerializerForSubscriptions(obj)
+        recipe = serializer.save(author=self.request.user)
+        recipe.short_url = encode_short_code(recipe.pk)
+        Recipes.objects.filter(pk=recipe.pk).update(
+            short_url=recipe.short_url)
 
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer_read.data,
-                            status=status.HTTP_201_CREATED)
-        return Response(
-            serializer.errors,
-            status=status.HTTP_400_BAD_REQUEST
-        )
-
-    def delete_favorites_shopping_cart(self, obj, error):
-        deleted = obj.delete()
-        if deleted[0] != 0:
+    def toggle_recipe_link(self, request, model, id):
+        """Идемпотентно добавляет рецепт в список model или удаляет."""
+        user = request.user
+        if request.method == 'DELETE':
+            if (not remove_link(model, user, 'recipe', id)
+                    and not Recipes.objects.filter(pk=id).exists()):
+                raise Http404
             return Response(status=status.HTTP_204_NO_CONTENT)
-        return Response({'detail': f'{error}'},
-                        status=status.HTTP_400_BAD_REQUEST
-                        )
+        created = add_link(model, user, 'recipe', id)
+        recipe = get_object_or_404(
+            Recipes.objects.only('id', 'name', 'image', 'image_variants',
+                                 'cooking_time'), pk=id)
+        return Response(RecipeReadSerializerForSubscriptions(recipe).data,
+                        status=status.HTTP_201_CREATED if created
+                        else status.HTTP_200_OK)
 
     @action(detail=True, methods=['post', 'delete'],)
     def favorite(self, request, id=None):
         """Добавление/удаление рецепта из избранного."""
-        recipe = get_object_or_404(Recipes, id=id)
-        user = request.user
-
-        favorite = Favorites.objects.filter(user=user, recipe=recipe)
-        data = {'recipe': recipe.id, 'user': user.id}
-        serializer = FavoriteSerializer(data=data,
-                                        context={'request': request})
-
-        if request.method == 'POST':
-            return self.create_favorites_shopping_cart(serializer, recipe)
-        return self.delete_favorites_shopping_cart(
-            favorite, error='Рецепт не в избранном!')
+        return self.toggle_recipe_link(request, Favorites, id)
 
     @action(detail=True, methods=['post', 'delete'],
             permission_classes=[IsAuthenticated])
     def shopping_cart(self, request, id=None):
         """Добавление/удаление рецепта из корзины покупок."""
-        recipe = get_object_or_404(Recipes, id=id)
-        user = request.user
-        recipe_in_cart = ShoppingCart.objects.filter(user=user, recipe=recipe)
-        data = {'recipe': recipe.id, 'user': user.id}
-        serializer = ShoppingCartSerializer(data=data,
-                                            context={'request': request})
+        return self.toggle_recipe_link(request, ShoppingCart, id)
+
+    def toggle_recipes_batch(self, request, model):
+        serializer = RecipeBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = toggle_recipes(model, request.user,
+                                 **serializer.validated_data)
+        return Response({'results': [
+            {'id': recipe_id, 'status': outcome}
+            for recipe_id, outcome in results.items()]})
+
+    @action(detail=False, methods=['post'], url_path='favorite/batch')
+    def favorite_batch(self, request):
+        """Пакетное добавление/удаление рецептов из избранного."""
+        return self.toggle_recipes_batch(request, Favorites)
+
+    @action(detail=False, methods=['post'], url_path='shopping_cart/batch')
+    def shopping_cart_batch(self, request):
+        """Пакетное добавление/удаление рецептов из корзины покупок."""
+        return self.toggle_recipes_batch(request, ShoppingCart)
 
-        if request.method == 'POST':
-            return self.create_favorites_shopping_cart(serializer, recipe)
-        return self.delete_favorites_shopping_cart(
-            recipe_in_cart,
-            error='Рецепт не в корзине!')
-
-    @action(detail=False, methods=['get'])
+    @action(detail=False, methods=['get'],
+            renderer_classes=[ShoppingListHTMLRenderer, PlainTextRenderer,
+                              CSVRenderer, PDFRenderer])
     def download_shopping_cart(self, request):
-        user = request.user
+        """Список покупок в формате из ?format=: html, txt, csv или pdf."""
+        return self.get_conditional_response(self.render_shopping_cart,
+                                             request)
 
-        shopping_cart_recipes = ShoppingCart.objects.filter(user=user)
+    def render_shopping_cart(self, request):
+        user = request.user
+        export_format = request.accepted_renderer.format
+        date = self.get_last_modified() or timezone.now()
+        if export_format != ShoppingListHTMLRenderer.format:
+            version, = self.get_validator_values()
+            return export_shopping_list(user, version, date, export_format,
+                                        request.build_absolute_uri())
 
         shopping_cart_ingredients = (
-            ShoppingCart.objects.filter(user=user).values(
-                name=F('recipe__recipe_ingredients__ingredient_id__name'),
-                unit=F(
-                    'recipe__recipe_ingredients__'
-                    'ingredient_id__measurement_unit'
-                )
-            ).annotate(total_amount=Sum('recipe__recipe_ingredients__amount')
-                       ).order_by('name')
+            ShoppingListItem.objects.filter(user=user).values(
+                'total_amount',
+                name=F('ingredient__name'),
+                unit=F('ingredient__measurement_unit'),
+            ).order_by('name')
         )
 
         context = {
             'ingredients': shopping_cart_ingredients,
             'user': user,
-            'total_recipes': len(shopping_cart_recipes)
+            'total_recipes': ShoppingCart.objects.filter(user=user).count(),
+            'date': date,
         }
 
         return render(request, 'shopping_list.html', context)
 
+    @action(detail=False, methods=['get'],
+            pagination_class=KeysetPagination)
+    def feed(self, request):
+        """Рецепты авторов, на которых подписан пользователь."""
+        page = self.paginate_queryset(Feed(request.user,
+                                           self.get_queryset()))
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['post'], url_path='import',
+            parser_classes=[NDJSONParser, JSONParser])
+    def import_recipes(self, request):
+        """Пакетный импорт рецептов из NDJSON или JSON-массива."""
+        items = request.data
+        if isinstance(items, dict):
+            items = [items]
+        limit = settings.RECIPE_IMPORT_MAX_ITEMS
+        items = list(islice(items, limit + 1))
+        if len(items) > limit:
+            return Response(
+                {'detail': f'Не больше {limit} рецептов за запрос.'},
+                status=status.HTTP_400_BAD_REQUEST)
+        results, seconds = RecipeImporter(
+            request.user, context=self.get_serializer_context()).run(items)
+        created = sum('id' in result for result in results)
+        return Response({
+            'created': created,
+            'failed': len(results) - created,
+            'seconds': round(seconds, 3),
+            'recipes_per_second': round(created / max(seconds, 1e-6), 1),
+            'results': results,
+        }, status=status.HTTP_201_CREATED if created
+            else status.HTTP_400_BAD_REQUEST)
+
+    def get_requested_ids(self):
+        """id рецептов из ?ids=1,2,3 без повторов, в порядке запроса."""
+        if not hasattr(self, '_requested_ids'):
+            values = ','.join(self.request.query_params.getlist('ids'))
+            try:
+                ids = [int(value) for value in values.split(',')
+                       if value.strip()]
+            except ValueError:
+                raise ValidationError(
+                    {'ids': 'Ожидается список id через запятую.'})
+            ids = list(dict.fromkeys(ids))
+            if not ids:
+                raise ValidationError({'ids': 'Нужно передать id рецептов.'})
+            if len(ids) > RECIPE_MULTI_GET_MAX_IDS:
+                raise ValidationError(
+                    {'ids': f'Не больше {RECIPE_MULTI_GET_MAX_IDS} рецептов '
+                            f'за запрос.'})
+            self._requested_ids = ids
+        return self._requested_ids
+
+    @action(detail=False, methods=['get'])
+    def bulk(self, request):
+        """Рецепты по списку ?ids= в порядке запроса одним ответом."""
+        return self.get_conditional_response(self.render_bulk, request)
+
+    def render_bulk(self, request):
+        ids = self.get_requested_ids()
+        recipes = self.get_queryset().in_bulk(ids)
+        serializer = self.get_serializer(
+            [recipes[pk] for pk in ids if pk in recipes], many=True)
+        return Response({
+            'results': serializer.data,
+            'missing': [pk for pk in ids if pk not in recipes],
+        })
+
+    @action(detail=True, methods=['put'],
+            parser_classes=[ImageMultiPartParser, ImageUploadParser])
+    def image(self, request, id=None):
+        """Замена изображения рецепта файлом без base64."""
+        recipe = self.get_object()
+        serializer = RecipeImageSerializer(
+            recipe, data=upload_data(request, 'image'),
+            context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['get'], url_path='get-link')
     def get_short_link(self, request, id=None):
         """Получить короткую ссылку для конкретного рецепта."""
         recipe = get_object_or_404(Recipes, id=id)
+        code = recipe.short_url or encode_short_code(recipe.pk)
         return Response({
-            'short-link': request.build_absolute_uri(f'/s/{recipe.short_url}/')
+            'short-link': request.build_absolute_uri(f'/s/{code}/')
         })
 
 
-class TagViewset(viewsets.ModelViewSet):
+class CatalogueViewSet(ConditionalGetMixin, CatalogueMixin,
+                       viewsets.ModelViewSet):
+    """Базовый вьюсет справочников из памяти с условными GET-запросами."""
+
+    public_max_age = settings.CATALOGUE_HTTP_MAX_AGE
+
+    def get_validator_values(self):
+        return [catalogue.get_version()]
+
+
+class TagViewset(CatalogueViewSet):
+    catalogue_name = 'tags'
     queryset = Tags.objects.all()
     permission_classes = [AllowAny]
     serializer_class = TagsReadSerializer
@@ -156,7 +318,9 @@ class TagViewset(viewsets.ModelViewSet):
     http_method_names = ['get']
 
 
-class IngredientViewset(viewsets.ModelViewSet):
+class IngredientViewset(CatalogueViewSet):
+    catalogue_name = 'ingredients'
+    catalogue_search_param = 'name'
     queryset = Ingredients.objects.all()
     permission_classes = [AllowAny, ]
     serializer_class = IngredientsSerializer
@@ -172,8 +336,19 @@ class UserViewset(DjoserUserViewSet):
     pagination_class = PageLimitPagination
     lookup_field = 'id'
 
+    def get_queryset(self):
+        """Пользователи с is_subscribed одним запросом на страницу."""
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            user = self.request.user
+            queryset = annotate_user_flag(
+                queryset, 'is_subscribed',
+                Follow.objects.filter(user=user.pk, following=OuterRef('pk')),
+                user)
+        return queryset
+
     def get_permissions(self):
-        if self.action in ['update', 'partial_update', 'destroy']:
+        if self.action in ['update', 'partial_update', 'destroy', 'image']:
             return [CurrentUserOrAdmin()]
         elif self.action in ['subscribe', 'get_subscriptions', 'avatar', 'me']:
             return [IsAuthenticated()]
@@ -194,30 +369,28 @@ class UserViewset(DjoserUserViewSet):
                 {'ошибка': 'Пользователь не авторизован'},
                 status=status.HTTP_401_UNAUTHORIZED)
 
-        follow_user = get_object_or_404(User, id=id)
         user = request.user
-        subscription = user.follower.filter(following=follow_user)
-        data = {'user': user.id, 'following': follow_user.id}
-        query_params = request.query_params.get('recipes_limit')
-        serializer = FollowSerializer(data=data)
-
-        if request.method == 'POST':
-            serializer_read = UserGetSerializerFollow(
-                follow_user,
-                context={'recipes_limit': query_params})
-            if serializer.is_valid():
-                serializer.save()
-                return Response(serializer_read.data,
-                                status=status.HTTP_201_CREATED)
+        if str(user.pk) == str(id):
             return Response(
-                serializer.errors,
+                {'detail': 'Нельзя подписаться на самого себя!'},
                 status=status.HTTP_400_BAD_REQUEST)
-
-        deleted = subscription.delete()
-        if deleted[0] != 0:
+        if request.method == 'DELETE':
+            if (not remove_link(Follow, user, 'following', id)
+                    and not User.objects.filter(pk=id).exists()):
+                raise Http404
             return Response(status=status.HTTP_204_NO_CONTENT)
-        return Response({'detail': 'Пользователь не в подписках!'},
-                        status=status.HTTP_400_BAD_REQUEST)
+        created = add_link(Follow, user, 'following', id)
+        recipes_limit = request.query_params.get('recipes_limit')
+        # Подписку могли тут же отменить параллельным запросом.
+        following = (get_subscriptions_queryset(
+            user, parse_recipes_limit(recipes_limit)).filter(pk=id).first()
+            or get_object_or_404(User, pk=id))
+        return Response(
+            UserGetSerializerFollow(following, context={
+                **self.get_serializer_context(),
+                'recipes_limit': recipes_limit}).data,
+            status=status.HTTP_201_CREATED if created
+            else status.HTTP_200_OK)
 
     @action(detail=False, methods=['get'],
             permission_classes=[IsAuthenticated],
@@ -226,42 +399,55 @@ class UserViewset(DjoserUserViewSet):
             )
     def get_subscriptions(self, request):
         """Список подписок текущего пользователя."""
-        user = request.user
-        subscriptions = user.follower.all()
-        subscribed_users = [item.following for item in subscriptions]
-        query_params = request.query_params.get('recipes_limit')
-
-        paginated_subscribed_users = self.paginate_queryset(subscribed_users)
-        if paginated_subscribed_users is not None:
-            serializer = SubscriptionSerializer(
-                paginated_subscribed_users,
-                many=True,
-                context={'recipes_limit': query_params})
-
-            return self.get_paginated_response(serializer.data)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        queryset = get_subscriptions_queryset(
+            request.user,
+            parse_recipes_limit(request.query_params.get('recipes_limit')))
+        page = self.paginate_queryset(queryset)
+        serializer = UserGetSerializerFollow(
+            queryset if page is None else page, many=True,
+            context=self.get_serializer_context())
+        if page is None:
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.get_paginated_response(serializer.data)
 
     @action(detail=False, url_path='me/avatar', methods=['put', 'delete'],
-            permission_classes=[IsAuthenticated])
+            permission_classes=[IsAuthenticated],
+            parser_classes=[JSONParser, ImageMultiPartParser,
+                            ImageUploadParser])
     def avatar(self, request):
         """Обновление и удаление аватара текущего пользователя."""
         user = request.user
-        serializer = AvatarUpdateSerializer(user, data=request.data)
-        if request.method == 'PUT' and serializer.is_valid():
+        serializer = AvatarUpdateSerializer(
+            user, data=upload_data(request, 'avatar'))
+        if request.method == 'PUT':
+            serializer.is_valid(raise_exception=True)
             serializer.save()
             return Response(serializer.data, status=status.HTTP_200_OK)
         if user.avatar:
-            user.avatar.delete()
-            user.avatar = None
-            user.save()
+            replace_image(user, None)
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response({'detail': 'Аватар не найден!'},
                         status=status.HTTP_400_BAD_REQUEST)
 
 
+def upload_data(request, field):
+    """Данные запроса, где файл из «сырого» тела назван field."""
+    if request.method == 'DELETE':
+        return {}
+    if 'file' in request.FILES and field not in request.data:
+        return {field: request.FILES['file']}
+    return request.data
+
+
 def redirect_short_link(request, code):
     if request.method == 'GET':
-        recipe = get_object_or_404(Recipes, short_url=code)
-        return redirect(request.build_absolute_uri(f'/recipes/{recipe.id}'))
+        recipe_id = resolve_short_code(code)
+        if recipe_id is None:
+            raise Http404
+        return redirect(request.build_absolute_uri(f'/recipes/{recipe_id}'))
     return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+def metrics(request):
+    """Метрики API в текстовом формате Prometheus."""
+    return HttpResponse(render_metrics(), content_type=METRICS_CONTENT_TYPE)
@@ -12,3 +12,13 @@ MAX_EMAIL_LENGTH = 254
 MIN_COOKING_TIME_VALUE = 1
 MIN_VALUE_INGREDIENT = 1
 SHORT_CODE_LENGTH = 6
+SHORT_CODE_ID_BITS = 40
+SHORT_CODE_ID_LENGTH = 7
+SINGLE_FLIGHT_LOCK_TIMEOUT = 10
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+SINGLE_FLIGHT_WAIT_TIMEOUT = 2
+IMPORT_BATCH_SIZE = 5000
+IMPORT_READ_CHUNK_SIZE = 65536
+RECIPE_IMPORT_BATCH_SIZE = 200
+RECIPE_BATCH_MAX_IDS = 500
+RECIPE_MULTI_GET_MAX_IDS = 100
@@ -57,6 +57,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
+    'api.instrumentation.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -112,6 +114,22 @@ DATABASES = {
 # }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Версии данных, по которым строятся ключи кеша и ETag, хранятся в базе,
+# поэтому подходит и кеш в памяти процесса. Общий бэкенд, например
+# django.core.cache.backends.filebased.FileBasedCache, избавляет
+# воркеры gunicorn от повторной сборки одних и тех же ответов.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND',
+                             'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'foodgram'),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -178,6 +196,16 @@ MEDIA_URL = '/media/'
 
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Медиа хранятся под именами по хешу содержимого, см. recipes/storage.py.
+STORAGES = {
+    'default': {
+        'BACKEND': 'recipes.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
 DJOSER = {
     'LOGIN_FIELD': 'email',
     'HIDE_USERS': False,
@@ -203,3 +231,85 @@ DJOSER = {
         'token_destroy': ['rest_framework.permissions.IsAuthenticated']
     }
 }
+
+# Кеширование и оценка количества записей при пагинации.
+COUNT_CACHE_TIMEOUT = int(os.getenv('COUNT_CACHE_TIMEOUT', 60))
+COUNT_ESTIMATE_THRESHOLD = int(os.getenv('COUNT_ESTIMATE_THRESHOLD', 100000))
+
+# Время жизни кеша ответов для анонимных пользователей.
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', 300))
+
+# Время жизни кеша публичной части рецептов (ключ содержит версию рецепта).
+FRAGMENT_CACHE_TIMEOUT = int(os.getenv('FRAGMENT_CACHE_TIMEOUT', 3600))
+
+# max-age в Cache-Control публичных ответов для nginx и клиентов.
+RECIPES_HTTP_MAX_AGE = int(os.getenv('RECIPES_HTTP_MAX_AGE', 30))
+CATALOGUE_HTTP_MAX_AGE = int(os.getenv('CATALOGUE_HTTP_MAX_AGE', 300))
+
+# Как часто воркер сверяет версию справочников в памяти с базой, секунд.
+CATALOGUE_CHECK_INTERVAL = float(os.getenv('CATALOGUE_CHECK_INTERVAL', 5))
+
+# Выгрузка списка покупок.
+EXPORT_CHUNK_SIZE = 500
+EXPORT_CACHE_TIMEOUT = int(os.getenv('EXPORT_CACHE_TIMEOUT', 3600))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv('EXPORT_CACHE_MAX_BYTES', 1048576))
+PDF_FONT_PATH = os.getenv('PDF_FONT_PATH',
+                          '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', 2))
+PDF_RENDER_QUEUE_SIZE = int(os.getenv('PDF_RENDER_QUEUE_SIZE', 8))
+PDF_RETRY_AFTER = 2
+
+# Короткие ссылки. Смена SHORT_CODE_SECRET делает выданные коды
+# нового формата недействительными.
+SHORT_CODE_SECRET = os.getenv('SHORT_CODE_SECRET', '')
+SHORT_LINK_LRU_SIZE = int(os.getenv('SHORT_LINK_LRU_SIZE', 10000))
+SHORT_LINK_CACHE_TIMEOUT = int(os.getenv('SHORT_LINK_CACHE_TIMEOUT', 86400))
+SHORT_LINK_MISS_CACHE_TIMEOUT = int(
+    os.getenv('SHORT_LINK_MISS_CACHE_TIMEOUT', 60))
+
+# Загрузка изображений: multipart и «сырое» тело пишутся на диск кусками,
+# лимиты проверяют парсеры из api.uploads до чтения файла целиком.
+IMAGE_MAX_UPLOAD_SIZE = int(os.getenv('IMAGE_MAX_UPLOAD_SIZE', 10485760))
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 8000))
+
+# Уменьшенные копии изображений для карточек.
+IMAGE_DERIVATIVE_WIDTHS = [320, 640, 1280]
+IMAGE_DERIVATIVE_FORMATS = ['avif', 'webp', 'jpeg']
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv('IMAGE_DERIVATIVE_WORKERS', 2))
+
+# Лента подписок: у авторов с таким числом подписчиков рецепты не
+# раскладываются по лентам, а подмешиваются при чтении.
+FEED_FANOUT_MAX_FOLLOWERS = int(os.getenv('FEED_FANOUT_MAX_FOLLOWERS', 10000))
+FEED_FANOUT_CHUNK_SIZE = 1000
+FEED_FANOUT_WORKERS = int(os.getenv('FEED_FANOUT_WORKERS', 2))
+FEED_FANOUT_CACHE_TIMEOUT = 60
+FEED_BACKFILL_SIZE = 50
+
+# Проверять id тегов и ингредиентов рецепта по справочникам в памяти
+# воркера без запросов к базе. Справочник может отставать от базы на
+# CATALOGUE_CHECK_INTERVAL.
+VALIDATE_PKS_FROM_CATALOGUE = (
+    os.getenv('VALIDATE_PKS_FROM_CATALOGUE', 'False').lower() == 'true')
+
+# Пакетный импорт рецептов: каталог, от которого считаются пути к
+# изображениям, и предел числа рецептов в одном запросе к API.
+RECIPE_IMPORT_IMAGE_ROOT = os.getenv('RECIPE_IMPORT_IMAGE_ROOT',
+                                     BASE_DIR / 'data' / 'images')
+RECIPE_IMPORT_MAX_ITEMS = int(os.getenv('RECIPE_IMPORT_MAX_ITEMS', 1000))
+
+# Учет SQL по запросам: доля запросов с заголовком Server-Timing, порог
+# медленного запроса в мс и число одинаковых SQL, считающееся N+1.
+SQL_INSTRUMENTATION_SAMPLE_RATE = float(
+    os.getenv('SQL_INSTRUMENTATION_SAMPLE_RATE', 0.1))
+SQL_SLOW_REQUEST_MS = float(os.getenv('SQL_SLOW_REQUEST_MS', 500))
+SQL_DUPLICATE_QUERY_THRESHOLD = int(
+    os.getenv('SQL_DUPLICATE_QUERY_THRESHOLD', 5))
+
+# Метрики /metrics: каталог снимков процессов для нескольких воркеров
+# gunicorn (очищается при запуске хуком в gunicorn.conf.py, без gunicorn -
+# вручную), период записи снимка в секундах и границы корзин гистограммы
+# длительности запросов.
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                           2.5, 5, 10)
@@ -18,10 +18,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
-from api.views import redirect_short_link
+from api.views import metrics, redirect_short_link
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
     path('s/<slug:code>/', redirect_short_link, name='short_link_redirect'),
+    path('metrics', metrics, name='metrics'),
 ]
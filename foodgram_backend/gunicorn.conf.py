@@ -0,0 +1,88 @@
+"""Настройки gunicorn: каталог снимков метрик /metrics.
+
+gunicorn читает этот файл из рабочего каталога сам. Если задан
+METRICS_MULTIPROC_DIR, при запуске из каталога удаляются снимки прошлых
+запусков, а счетчики завершившегося воркера прибавляются к накопленному
+снимку exited.json, и снимок воркера удаляется: файлов не больше, чем
+воркеров, а запросы в обработке завершившихся воркеров не учитываются.
+
+Мастер gunicorn не загружает Django, поэтому снимки здесь сливаются
+без api.metrics.
+"""
+import json
+import os
+from pathlib import Path
+
+METRICS_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+# Имя накопленного снимка, см. api.metrics.EXITED_NAME.
+EXITED_NAME = 'exited.json'
+# Сколько последних слитых воркеров помнить: /metrics пропускает их
+# снимки, если прочитал их до удаления.
+MERGED_KEEP = 64
+
+
+def on_starting(server):
+    if not METRICS_DIR:
+        return
+    directory = Path(METRICS_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    for path in directory.iterdir():
+        if path.suffix in ('.json', '.tmp'):
+            path.unlink()
+
+
+def worker_exit(server, worker):
+    """Последний снимок воркера перед выходом."""
+    if METRICS_DIR:
+        from api.metrics import registry
+
+        registry.flush(METRICS_DIR, force=True)
+
+
+def add_rows(total, rows):
+    """Складывает строки [*метки, значение]; значение - число или список
+    корзин гистограммы."""
+    index = {tuple(row[:-1]): row for row in total}
+    for row in rows:
+        key, value = tuple(row[:-1]), row[-1]
+        if key not in index:
+            index[key] = [*key, value]
+            total.append(index[key])
+        elif isinstance(value, list):
+            index[key][-1] = [a + b for a, b in zip(index[key][-1], value)]
+        else:
+            index[key][-1] += value
+
+
+def accumulate(total, snapshot):
+    """Прибавляет счетчики снимка воркера к накопленному снимку."""
+    for name in ('durations', 'responses', 'queries'):
+        add_rows(total[name], snapshot[name])
+    for name, stats in snapshot['cache'].items():
+        cache_stats = total['cache'].setdefault(name, {})
+        for result, value in stats.items():
+            cache_stats[result] = cache_stats.get(result, 0) + value
+    total['merged'] = (total['merged']
+                       + [snapshot['process']])[-MERGED_KEEP:]
+
+
+def child_exit(server, worker):
+    if not METRICS_DIR:
+        return
+    directory = Path(METRICS_DIR)
+    path = directory / f'{worker.pid}.json'
+    exited = directory / EXITED_NAME
+    try:
+        snapshot = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return
+    try:
+        total = json.loads(exited.read_text())
+    except (OSError, ValueError):
+        total = {'in_flight': 0, 'durations': [], 'responses': [],
+                 'queries': [], 'cache': {}, 'merged': []}
+    accumulate(total, snapshot)
+    temporary = exited.with_suffix('.tmp')
+    temporary.write_text(json.dumps(total))
+    os.replace(temporary, exited)
+    path.unlink()
@@ -0,0 +1,210 @@
+"""Пакетный импорт справочников из CSV и JSON.
+
+Строки читаются потоком и пишутся пачками внутри одной транзакции с
+upsert по уникальным полям, так что повторный импорт того же файла
+ничего не ломает. На PostgreSQL пачки загружаются через COPY во
+временную таблицу и переносятся одним INSERT ... ON CONFLICT.
+"""
+import csv
+import io
+import json
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connections, transaction
+
+from constants import IMPORT_BATCH_SIZE, IMPORT_READ_CHUNK_SIZE
+
+from .models import Ingredients, Tags
+from .signals import catalogue_imported
+
+
+def iter_json_array(file, chunk_size=IMPORT_READ_CHUNK_SIZE):
+    """Объекты JSON-массива верхнего уровня по одному, без чтения файла
+    целиком."""
+    decoder = json.JSONDecoder()
+    buffer, position, started, finished = '', 0, False, False
+    eof = False
+    while not finished:
+        if not eof:
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Ожидается JSON-массив объектов.')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                finished = True
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                break
+            yield item
+        if eof and not finished:
+            raise ValueError('Неожиданный конец JSON-файла.')
+
+
+def read_rows(path, file_format=None):
+    """Строки файла CSV или JSON в виде словарей."""
+    file_format = file_format or path.rsplit('.', 1)[-1].lower()
+    with open(path, encoding='utf-8', newline='') as file:
+        if file_format == 'csv':
+            yield from csv.DictReader(file)
+        elif file_format == 'json':
+            yield from iter_json_array(file)
+        else:
+            raise ValueError(f'Неизвестный формат файла: {file_format}')
+
+
+class CatalogueImporter:
+    """Импорт справочника model с upsert по unique_fields."""
+
+    def __init__(self, model, fields, unique_fields, update_fields=()):
+        self.model = model
+        self.fields = fields
+        self.unique_fields = unique_fields
+        self.update_fields = update_fields
+
+    def clean(self, row):
+        return tuple(str(row[field]).strip() for field in self.fields)
+
+    def run(self, rows, batch_size=IMPORT_BATCH_SIZE, using='default'):
+        """Импортирует rows, возвращает (число строк, секунды)."""
+        started = time.perf_counter()
+        rows = (self.clean(row) for row in rows)
+        total = 0
+        connection = connections[using]
+        with transaction.atomic(using=using):
+            if connection.vendor == 'postgresql':
+                total = self.copy(rows, batch_size, connection)
+            else:
+                for batch in self.batches(rows, batch_size):
+                    self.bulk_upsert(batch, using)
+                    total += len(batch)
+            transaction.on_commit(
+                lambda: catalogue_imported.send(
+                    sender=self.model, updated=bool(self.update_fields)),
+                using=using)
+        return total, time.perf_counter() - started
+
+    @staticmethod
+    def batches(rows, batch_size):
+        rows = iter(rows)
+        while batch := list(islice(rows, batch_size)):
+            yield batch
+
+    def bulk_upsert(self, batch, using):
+        unique = {}
+        for values in batch:
+            row = dict(zip(self.fields, values))
+            unique[tuple(row[field] for field in self.unique_fields)] = row
+        objects = [self.model(**row) for row in unique.values()]
+        if self.update_fields:
+            self.model.objects.using(using).bulk_create(
+                objects, update_conflicts=True,
+                unique_fields=self.unique_fields,
+                update_fields=self.update_fields)
+        else:
+            self.model.objects.using(using).bulk_create(
+                objects, ignore_conflicts=True)
+
+    def copy(self, rows, batch_size, connection):
+        """COPY во временную таблицу и один INSERT ... ON CONFLICT."""
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        columns = ', '.join(
+            quote(self.model._meta.get_field(field).column)
+            for field in self.fields)
+        unique = ', '.join(
+            quote(self.model._meta.get_field(field).column)
+            for field in self.unique_fields)
+        if self.update_fields:
+            on_conflict = 'DO UPDATE SET ' + ', '.join(
+                f'{column} = EXCLUDED.{column}'
+                for column in (quote(self.model._meta.get_field(field).column)
+                               for field in self.update_fields))
+        else:
+            on_conflict = 'DO NOTHING'
+        total = 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE import_staging ON COMMIT DROP AS '
+                f'SELECT {columns} FROM {table} WITH NO DATA')
+            for batch in self.batches(rows, batch_size):
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(batch)
+                buffer.seek(0)
+                # Без FORCE_NOT_NULL пустая строка из csv.writer стала
+                # бы NULL.
+                self.copy_from(cursor, f'COPY import_staging ({columns}) '
+                               f'FROM STDIN WITH (FORMAT csv, '
+                               f'FORCE_NOT_NULL ({columns}))', buffer)
+                total += len(batch)
+            cursor.execute(
+                f'INSERT INTO {table} ({columns}) '
+                f'SELECT DISTINCT ON ({unique}) {columns} '
+                f'FROM import_staging '
+                f'ON CONFLICT ({unique}) {on_conflict}')
+        return total
+
+    @staticmethod
+    def copy_from(cursor, sql, buffer):
+        raw_cursor = cursor.cursor
+        if hasattr(raw_cursor, 'copy_expert'):
+            raw_cursor.copy_expert(sql, buffer)
+        else:
+            with raw_cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+
+
+ingredients_importer = CatalogueImporter(
+    Ingredients, fields=('name', 'measurement_unit'),
+    unique_fields=('name', 'measurement_unit'))
+tags_importer = CatalogueImporter(
+    Tags, fields=('name', 'slug'), unique_fields=('slug',),
+    update_fields=('name',))
+
+
+class ImportCommand(BaseCommand):
+    """Команда импорта справочника из файла CSV или JSON."""
+
+    importer = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', type=str,
+                            help='Путь к файлу CSV или JSON')
+        parser.add_argument('--format', choices=('csv', 'json'),
+                            help='Формат файла, по умолчанию по расширению')
+        parser.add_argument('--batch-size', type=int,
+                            default=IMPORT_BATCH_SIZE,
+                            help='Размер пачки записей')
+
+    def handle(self, *args, **options):
+        path = options['csv_file']
+        try:
+            total, seconds = self.importer.run(
+                read_rows(path, options['format']),
+                batch_size=options['batch_size'])
+        except (OSError, ValueError, KeyError) as error:
+            raise CommandError(f'Ошибка импорта из {path}: {error!r}')
+        except IntegrityError as error:
+            # Например, тег с новым slug и уже занятым name.
+            raise CommandError(
+                f'Импорт из {path} отменен, данные противоречат '
+                f'уже сохраненным: {error}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Импорт из {path} произведен: {total} строк за '
+            f'{seconds:.2f} с ({total / max(seconds, 1e-6):.0f} строк/с).'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes import shopping_list
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает агрегаты списков покупок или сверяет их '
+            'с корзинами')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append',
+                            dest='user_ids',
+                            help='Только для пользователя с этим id')
+        parser.add_argument('--verify', action='store_true',
+                            help='Только сравнить, ничего не меняя')
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+        if not options['verify']:
+            shopping_list.rebuild(user_ids)
+            self.stdout.write(self.style.SUCCESS(
+                'Списки покупок пересчитаны.'))
+            return
+
+        expected = shopping_list.compute(user_ids)
+        actual = shopping_list.read(user_ids)
+        mismatched = sorted(
+            user_id for user_id in expected.keys() | actual.keys()
+            if expected.get(user_id, {}) != actual.get(user_id, {}))
+        for user_id in mismatched:
+            self.stdout.write(f'Расхождение у пользователя {user_id}')
+        if mismatched:
+            raise CommandError(f'Расхождений: {len(mismatched)}')
+        self.stdout.write(self.style.SUCCESS(
+            'Списки покупок совпадают с корзинами.'))
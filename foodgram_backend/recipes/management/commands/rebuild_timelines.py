@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from recipes import timeline
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает ленты подписок по текущим подпискам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append',
+                            dest='user_ids',
+                            help='Только для пользователя с этим id')
+
+    def handle(self, *args, **options):
+        timeline.rebuild(options['user_ids'])
+        self.stdout.write(self.style.SUCCESS('Ленты подписок пересобраны.'))
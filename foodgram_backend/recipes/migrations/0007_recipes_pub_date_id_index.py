@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 04:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_alter_favorites_options_alter_recipes_options_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='recipes',
+            options={'default_related_name': 'recipes', 'ordering': ['-pub_date', '-id'], 'verbose_name': 'Рецепт', 'verbose_name_plural': 'Рецепты'},
+        ),
+        migrations.AddIndex(
+            model_name='recipes',
+            index=models.Index(fields=['-pub_date', '-id'], name='recipes_pub_date_id_idx'),
+        ),
+    ]
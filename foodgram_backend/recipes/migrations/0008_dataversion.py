@@ -0,0 +1,35 @@
+# Generated by Django 5.2.5 on 2026-10-18 04:59
+
+import time
+
+from django.db import migrations, models
+
+
+def create_catalogue_version(apps, schema_editor):
+    DataVersion = apps.get_model('recipes', 'DataVersion')
+    DataVersion.objects.get_or_create(
+        name='catalogue', defaults={'version': time.time_ns() // 1000})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_recipes_pub_date_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(unique=True, verbose_name='Данные')),
+                ('version', models.PositiveBigIntegerField(default=0, verbose_name='Версия')),
+            ],
+            options={
+                'verbose_name': 'Версия данных',
+                'verbose_name_plural': 'Версии данных',
+            },
+        ),
+        migrations.RunPython(create_catalogue_version,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.5 on 2026-10-18 05:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+
+
+def fill_shopping_lists(apps, schema_editor):
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    ShoppingListItem = apps.get_model('recipes', 'ShoppingListItem')
+    rows = ShoppingCart.objects.filter(
+        recipe__recipe_ingredients__isnull=False
+    ).values(
+        'user_id',
+        ingredient_id=F('recipe__recipe_ingredients__ingredient_id'),
+    ).annotate(
+        total_amount=Sum('recipe__recipe_ingredients__amount'),
+        recipe_count=Count('recipe'),
+    ).order_by()
+    ShoppingListItem.objects.bulk_create(
+        (ShoppingListItem(**row) for row in rows), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_dataversion'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_amount', models.BigIntegerField(default=0, verbose_name='Общее количество')),
+                ('recipe_count', models.IntegerField(default=0, verbose_name='Число рецептов')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recipes.ingredients', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Ингредиент в списке покупок',
+                'verbose_name_plural': 'Список покупок',
+                'ordering': ['user'],
+                'default_related_name': 'shopping_list_items',
+                'unique_together': {('user', 'ingredient')},
+            },
+        ),
+        migrations.RunPython(fill_shopping_lists, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.5 on 2026-10-18 05:27
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, F, Min, Sum
+
+
+def delete_duplicates(model):
+    """Удаляет повторы (user, recipe), оставляя первую запись.
+
+    Возвращает пользователей, у которых были повторы.
+    """
+    duplicates = model.objects.values('user_id', 'recipe_id').annotate(
+        first=Min('pk'), count=Count('pk')).filter(count__gt=1).order_by()
+    user_ids = set()
+    for row in duplicates:
+        model.objects.filter(
+            user_id=row['user_id'], recipe_id=row['recipe_id']).exclude(
+                pk=row['first']).delete()
+        user_ids.add(row['user_id'])
+    return user_ids
+
+
+def deduplicate(apps, schema_editor):
+    Favorites = apps.get_model('recipes', 'Favorites')
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    ShoppingListItem = apps.get_model('recipes', 'ShoppingListItem')
+    delete_duplicates(Favorites)
+    user_ids = delete_duplicates(ShoppingCart)
+    if not user_ids:
+        return
+    # Повторы в корзине учитывались в списке покупок дважды.
+    ShoppingListItem.objects.filter(user_id__in=user_ids).delete()
+    rows = ShoppingCart.objects.filter(
+        user_id__in=user_ids, recipe__recipe_ingredients__isnull=False
+    ).values(
+        'user_id',
+        ingredient_id=F('recipe__recipe_ingredients__ingredient_id'),
+    ).annotate(
+        total_amount=Sum('recipe__recipe_ingredients__amount'),
+        recipe_count=Count('recipe'),
+    ).order_by()
+    ShoppingListItem.objects.bulk_create(
+        (ShoppingListItem(**row) for row in rows), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_timelineentry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='favorites',
+            options={'default_related_name': 'favorites', 'ordering': ['user'], 'verbose_name': 'Рецепт в избранном', 'verbose_name_plural': 'Избранные рецепты'},
+        ),
+        migrations.AlterModelOptions(
+            name='shoppingcart',
+            options={'default_related_name': 'shopping_cart', 'ordering': ['user'], 'verbose_name': 'Корзина для покупок', 'verbose_name_plural': 'Корзина для покупок'},
+        ),
+        migrations.RunPython(deduplicate, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='favorites',
+            unique_together={('user', 'recipe')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='shoppingcart',
+            unique_together={('user', 'recipe')},
+        ),
+    ]
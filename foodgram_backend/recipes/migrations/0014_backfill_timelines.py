@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_timelines(apps, schema_editor):
+    """Раскладывает последние рецепты авторов по лентам подписчиков.
+
+    То же, что rebuild_timelines: без этого ленты, созданные миграцией
+    0012, пусты для подписок, оформленных до нее.
+    """
+    Follow = apps.get_model('users', 'Follow')
+    Recipes = apps.get_model('recipes', 'Recipes')
+    TimelineEntry = apps.get_model('recipes', 'TimelineEntry')
+    author_ids = list(Follow.objects.values('following').annotate(
+        followers=Count('pk')).filter(
+            followers__lt=settings.FEED_FANOUT_MAX_FOLLOWERS
+    ).values_list('following', flat=True).order_by())
+    for author_id in author_ids:
+        recipes = list(Recipes.objects.filter(author=author_id).order_by(
+            '-pub_date', '-id').values_list(
+                'pk', 'pub_date')[:settings.FEED_BACKFILL_SIZE])
+        follower_ids = list(Follow.objects.filter(
+            following=author_id).values_list('user_id', flat=True))
+        TimelineEntry.objects.bulk_create(
+            (TimelineEntry(user_id=user_id, recipe_id=recipe_id,
+                           author_id=author_id, pub_date=pub_date)
+             for user_id in follower_ids
+             for recipe_id, pub_date in recipes),
+            batch_size=settings.FEED_FANOUT_CHUNK_SIZE,
+            ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_favorites_shoppingcart_unique'),
+        ('users', '0006_user_avatar_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_timelines, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,9 @@
+import time
+
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.functions import Greatest
 
 from constants import (MAX_LENGTH_INGREDIENT_NAME,
                        MAX_LENGTH_MEAS_UNIT_INGREDIENT, MAX_LENGTH_RECIPE_NAME,
@@ -35,6 +38,9 @@ class Recipes(models.Model):
                                          verbose_name='Ингредиенты')
     image = models.ImageField(upload_to='recipes/images/',
                               verbose_name='Изображение блюда')
+    image_variants = models.JSONField(default=dict, blank=True,
+                                      editable=False,
+                                      verbose_name='Копии изображения')
     pub_date = models.DateTimeField(auto_now_add=True,
                                     verbose_name='Дата публикации')
     original_url = models.URLField(unique=True, null=True, blank=True)
@@ -42,7 +48,13 @@ class Recipes(models.Model):
                                  verbose_name='Слаг для прямой ссылки')
 
     class Meta:
-        ordering = ['-pub_date']
+        ordering = ['-pub_date', '-id']
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='recipes_pub_date_id_idx'),
+            models.Index(fields=['author', '-pub_date', '-id'],
+                         name='recipes_author_pub_date_idx'),
+        ]
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         default_related_name = 'recipes'
@@ -129,7 +141,7 @@ class FavoriteShoppingCartBaseModel(models.Model):
 class Favorites(FavoriteShoppingCartBaseModel):
     """Модель для рецептов в избранном."""
 
-    class Meta:
+    class Meta(FavoriteShoppingCartBaseModel.Meta):
         verbose_name = 'Рецепт в избранном'
         verbose_name_plural = 'Избранные рецепты'
         default_related_name = 'favorites'
@@ -138,7 +150,124 @@ class Favorites(FavoriteShoppingCartBaseModel):
 class ShoppingCart(FavoriteShoppingCartBaseModel):
     """Модель для списка покупок."""
 
-    class Meta:
+    class Meta(FavoriteShoppingCartBaseModel.Meta):
         verbose_name = 'Корзина для покупок'
         verbose_name_plural = 'Корзина для покупок'
         default_related_name = 'shopping_cart'
+
+
+class ShoppingListItem(models.Model):
+    """Сумма ингредиента по рецептам в корзине пользователя.
+
+    Поддерживается при изменении корзины и ингредиентов рецептов,
+    см. recipes.shopping_list.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             verbose_name='Пользователь')
+    ingredient = models.ForeignKey(Ingredients, on_delete=models.CASCADE,
+                                   verbose_name='Ингредиент')
+    total_amount = models.BigIntegerField(default=0,
+                                          verbose_name='Общее количество')
+    recipe_count = models.IntegerField(default=0,
+                                       verbose_name='Число рецептов')
+
+    class Meta:
+        ordering = ['user']
+        verbose_name = 'Ингредиент в списке покупок'
+        verbose_name_plural = 'Список покупок'
+        default_related_name = 'shopping_list_items'
+        unique_together = ['user', 'ingredient']
+
+    def __str__(self):
+        return f'{self.user}, {self.ingredient}: {self.total_amount}'
+
+
+class TimelineEntry(models.Model):
+    """Рецепт в ленте подписок пользователя.
+
+    Записи раскладываются при публикации рецепта, см. recipes.timeline.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             verbose_name='Пользователь')
+    recipe = models.ForeignKey(Recipes, on_delete=models.CASCADE,
+                               verbose_name='Рецепт')
+    author = models.ForeignKey(User, on_delete=models.CASCADE,
+                               related_name='+',
+                               verbose_name='Автор рецепта')
+    pub_date = models.DateTimeField(verbose_name='Дата публикации')
+
+    class Meta:
+        ordering = ['user', '-pub_date', '-recipe']
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+        default_related_name = 'timeline_entries'
+        unique_together = ['user', 'recipe']
+        indexes = [
+            models.Index(fields=['user', '-pub_date', '-recipe'],
+                         name='timeline_user_pub_date_idx'),
+            models.Index(fields=['user', 'author'],
+                         name='timeline_user_author_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.recipe_id}'
+
+
+class DataVersion(models.Model):
+    """Версия данных для перезагрузки кешей в воркерах.
+
+    Значение - время последнего изменения в микросекундах.
+    """
+
+    name = models.SlugField(unique=True, verbose_name='Данные')
+    version = models.PositiveBigIntegerField(default=0,
+                                             verbose_name='Версия')
+
+    class Meta:
+        verbose_name = 'Версия данных'
+        verbose_name_plural = 'Версии данных'
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
+
+    @classmethod
+    def get_version(cls, name):
+        return cls.get_versions([name])[name]
+
+    @classmethod
+    def get_versions(cls, names):
+        """Версии по именам за один запрос; 0 - данные еще не менялись."""
+        versions = dict(cls.objects.filter(name__in=set(names)).values_list(
+            'name', 'version'))
+        return {name: versions.get(name, 0) for name in names}
+
+    @classmethod
+    def bump(cls, *names):
+        """Увеличивает версии names одним UPDATE, недостающие строки
+        вставляются вторым запросом."""
+        now = time.time_ns() // 1000
+        names = set(names)
+        updated = cls.objects.filter(name__in=names).update(
+            version=Greatest(models.F('version') + 1, models.Value(now)))
+        if updated < len(names):
+            cls.objects.bulk_create(
+                [cls(name=name, version=now) for name in names],
+                ignore_conflicts=True)
+
+
+class MediaBlob(models.Model):
+    """Файл в хранилище, адресуемом по содержимому, и число ссылок на него."""
+
+    name = models.CharField(max_length=255, unique=True,
+                            verbose_name='Путь к файлу')
+    refcount = models.PositiveIntegerField(default=0,
+                                           verbose_name='Число ссылок')
+
+    class Meta:
+        verbose_name = 'Файл медиа'
+        verbose_name_plural = 'Файлы медиа'
+
+    def __str__(self):
+        return f'{self.name}: {self.refcount}'
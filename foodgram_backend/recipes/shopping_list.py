@@ -0,0 +1,156 @@
+"""Поддержка агрегата списка покупок ShoppingListItem.
+
+Изменения описываются словарем {ingredient_id: (amount, recipe_count)}
+и применяются ко всем строкам пользователей одним UPDATE, поэтому
+число запросов не зависит ни от числа пользователей, ни от числа
+ингредиентов.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Sum, Value, When
+
+from .models import RecipeIngredients, ShoppingCart, ShoppingListItem
+
+
+def _delta(changes, index):
+    return Case(
+        *(When(ingredient_id=ingredient_id, then=Value(change[index]))
+          for ingredient_id, change in changes.items()),
+        default=Value(0), output_field=IntegerField())
+
+
+def apply_changes(user_ids, changes):
+    """Прибавляет changes к спискам покупок пользователей user_ids."""
+    user_ids = list(user_ids)
+    changes = {ingredient_id: change
+               for ingredient_id, change in changes.items() if any(change)}
+    if not user_ids or not changes:
+        return
+    with transaction.atomic():
+        ShoppingListItem.objects.bulk_create(
+            [ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id)
+             for user_id in user_ids
+             for ingredient_id, (_, count) in changes.items() if count > 0],
+            ignore_conflicts=True)
+        items = ShoppingListItem.objects.filter(
+            user_id__in=user_ids, ingredient_id__in=changes)
+        items.update(total_amount=F('total_amount') + _delta(changes, 0),
+                     recipe_count=F('recipe_count') + _delta(changes, 1))
+        items.filter(recipe_count__lte=0).delete()
+
+
+def get_recipe_changes(recipe_id, sign=1):
+    """Изменения от добавления (sign=1) или удаления (-1) рецепта."""
+    return {
+        ingredient_id: (sign * amount, sign)
+        for ingredient_id, amount in RecipeIngredients.objects.filter(
+            recipe_id=recipe_id).values_list('ingredient_id', 'amount')
+    }
+
+
+def get_recipes_changes(added=(), removed=()):
+    """Изменения от добавления рецептов added и удаления removed."""
+    changes = defaultdict(lambda: (0, 0))
+    for recipe_ids, sign in ((added, 1), (removed, -1)):
+        if not recipe_ids:
+            continue
+        rows = RecipeIngredients.objects.filter(
+            recipe_id__in=recipe_ids).values('ingredient_id').annotate(
+                amount=Sum('amount'), count=Count('pk')).values_list(
+                    'ingredient_id', 'amount', 'count').order_by()
+        for ingredient_id, amount, count in rows:
+            total, recipes = changes[ingredient_id]
+            changes[ingredient_id] = (total + sign * amount,
+                                      recipes + sign * count)
+    return changes
+
+
+def get_ingredients_changes(old, new):
+    """Изменения от замены ингредиентов рецепта old на new.
+
+    old и new - словари {ingredient_id: amount}.
+    """
+    changes = {}
+    for ingredient_id in old.keys() | new.keys():
+        changes[ingredient_id] = (
+            new.get(ingredient_id, 0) - old.get(ingredient_id, 0),
+            (ingredient_id in new) - (ingredient_id in old))
+    return changes
+
+
+def get_cart_user_ids(recipe_id):
+    return ShoppingCart.objects.filter(recipe_id=recipe_id).values_list(
+        'user_id', flat=True)
+
+
+def add_recipe(user_id, recipe_id):
+    apply_changes([user_id], get_recipe_changes(recipe_id))
+
+
+def remove_recipe(user_id, recipe_id):
+    apply_changes([user_id], get_recipe_changes(recipe_id, sign=-1))
+
+
+def change_recipes(user_id, added=(), removed=()):
+    """Добавляет и удаляет рецепты корзины одним обновлением."""
+    apply_changes([user_id], get_recipes_changes(added, removed))
+
+
+def change_recipe_ingredients(recipe_id, old, new):
+    """Переносит изменение ингредиентов рецепта в корзины с ним."""
+    apply_changes(get_cart_user_ids(recipe_id),
+                  get_ingredients_changes(old, new))
+
+
+def compute(user_ids=None):
+    """Списки покупок по корзинам, посчитанные соединением таблиц.
+
+    Возвращает {user_id: {ingredient_id: (total_amount, recipe_count)}}.
+    """
+    carts = ShoppingCart.objects.filter(
+        recipe__recipe_ingredients__isnull=False)
+    if user_ids is not None:
+        carts = carts.filter(user_id__in=user_ids)
+    rows = carts.values(
+        'user_id',
+        ingredient_id=F('recipe__recipe_ingredients__ingredient_id'),
+    ).annotate(
+        total_amount=Sum('recipe__recipe_ingredients__amount'),
+        recipe_count=Count('recipe'),
+    ).order_by()
+    result = defaultdict(dict)
+    for row in rows:
+        result[row['user_id']][row['ingredient_id']] = (
+            row['total_amount'], row['recipe_count'])
+    return result
+
+
+def read(user_ids=None):
+    """Сохраненные списки покупок в формате compute()."""
+    items = ShoppingListItem.objects.all()
+    if user_ids is not None:
+        items = items.filter(user_id__in=user_ids)
+    result = defaultdict(dict)
+    for user_id, ingredient_id, total_amount, recipe_count in (
+            items.values_list('user_id', 'ingredient_id', 'total_amount',
+                              'recipe_count')):
+        result[user_id][ingredient_id] = (total_amount, recipe_count)
+    return result
+
+
+def rebuild(user_ids=None, batch_size=1000):
+    """Пересчитывает списки покупок заново из корзин."""
+    with transaction.atomic():
+        items = ShoppingListItem.objects.all()
+        if user_ids is not None:
+            items = items.filter(user_id__in=user_ids)
+        items.delete()
+        ShoppingListItem.objects.bulk_create(
+            (ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                              total_amount=total_amount,
+                              recipe_count=recipe_count)
+             for user_id, ingredients in compute(user_ids).items()
+             for ingredient_id, (total_amount, recipe_count)
+             in ingredients.items()),
+            batch_size=batch_size)
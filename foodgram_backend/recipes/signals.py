@@ -0,0 +1,124 @@
+"""Поддержка списков покупок и лент подписок при изменении данных."""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from users.models import Follow
+
+from . import shopping_list, timeline
+from .models import RecipeIngredients, Recipes, ShoppingCart
+
+# Пакетный импорт справочника обходит сигналы моделей; после коммита
+# отправляется этот сигнал с sender=модель и updated=True, если импорт
+# мог изменить существующие записи.
+catalogue_imported = Signal()
+
+# Пакетное изменение ингредиентов рецепта (bulk_create, bulk_update и
+# удаление внутри suspend_ingredient_signals) обходит сигналы модели;
+# после него отправляется этот сигнал с recipe_id, old и new - словарями
+# {ingredient_id: amount} до и после изменения.
+recipe_ingredients_changed = Signal()
+
+# Пакетный импорт рецептов (bulk_create) обходит сигналы моделей; внутри
+# транзакции импорта отправляется этот сигнал с recipes - списком
+# созданных рецептов.
+recipes_imported = Signal()
+
+# Пакетное изменение избранного или корзины обходит сигналы моделей;
+# внутри транзакции отправляется этот сигнал с sender=Favorites или
+# ShoppingCart, user_id, added и removed - id добавленных и удаленных
+# рецептов.
+user_recipes_changed = Signal()
+_ingredient_signals_suspended = ContextVar('ingredient_signals_suspended',
+                                           default=False)
+
+
+@contextmanager
+def suspend_ingredient_signals():
+    """Отключает обработку сигналов RecipeIngredients внутри блока."""
+    token = _ingredient_signals_suspended.set(True)
+    try:
+        yield
+    finally:
+        _ingredient_signals_suspended.reset(token)
+
+
+def ingredient_signals_suspended():
+    return _ingredient_signals_suspended.get()
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_shopping_list(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        shopping_list.add_recipe(instance.user_id, instance.recipe_id)
+
+
+@receiver(user_recipes_changed, sender=ShoppingCart)
+def change_shopping_list(sender, user_id, added, removed, **kwargs):
+    shopping_list.change_recipes(user_id, added, removed)
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def remove_from_shopping_list(sender, instance, **kwargs):
+    shopping_list.remove_recipe(instance.user_id, instance.recipe_id)
+
+
+@receiver(pre_save, sender=RecipeIngredients)
+def remember_recipe_ingredient(sender, instance, raw=False, **kwargs):
+    instance._shopping_list_old = None
+    if instance.pk and not raw and not ingredient_signals_suspended():
+        instance._shopping_list_old = RecipeIngredients.objects.filter(
+            pk=instance.pk).values_list(
+                'recipe_id', 'ingredient_id', 'amount').first()
+
+
+@receiver(post_save, sender=RecipeIngredients)
+def change_recipe_ingredient(sender, instance, raw=False, **kwargs):
+    if raw or ingredient_signals_suspended():
+        return
+    new = {instance.ingredient_id_id: instance.amount}
+    old = getattr(instance, '_shopping_list_old', None)
+    if old is not None and old[0] != instance.recipe_id_id:
+        shopping_list.change_recipe_ingredients(old[0], {old[1]: old[2]}, {})
+        old = None
+    shopping_list.change_recipe_ingredients(
+        instance.recipe_id_id, {old[1]: old[2]} if old else {}, new)
+
+
+@receiver(post_delete, sender=RecipeIngredients)
+def delete_recipe_ingredient(sender, instance, **kwargs):
+    if ingredient_signals_suspended():
+        return
+    shopping_list.change_recipe_ingredients(
+        instance.recipe_id_id, {instance.ingredient_id_id: instance.amount},
+        {})
+
+
+@receiver(recipe_ingredients_changed)
+def apply_recipe_ingredients_change(sender, recipe_id, old, new, **kwargs):
+    shopping_list.change_recipe_ingredients(recipe_id, old, new)
+
+
+@receiver(post_save, sender=Recipes)
+def publish_to_timelines(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timeline.schedule_fan_out(instance.pk)
+
+
+@receiver(recipes_imported)
+def publish_imported_to_timelines(sender, recipes, **kwargs):
+    for recipe in recipes:
+        timeline.schedule_fan_out(recipe.pk)
+
+
+@receiver(post_save, sender=Follow)
+def backfill_timeline(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timeline.follow(instance.user_id, instance.following_id)
+
+
+@receiver(post_delete, sender=Follow)
+def prune_timeline(sender, instance, **kwargs):
+    timeline.unfollow(instance.user_id, instance.following_id)
@@ -0,0 +1,90 @@
+"""Хранилище медиа, адресуемое по содержимому.
+
+Файл сохраняется под именем <каталог>/<xx>/<sha256><расширение>, поэтому
+одинаковые загрузки хранятся один раз, а содержимое по имени никогда не
+меняется и может кешироваться навсегда. Каждое сохранение добавляет
+ссылку на файл, каждое удаление снимает ее; сам файл удаляется, когда
+ссылок не осталось.
+"""
+import hashlib
+import os
+import posixpath
+import re
+
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+
+# Размер куска при чтении файла для подсчета хеша.
+HASH_CHUNK_SIZE = 65536
+CONTENT_NAME_RE = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{64}(\.\w+)?$')
+
+
+def hash_file(content):
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def is_content_name(name):
+    return bool(CONTENT_NAME_RE.search(name or ''))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage с именами по sha256 и подсчетом ссылок."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(*args, **kwargs)
+
+    def get_content_name(self, name, content):
+        directory, filename = posixpath.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        digest = hash_file(content)
+        return posixpath.join(directory, digest[:2], digest + extension)
+
+    def _save(self, name, content):
+        name = self.get_content_name(name, content)
+        with transaction.atomic():
+            blob = self.lock_blob(name)
+            if not super().exists(name):
+                name = super()._save(name, content)
+            blob.refcount += 1
+            blob.save(update_fields=['refcount'])
+        return name
+
+    def add_reference(self, name):
+        """Еще одна ссылка на уже сохраненный файл."""
+        with transaction.atomic():
+            blob = self.lock_blob(name)
+            blob.refcount += 1
+            blob.save(update_fields=['refcount'])
+
+    @staticmethod
+    def lock_blob(name):
+        from recipes.models import MediaBlob
+
+        return MediaBlob.objects.select_for_update().get_or_create(
+            name=name)[0]
+
+    def delete(self, name):
+        from recipes.models import MediaBlob
+
+        if not name:
+            raise ValueError('The name must be given to delete().')
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(
+                name=name).first()
+            if blob is None:
+                # Файл сохранен до перехода на это хранилище.
+                return super().delete(name)
+            if blob.refcount > 1:
+                blob.refcount -= 1
+                blob.save(update_fields=['refcount'])
+                return
+            blob.delete()
+            super().delete(name)
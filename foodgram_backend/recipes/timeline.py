@@ -0,0 +1,166 @@
+"""Ленты подписок TimelineEntry.
+
+Новый рецепт раскладывается в ленты подписчиков автора пачками в пуле
+потоков (fan-out on write). У авторов с числом подписчиков от
+FEED_FANOUT_MAX_FOLLOWERS рецепты не раскладываются, а подмешиваются при
+чтении ленты (fan-out on read). Подписка добавляет в ленту последние
+рецепты автора, отписка их удаляет. Когда автор пересекает порог,
+кешированный список авторов с fan-out on read сбрасывается, а при
+переходе обратно к fan-out on write его последние рецепты раскладываются
+по лентам всех подписчиков: пока он был выше порога, в ленты они не
+попадали.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.db.models import Count
+
+from users.models import Follow
+
+from .models import Recipes, TimelineEntry
+
+logger = logging.getLogger(__name__)
+
+FANOUT_ON_READ_CACHE_KEY = 'timeline:fanout_on_read_authors'
+
+executor = ThreadPoolExecutor(max_workers=settings.FEED_FANOUT_WORKERS,
+                              thread_name_prefix='feed')
+
+
+def is_fanout_on_read(author_id):
+    return Follow.objects.filter(following=author_id).count() >= (
+        settings.FEED_FANOUT_MAX_FOLLOWERS)
+
+
+def get_fanout_on_read_author_ids():
+    """Авторы, чьи рецепты подмешиваются при чтении; кешируется."""
+    author_ids = cache.get(FANOUT_ON_READ_CACHE_KEY)
+    if author_ids is None:
+        author_ids = list(Follow.objects.values('following').annotate(
+            followers=Count('pk')).filter(
+                followers__gte=settings.FEED_FANOUT_MAX_FOLLOWERS
+        ).values_list('following', flat=True).order_by())
+        cache.set(FANOUT_ON_READ_CACHE_KEY, author_ids,
+                  settings.FEED_FANOUT_CACHE_TIMEOUT)
+    return author_ids
+
+
+def fan_out(recipe_id):
+    """Раскладывает рецепт по лентам подписчиков автора."""
+    recipe = Recipes.objects.filter(pk=recipe_id).values(
+        'author_id', 'pub_date').first()
+    if recipe is None or is_fanout_on_read(recipe['author_id']):
+        return 0
+    follower_ids = Follow.objects.filter(
+        following=recipe['author_id']).values_list(
+            'user_id', flat=True).order_by('pk').iterator(
+                chunk_size=settings.FEED_FANOUT_CHUNK_SIZE)
+    total = 0
+    while chunk := list(islice(follower_ids,
+                               settings.FEED_FANOUT_CHUNK_SIZE)):
+        TimelineEntry.objects.bulk_create(
+            (TimelineEntry(user_id=user_id, recipe_id=recipe_id,
+                           author_id=recipe['author_id'],
+                           pub_date=recipe['pub_date'])
+             for user_id in chunk), ignore_conflicts=True)
+        total += len(chunk)
+    return total
+
+
+def run(task, *args):
+    try:
+        task(*args)
+    except Exception:
+        logger.exception('Не удалось обновить ленты: %s%r', task.__name__,
+                         args)
+    finally:
+        close_old_connections()
+
+
+def schedule_fan_out(recipe_id):
+    transaction.on_commit(lambda: executor.submit(run, fan_out, recipe_id))
+
+
+def get_recent_recipes(author_id):
+    return list(Recipes.objects.filter(author=author_id).values_list(
+        'pk', 'pub_date')[:settings.FEED_BACKFILL_SIZE])
+
+
+def add_entries(user_ids, author_id, recipes):
+    TimelineEntry.objects.bulk_create(
+        (TimelineEntry(user_id=user_id, recipe_id=recipe_id,
+                       author_id=author_id, pub_date=pub_date)
+         for user_id in user_ids for recipe_id, pub_date in recipes),
+        ignore_conflicts=True)
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту пользователя последние рецепты автора."""
+    if not is_fanout_on_read(author_id):
+        add_entries([user_id], author_id, get_recent_recipes(author_id))
+
+
+def backfill_followers(author_id):
+    """Добавляет последние рецепты автора в ленты всех подписчиков."""
+    if is_fanout_on_read(author_id):
+        return
+    recipes = get_recent_recipes(author_id)
+    follower_ids = Follow.objects.filter(following=author_id).values_list(
+        'user_id', flat=True).order_by('pk').iterator(
+            chunk_size=settings.FEED_FANOUT_CHUNK_SIZE)
+    while chunk := list(islice(follower_ids,
+                               settings.FEED_FANOUT_CHUNK_SIZE)):
+        add_entries(chunk, author_id, recipes)
+
+
+def prune(user_id, author_id):
+    """Удаляет из ленты пользователя рецепты автора."""
+    TimelineEntry.objects.filter(user=user_id, author=author_id).delete()
+
+
+def follow(user_id, author_id):
+    """Обновляет ленты после подписки user_id на author_id."""
+    followers = Follow.objects.filter(following=author_id).count()
+    if followers < settings.FEED_FANOUT_MAX_FOLLOWERS:
+        add_entries([user_id], author_id, get_recent_recipes(author_id))
+        return
+    cached = cache.get(FANOUT_ON_READ_CACHE_KEY)
+    if (followers == settings.FEED_FANOUT_MAX_FOLLOWERS
+            or cached is not None and author_id not in cached):
+        # Автор перешел к fan-out on read: до истечения кеша его новые
+        # рецепты не попали бы ни в ленты, ни в чтение.
+        cache.delete(FANOUT_ON_READ_CACHE_KEY)
+
+
+def unfollow(user_id, author_id):
+    """Обновляет ленты после отписки user_id от author_id."""
+    prune(user_id, author_id)
+    followers = Follow.objects.filter(following=author_id).count()
+    if followers >= settings.FEED_FANOUT_MAX_FOLLOWERS:
+        return
+    cached = cache.get(FANOUT_ON_READ_CACHE_KEY)
+    if (followers == settings.FEED_FANOUT_MAX_FOLLOWERS - 1
+            or cached is not None and author_id in cached):
+        # Автор вернулся к fan-out on write, а его рецептов в лентах
+        # подписчиков нет.
+        cache.delete(FANOUT_ON_READ_CACHE_KEY)
+        transaction.on_commit(
+            lambda: executor.submit(run, backfill_followers, author_id))
+
+
+def rebuild(user_ids=None):
+    """Пересобирает ленты по текущим подпискам."""
+    follows = Follow.objects.all()
+    entries = TimelineEntry.objects.all()
+    if user_ids is not None:
+        follows = follows.filter(user__in=user_ids)
+        entries = entries.filter(user__in=user_ids)
+    with transaction.atomic():
+        entries.delete()
+        for user_id, author_id in follows.values_list(
+                'user_id', 'following_id').iterator():
+            backfill(user_id, author_id)
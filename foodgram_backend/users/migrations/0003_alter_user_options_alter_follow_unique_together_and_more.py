@@ -31,6 +31,6 @@ class Migration(migrations.Migration):
         ),
         migrations.AddConstraint(
             model_name='follow',
-            constraint=models.UniqueConstraint(condition=models.Q(('user__ne', models.F('following'))), fields=('user', 'following'), name='non_self_follow'),
+            constraint=models.UniqueConstraint(condition=models.Q(('user', models.F('following')), _negated=True), fields=('user', 'following'), name='non_self_follow'),
         ),
     ]
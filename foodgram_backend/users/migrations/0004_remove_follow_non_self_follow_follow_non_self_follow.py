@@ -16,6 +16,6 @@ class Migration(migrations.Migration):
         ),
         migrations.AddConstraint(
             model_name='follow',
-            constraint=models.UniqueConstraint(condition=models.Q(('user_id__ne', models.F('following_id'))), fields=('user', 'following'), name='non_self_follow'),
+            constraint=models.UniqueConstraint(condition=models.Q(('user_id', models.F('following_id')), _negated=True), fields=('user', 'following'), name='non_self_follow'),
         ),
     ]
@@ -26,6 +26,8 @@ class User(AbstractUser):
     password = models.CharField('Пароль', max_length=MAX_PASSWORD_LENGTH)
     avatar = models.ImageField('Аватар пользователя',
                                upload_to='users/avatars/')
+    avatar_variants = models.JSONField('Копии аватара', default=dict,
+                                       blank=True, editable=False)
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name', 'password']
 